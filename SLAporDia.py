@@ -1,13 +1,15 @@
 import requests
 import json
 from datetime import datetime, timedelta, timezone
-import numpy as np
 import os
 from dotenv import dotenv_values
 from redis_connection import get_redis_connection
 from dateutil import parser
 from parseDT import parse_date
-from metabase import get_dataset, process_data
+from business_calendar import roll_past_cutoff, next_business_day, roll_backward
+from metabase import get_dataset, iter_dataset, process_data
+from sla_counters import month_rolled_over
+import exclusions
 
 env_config = dotenv_values(".env")
 
@@ -16,21 +18,6 @@ nova_hora = (hora_agora - timedelta(hours=3)).strftime("%H:%M")
 
 redis_client = get_redis_connection()
 
-class CONFIG:
-
-    FERIADOS_ACCOUNTS = []
-
-    def __init__(self):
-            self.JSON_CONFIG = self.get_configurations()
-            self.FERIADOS_ACCOUNTS = self.JSON_CONFIG["BR"]["holidays"]
-
-    def get_configurations(self):
-            with open("json/config.json", "r", ) as f:
-                config = json.load(f)
-            return config
-        
-config = CONFIG()
-
 def erase_json_files():
     # List of all JSON files to erase
     json_files = ["json/excluded_orders.json", "json/excluded_recibos.json", "json/sla_embu.json"]
@@ -39,47 +26,13 @@ def erase_json_files():
         with open(file_path, "w") as file:
             json.dump([], file)
     save_to_redis("sla_embu", "[]")
-    save_to_redis("excluded_orders", "[]")
-    save_to_redis("excluded_recibos", "[]")
+    exclusions.clear_exclusions()
     print("jsons apagados")
 
 def check_and_erase_json_files():
-    # Path to the file storing the last cleanup date
-    last_cleanup_file = "last_cleanup.txt"
-
-    # Get the current date
-    now = datetime.now()
-    current_month = now.month
-    current_year = now.year
-
-    # Check if the last_cleanup_file exists and is not empty
-    if os.path.exists(last_cleanup_file):
-        with open(last_cleanup_file, "r") as f:
-            last_cleanup_date = f.read().strip()
-        
-        try:
-            # Extract the last cleanup month and year
-            last_cleanup_month, last_cleanup_year = map(int, last_cleanup_date.split("-"))
-        except (ValueError, IndexError):
-            # If the file is empty or has invalid format, perform cleanup and write the current date
-            erase_json_files()
-            with open(last_cleanup_file, "w") as f:
-                f.write(f"{current_month}-{current_year}")
-            return
-
-        # Check if it is a new month
-        if (current_month != last_cleanup_month or current_year != last_cleanup_year):
-            erase_json_files()
-            # Update the last cleanup date
-            with open(last_cleanup_file, "w") as f:
-                f.write(f"{current_month}-{current_year}")
-
-    else:
-        # If file does not exist, perform cleanup and create the file
+    # The month is kept in Redis and shared with sla_pipeline, which clears every warehouse at once
+    if month_rolled_over():
         erase_json_files()
-        with open(last_cleanup_file, "w") as f:
-            f.write(f"{current_month}-{current_year}")
-
 
 def save_to_redis(key, data):
     try:
@@ -93,22 +46,15 @@ def save_to_redis(key, data):
 
 
 def load_excluded_orders():
-    try:
-        with open("json/excluded_orders.json", "r") as file:
-            return json.load(file)
-    except FileNotFoundError:
-        return []
+    # frozenset cached by the exclusions module, refreshed when the Redis set changes
+    return exclusions.excluded_orders()
 
 def save_excluded_orders(excluded_orders):
     with open("json/excluded_orders.json", "w") as file:
         json.dump(excluded_orders, file)
 
 def load_excluded_recibos():
-    try:
-        with open("json/excluded_recibos.json", "r") as file:
-            return json.load(file)
-    except FileNotFoundError:
-        return []
+    return exclusions.excluded_recibos()
 
 def save_excluded_recibos(excluded_recibos):
     with open("json/excluded_recibos.json", "w") as file:
@@ -137,33 +83,15 @@ def adjust_shipping_date(shipping_date, carrier):
         'JT Express': (17, 0)
     }
 
-    hour, minute = cut_off_hours.get(carrier, cut_off_hours['LOGGI'])
-
-    # Check if shipping date is after cut off time or is a holiday
-    if (shipping_date.hour > hour or 
-        (shipping_date.hour == hour and shipping_date.minute >= minute) or 
-        shipping_date.weekday() >= 5 or  # Check if it's Saturday or Sunday
-        shipping_date.strftime('%Y-%m-%d') in CONFIG['BR']['holidays']):
-        
-        # Increment the shipping date by one day until it's not a holiday or weekend
-        while True:
-            shipping_date += timedelta(days=1)
-            if (shipping_date.weekday() < 5 and 
-                shipping_date.strftime('%Y-%m-%d') not in CONFIG['BR']['holidays']):
-                break
-
-    return shipping_date
+    # Past the cutoff, on a weekend or on a holiday: next business day, same time
+    return roll_past_cutoff(shipping_date, cut_off_hours.get(carrier, cut_off_hours['LOGGI']))
 
 def adjust_receiving_date(recibo):
 
-    # Convert recibo to numpy datetime64[D] format
-    recibo_np = np.datetime64(parse_date(recibo).strftime('%Y-%m-%d'))
+    # One business day after the receiving day (or after the business day before it)
+    adjusted_date = next_business_day(roll_backward(parse_date(recibo).date()))
 
-    adjusted_date_np = np.busday_offset(recibo_np, 1, roll='backward', holidays=config.JSON_CONFIG['BR']['holidays'])
-# Replace deprecated usage
-    adjusted_datetime = datetime.fromtimestamp(adjusted_date_np.astype('datetime64[s]').astype(int), tz=timezone.utc)
-
-    return adjusted_datetime
+    return datetime(adjusted_date.year, adjusted_date.month, adjusted_date.day, tzinfo=timezone.utc)
 
 dir_path = os.path.dirname(os.path.abspath(__file__))
 with open(os.path.join(dir_path, "json/config.json"), "r") as f:
@@ -175,14 +103,10 @@ def last_workday_of_previous_month():
     first_day_of_this_month = today.replace(day=1)
     last_day_of_previous_month = first_day_of_this_month - timedelta(days=1)
 
-    # Loop backwards from the last day of the month until we find a workday
-    while last_day_of_previous_month.weekday() >= 5:  # Saturday or Sunday
-        last_day_of_previous_month -= timedelta(days=1)
+    # Back to the last workday; from a weekend the window starts at 05:00
+    if last_day_of_previous_month.weekday() >= 5:  # Saturday or Sunday
         last_day_of_previous_month = last_day_of_previous_month.replace(hour=5)
-    
-    # If the last day of the previous month is a holiday, go one day backward
-    while last_day_of_previous_month.strftime("%Y-%m-%d") in CONFIG['BR']['holidays']:
-        last_day_of_previous_month -= timedelta(days=1)
+    last_day_of_previous_month = roll_backward(last_day_of_previous_month)
 
     print(last_day_of_previous_month)
     return last_day_of_previous_month
@@ -202,9 +126,8 @@ def ajuste_pendentes():
         }
     )
 
-    orders_list = get_dataset('1496', incentivo_inputs)
-
-    #print(orders_list)
+    # Rows are classified while the card is still downloading
+    orders_list = iter_dataset('1496', incentivo_inputs)
 
     marcas = ["FOSFORO", "Dois Pontos", "Boitempo", "Qura Editora", "TAG Livros"]
 
@@ -212,7 +135,7 @@ def ajuste_pendentes():
     for order in orders_list:
         #print(order)
         order_number = order['order_number']
-        if order_number in excluded_orders:
+        if str(order_number) in excluded_orders:
             continue
 
         if order['status'] == "canceled" or order['status'] == "holded":
@@ -306,9 +229,8 @@ def incentivos_pedidos(todos_pedidos):
                 })
         
 
-    for excluded_order in excluded_orders:
-        # Remove the excluded orders from the atraso list
-        atraso = [entry for entry in atraso if entry['order_number'] != excluded_order]
+    # Remove the excluded orders from the atraso list
+    atraso = [entry for entry in atraso if str(entry['order_number']) not in excluded_orders]
 
     sla_porcent = (hit_count / len(todos_pedidos)) * 100
 
@@ -447,9 +369,8 @@ def incentivos_recibo():
             continue
 
 
-    for excluded_recibo in excluded_recibos:
-        # Remove the excluded orders from the atraso list
-        atraso_recibo = [r for r in atraso_recibo if r['id'] != excluded_recibo]
+    # Remove the excluded receipts from the atraso list (ids are stored as strings)
+    atraso_recibo = [r for r in atraso_recibo if str(r['id']) not in excluded_recibos]
 
     todos_recibos=len(recibos_data)
     if todos_recibos == 0:
@@ -41,8 +41,14 @@ import schedule
 import requests
 from slack_sdk import WebClient
 from google.auth.exceptions import RefreshError
-from metabase import get_dataset, process_data
+from metabase import get_dataset, process_data, breaker, MetabaseUnavailable, WEB_DEADLINE
+from metabase_metrics import track_caller, set_caller, load_metrics, METRICS_RETENTION_HOURS
+from job_timings import load_timings, TIMINGS_HISTORY
+from sla_history import load_history, RESOLUTIONS
+from snapshot_store import load_card_snapshot, iter_snapshot_rows, params_inputs
 from google_auth import authenticate_google
+from exclusions import (add_exclusions, remove_exclusions, load_exclusions, excluded_orders, excluded_recibos,
+                        EXCLUSION_KINDS)
 
 app = Flask(__name__)
 CORS(app)  # Enable Cross-Origin Resource Sharing if needed
@@ -100,28 +106,23 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
-def job_embu():
-    """Update Embu SLAs - runs every 5 minutes"""
-    try:
-        logger.info("Starting Embu SLA update job")
-        # Import and call the main function directly
-        from incentivosEmbu import main as embu_main
-        embu_main()
-        logger.info("Embu SLA update completed successfully")
-    except Exception as e:
-        logger.error(f"Error in Embu job: {e}")
+@app.before_request
+def tag_metabase_caller():
+    # Metabase calls made while serving this request are attributed to the route
+    set_caller(f"route:{request.endpoint}")
 
-def job_extrema():
-    """Update Extrema SLAs - runs every 7 minutes"""
+@track_caller
+def job_sla():
+    """Update the Embu, Extrema and POA SLAs in one run - runs every 5 minutes"""
     try:
-        logger.info("Starting Extrema SLA update job")
-        # Import and call the main function directly
-        from incentivosExtrema import main as extrema_main
-        extrema_main()
-        logger.info("Extrema SLA update completed successfully")
+        logger.info("Starting SLA update job")
+        from sla_pipeline import run_pipeline
+        run_pipeline()
+        logger.info("SLA update completed successfully")
     except Exception as e:
-        logger.error(f"Error in Extrema job: {e}")
+        logger.error(f"Error in SLA job: {e}")
 
+@track_caller
 def job_bonus():
     """Update bonus calculations - runs every 3 minutes"""
     try:
@@ -133,6 +134,7 @@ def job_bonus():
     except Exception as e:
         logger.error(f"Error in bonus job: {e}")
 
+@track_caller
 def job_report_ops():
     """Generate operations report - runs daily at 8 PM"""
     try:
@@ -151,6 +153,7 @@ def job_report_ops():
     except Exception as e:
         logger.error(f"Error in report ops job: {e}")
 
+@track_caller
 def job_pp_repo():
     """Update PP repository - runs every hour"""
     try:
@@ -161,6 +164,7 @@ def job_pp_repo():
     except Exception as e:
         logger.error(f"Error in PP repo job: {e}")
 
+@track_caller
 def job_controle_fluxo_pedidos_natura():
     """Update Natura order flow control - runs every 5 minutes"""
     try:
@@ -176,6 +180,7 @@ def job_controle_fluxo_pedidos_natura():
     except Exception as e:
         logger.error(f"Error in Natura order flow job: {e}")
 
+@track_caller
 def job_nf_erro():
     """Update NF error tracking - runs every 30 minutes"""
     try:
@@ -195,6 +200,7 @@ def job_nf_erro():
     except Exception as e:
         logger.error(f"Error in NF error job: {e}")
 
+@track_caller
 def job_store_status():
     """Update store status monitoring - runs every minute"""
     try:
@@ -216,6 +222,7 @@ def job_store_status():
     except Exception as e:
         logger.error(f"Error in store status job: {e}")
 
+@track_caller
 def job_inventory_export():
     """Daily inventory export job - runs at 11 PM São Paulo time"""
     try:
@@ -416,6 +423,20 @@ def export_daily_inventory_to_sheets(target_date):
         app.logger.error(f"Error exporting inventory to Google Sheets for {target_date}: {str(e)}")
         return False
 
+@track_caller
+def job_reconcile_incremental():
+    """Force a full refetch of the incremental order stores and SLA counters - runs nightly"""
+    try:
+        logger.info("Starting incremental store reconcile job")
+        from incremental_fetch import reset_watermarks
+        from sla_counters import reset_counters
+        reset_watermarks()
+        reset_counters()
+        logger.info("Incremental store reconcile completed successfully")
+    except Exception as e:
+        logger.error(f"Error in incremental reconcile job: {e}")
+
+@track_caller
 def job_lfbot():
     """Run LFbot stock movement check and send message if needed - runs every minute"""
     try:
@@ -434,8 +455,7 @@ def job_lfbot():
         logger.error(f"Error in LFbot job: {e}")
 
 # Configure jobs with proper settings
-scheduler.add_job(job_embu, 'interval', minutes=5, id='embu_sla', replace_existing=True)
-scheduler.add_job(job_extrema, 'interval', minutes=7, id='extrema_sla', replace_existing=True)
+scheduler.add_job(job_sla, 'interval', minutes=5, id='sla', replace_existing=True)
 scheduler.add_job(job_bonus, 'interval', minutes=3, id='bonus_calc', replace_existing=True)
 #scheduler.add_job(job_report_ops, 'cron', hour=20, minute=0, id='report_ops', replace_existing=True)
 #scheduler.add_job(job_pp_repo, 'interval', hours=1, id='pp_repo', replace_existing=True)  # Commented out - file doesn't exist
@@ -447,6 +467,7 @@ scheduler.add_job(job_lfbot, 'interval', minutes=1, id='lfbot', replace_existing
 # Inventory jobs - São Paulo timezone (America/Sao_Paulo)
 scheduler.add_job(job_inventory_export, CronTrigger(hour=23, minute=0, timezone='America/Sao_Paulo'), id='inventory_export', replace_existing=True)
 scheduler.add_job(cleanup_old_inventory_data, CronTrigger(hour=0, minute=30, timezone='America/Sao_Paulo'), id='inventory_cleanup', replace_existing=True)
+scheduler.add_job(job_reconcile_incremental, CronTrigger(hour=3, minute=0, timezone='America/Sao_Paulo'), id='incremental_reconcile', replace_existing=True)
 
 # Remove the @app.before_request decorator and start scheduler properly
 def initialize_scheduler():
@@ -958,32 +979,11 @@ def update_json():
 def update_excluded_orders():
     try:
         new_data = request.get_json()
-        json_file_path = 'json/excluded_orders.json'
-        
-        # Read existing data
-        with open(json_file_path, 'r') as file:
-            json_data = json.load(file)
-        
-        # Ensure json_data is a dictionary with 'excluded_orders' key
-        if not isinstance(json_data, dict):
-            json_data = {'excluded_orders': []}
-        elif 'excluded_orders' not in json_data:
-            json_data['excluded_orders'] = []
-        
-        # Append new excluded order
-        json_data['excluded_orders'].append(new_data['excluded_order'])
-        
-        # Write updated data back to file
-        with open(json_file_path, 'w') as file:
-            json.dump(json_data, file, indent=2)
-        
-        # Save to Redis
-        save_to_redis("excluded_orders", json_data)
-        
-        return jsonify(json_data)
-    
+        add_exclusions('orders', [new_data['excluded_order']])
+        return jsonify({'excluded_orders': sorted(excluded_orders())})
+
     except Exception as e:
-        app.logger.error('Error updating excluded orders JSON: %s', e)
+        app.logger.error('Error updating excluded orders: %s', e)
         return jsonify(error=str(e)), 500
 
 @app.route('/update-excluded-recibos', methods=['POST'])
@@ -991,32 +991,36 @@ def update_excluded_orders():
 def update_excluded_recibos():
     try:
         new_data = request.get_json()
-        json_file_path = 'json/excluded_recibos.json'
-
-        # Read existing data
-        with open(json_file_path, 'r') as file:
-            json_data = json.load(file)
-
-        # Ensure json_data is a dictionary with 'excluded_recibos' key
-        if not isinstance(json_data, dict):
-            json_data = {'excluded_recibos': []}
-        elif 'excluded_recibos' not in json_data:
-            json_data['excluded_recibos'] = []
-
-        # Append new excluded recibo
-        json_data['excluded_recibos'].append(new_data['excluded_recibo'])
+        add_exclusions('recibos', [new_data['excluded_recibo']])
+        return jsonify({'excluded_recibos': sorted(excluded_recibos())})
 
-        # Write updated data back to file
-        with open(json_file_path, 'w') as file:
-            json.dump(json_data, file, indent=2)
-
-        # Save to Redis
-        save_to_redis("excluded_recibos", json_data)
+    except Exception as e:
+        app.logger.error('Error updating excluded recibos: %s', e)
+        return jsonify(error=str(e)), 500
 
-        return jsonify(json_data)
+@app.route('/exclusions/<kind>', methods=['GET', 'POST'])
+@login_required
+def exclusions_bulk(kind):
+    """
+    GET lists the excluded orders or recibos; POST {"add": [...], "remove": [...]}
+    changes many at once, in one Redis round trip each.
+    """
+    if kind not in EXCLUSION_KINDS:
+        return jsonify(error=f"Unknown exclusion kind: {kind}"), 404
+    try:
+        if request.method == 'POST':
+            new_data = request.get_json() or {}
+            to_add = new_data.get('add', [])
+            to_remove = new_data.get('remove', [])
+            if not isinstance(to_add, list) or not isinstance(to_remove, list):
+                return jsonify(error="'add' and 'remove' must be lists"), 400
+            added = add_exclusions(kind, to_add)
+            removed = remove_exclusions(kind, to_remove)
+            app.logger.info('Exclusions %s: %d added, %d removed', kind, added, removed)
+        return jsonify({f'excluded_{kind}': sorted(load_exclusions(kind))})
 
     except Exception as e:
-        app.logger.error('Error updating excluded recibos JSON: %s', e)
+        app.logger.error('Error updating excluded %s: %s', kind, e)
         return jsonify(error=str(e)), 500
     
 #redis funtions
@@ -1041,12 +1045,12 @@ def load_from_redis(key):
         print(f"Error loading data from Redis: {e}")
         return {}
 
-# Adjust functions like load_excluded_orders and save_excluded_orders to use Redis
+# The exclusions live in Redis sets; the JSON files are a sorted copy written by update_jsons
 def load_excluded_orders():
-    return load_from_redis("excluded_orders")
+    return sorted(excluded_orders())
 
 def load_excluded_recibos():
-    return load_from_redis("excluded_recibos")
+    return sorted(excluded_recibos())
 
 def save_excluded_recibos(excluded_recibos):
     with open("json/excluded_recibos.json", "w") as file:
@@ -1167,7 +1171,7 @@ def api_remocoes():
         if remocoes_json:
             remocoes = json.loads(remocoes_json)
         else:
-            remocoes = get_remocoes()
+            remocoes = get_remocoes(deadline=WEB_DEADLINE)
             if not remocoes:
                 return jsonify([])
         
@@ -1457,8 +1461,8 @@ def get_image(numero_pedido, cliente):
 @login_required
 def refresh_remocoes():
     try:
-        # Call the get_remocoes function to fetch fresh data
-        new_remocoes = get_remocoes()
+        # Call the get_remocoes function to fetch fresh data (bypassing the Metabase cache)
+        new_remocoes = get_remocoes(refresh=True, deadline=WEB_DEADLINE)
         
         # Update the Redis cache with the new data
         redis_client.set("remocoes", json.dumps(new_remocoes))
@@ -1467,6 +1471,9 @@ def refresh_remocoes():
         check_removido_status()
         
         return jsonify({"success": True})
+    except MetabaseUnavailable as e:
+        app.logger.error(f"Metabase unavailable refreshing remocoes: {str(e)}")
+        return jsonify({"success": False, "error": str(e)}), 503
     except Exception as e:
         app.logger.error(f"Error refreshing remocoes: {str(e)}")
         return jsonify({"success": False, "error": str(e)}), 500
@@ -1474,6 +1481,22 @@ def refresh_remocoes():
 # Add a global variable to store the latest data
 latest_atrasos_data = None
 
+def restore_latest_atrasos():
+    """Rebuild latest_atrasos_data from the last on-disk snapshot of card 3477 (e.g. after a worker restart)."""
+    snapshot = load_card_snapshot('3477')
+    if snapshot is None:
+        return None
+    inputs = params_inputs(snapshot.meta['params'])
+    print(f"Restoring atrasos data from the snapshot of {snapshot.meta['created_at']}")
+    return update_transportadora_data(
+        transportadora=inputs.get('transportadora'),
+        data_inicial=inputs.get('data_inicial'),
+        data_final=inputs.get('data_final'),
+        cliente=inputs.get('cliente'),
+        status=inputs.get('shipping_status'),
+        rows=iter_snapshot_rows(snapshot)
+    )
+
 @app.route('/update_atrasos', methods=['POST'])
 def update_atrasos_data():
     try:
@@ -1493,13 +1516,17 @@ def update_atrasos_data():
             data_inicial=data_inicial,
             data_final=data_final,
             cliente=marca if marca else None,
-            status=status if status else None
+            status=status if status else None,
+            deadline=WEB_DEADLINE
         )
         
         # Store the data globally
         latest_atrasos_data = updated_data
 
         return jsonify({"success": True, **updated_data})
+    except MetabaseUnavailable as e:
+        app.logger.error(f"Metabase unavailable in update_atrasos_data: {str(e)}")
+        return jsonify({"success": False, "error": str(e)}), 503
     except Exception as e:
         app.logger.error(f"Error in update_atrasos_data: {str(e)}")
         return jsonify({"success": False, "error": str(e)}), 500
@@ -1510,6 +1537,8 @@ def generate_sheets_route():
     global latest_atrasos_data
     
     try:
+        if not latest_atrasos_data:
+            latest_atrasos_data = restore_latest_atrasos()
         if not latest_atrasos_data:
             return jsonify({
                 'success': False,
@@ -1632,7 +1661,7 @@ def api_tote_livre():
         elif isinstance(last_print_date, bytes):
             last_print_date = last_print_date.decode('utf-8')
         # Get real-time data directly from the get_tote_livre function
-        tote_data = get_tote_livre(last_print_date=last_print_date)
+        tote_data = get_tote_livre(last_print_date=last_print_date, refresh=request.args.get('refresh') == '1', deadline=WEB_DEADLINE)
         
         if "error" in tote_data:
             return jsonify({"error": tote_data["error"]}), 500
@@ -1654,7 +1683,7 @@ def api_tote_livre_zpl():
         elif isinstance(last_print_date, bytes):
             last_print_date = last_print_date.decode('utf-8')
         # Get real-time data directly from the get_tote_livre function
-        tote_data = get_tote_livre(last_print_date=last_print_date)
+        tote_data = get_tote_livre(last_print_date=last_print_date, refresh=request.args.get('refresh') == '1', deadline=WEB_DEADLINE)
         
         if "error" in tote_data:
             return jsonify({"error": tote_data["error"]}), 500
@@ -1676,7 +1705,7 @@ def download_tote_zpl():
         elif isinstance(last_print_date, bytes):
             last_print_date = last_print_date.decode('utf-8')
         # Get real-time data directly from the get_tote_livre function
-        tote_data = get_tote_livre(last_print_date=last_print_date)
+        tote_data = get_tote_livre(last_print_date=last_print_date, refresh=request.args.get('refresh') == '1', deadline=WEB_DEADLINE)
         
         if "error" in tote_data:
             return jsonify({"error": tote_data["error"]}), 500
@@ -1722,7 +1751,7 @@ def api_inventory_search():
         from inventario import get_estoque
         
         # Get inventory data for the location
-        products = get_estoque(location)
+        products = get_estoque(location, refresh=bool(data.get('refresh')), deadline=WEB_DEADLINE)
         
         # Ensure products is a list
         if products is None:
@@ -1847,6 +1876,7 @@ def health_check():
             'redis_connected': redis_client.ping(),
             'redis_status': redis_status,
             'job_count': job_count,
+            'metabase_circuit': breaker.status(),
             'timestamp': datetime.now().isoformat()
         })
     except Exception as e:
@@ -1896,6 +1926,14 @@ def metrics():
 def jobs_status():
     """Get detailed status of all scheduled jobs"""
     try:
+        runs = min(int(request.args.get('runs', 1)), TIMINGS_HISTORY)
+        try:
+            # Per-stage durations recorded by the jobs (job_timings.StageTimer), newest run first
+            stage_timings = load_timings(runs)
+        except Exception as e:
+            app.logger.error(f"Error loading job stage timings: {str(e)}")
+            stage_timings = {}
+
         jobs = []
         for job in scheduler.get_jobs():
             jobs.append({
@@ -1905,19 +1943,69 @@ def jobs_status():
                 'next_run_time': job.next_run_time.isoformat() if job.next_run_time else None,
                 'trigger': str(job.trigger),
                 'max_instances': job.max_instances,
-                'misfire_grace_time': job.misfire_grace_time
+                'misfire_grace_time': job.misfire_grace_time,
+                'last_runs': stage_timings.get(job.id, [])
             })
         
         return jsonify({
             'scheduler_running': scheduler.running,
             'total_jobs': len(jobs),
             'jobs': jobs,
+            # Includes runs outside the scheduler, e.g. incentivos*.py run by hand
+            'stage_timings': stage_timings,
             'timestamp': datetime.now().isoformat()
         })
     except Exception as e:
         app.logger.error(f"Error getting jobs status: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
+@app.route('/jobs/metabase-metrics')
+@login_required
+def metabase_metrics():
+    """Per card and caller Metabase latency, payload and cache statistics"""
+    try:
+        hours = min(int(request.args.get('hours', 24)), METRICS_RETENTION_HOURS)
+        cards = load_metrics(hours)
+        return jsonify({
+            'hours': hours,
+            'total_wall_s': round(sum(card['total_wall_s'] for card in cards), 1),
+            'cards': cards,
+            'timestamp': datetime.now().isoformat()
+        })
+    except Exception as e:
+        app.logger.error(f"Error getting Metabase metrics: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/sla-history/<warehouse>')
+@login_required
+def sla_history(warehouse):
+    """
+    SLA of a warehouse over time. start/end are ISO dates (default: the last
+    24 hours), resolution is raw, hourly, daily or auto, fields a comma list.
+    """
+    try:
+        end = datetime.fromisoformat(request.args['end']) if request.args.get('end') else datetime.now()
+        start = datetime.fromisoformat(request.args['start']) if request.args.get('start') else end - timedelta(hours=24)
+    except ValueError as e:
+        return jsonify({"error": f"Invalid date: {e}"}), 400
+    resolution = request.args.get('resolution', 'auto')
+    if resolution not in RESOLUTIONS + ('auto',):
+        return jsonify({"error": f"resolution must be one of {', '.join(RESOLUTIONS)} or auto"}), 400
+    fields = [field for field in request.args.get('fields', '').split(',') if field]
+    try:
+        resolution, points = load_history(warehouse.lower(), start, end,
+                                          None if resolution == 'auto' else resolution, fields)
+        return jsonify({
+            'warehouse': warehouse.lower(),
+            'start': start.isoformat(),
+            'end': end.isoformat(),
+            'resolution': resolution,
+            'points': points
+        })
+    except Exception as e:
+        app.logger.error(f"Error getting SLA history of {warehouse}: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
 
 if __name__ == '__main__':
     try:
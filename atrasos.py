@@ -17,7 +17,8 @@ from collections import Counter
 import re
 from google.oauth2 import service_account
 from parseDT import parse_date
-from metabase import get_dataset, process_data
+from metabase import iter_dataset, iter_shards, date_shards, process_data, JOB_DEADLINE
+from snapshot_store import SnapshotWriter
 from google_auth import authenticate_google, get_sheets_service
 
 env_config = dotenv_values(".env")
@@ -39,7 +40,40 @@ hoje_datetime = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0
 
 # Add this helper function near the top of the file
 
-def get_atrasos(transportadora=None, data_inicial=None, data_final=None, cliente=None, status=None):
+# Windows of card 3477 longer than this are fetched as parallel week shards
+SHARD_WINDOW_DAYS = 7
+
+def iter_atrasos_orders(inputs, deadline=JOB_DEADLINE):
+    """
+    Rows of card 3477 for these filters. A long data_inicial..data_final window
+    is split into week shards fetched in parallel and yielded in date order;
+    the merged rows are snapshotted under the whole window's params.
+    """
+    params = process_data(inputs)
+    try:
+        start = datetime.strptime(str(inputs['data_inicial']), '%Y-%m-%d')
+        end = datetime.strptime(str(inputs['data_final']), '%Y-%m-%d')
+    except ValueError:
+        start = end = None
+    if start is None or (end - start).days < SHARD_WINDOW_DAYS:
+        yield from iter_dataset('3477', params, deadline=deadline)
+        return
+
+    def shard_params(first, last):
+        return process_data({**inputs, 'data_inicial': f"{first:%Y-%m-%d}", 'data_final': f"{last:%Y-%m-%d}"})
+
+    def report_progress(done, total, first, last):
+        print(f"Card 3477: {done}/{total} weeks fetched (up to {last:%Y-%m-%d})")
+
+    writer = SnapshotWriter('3477', params)
+    for _, shard_rows in iter_shards('3477', date_shards(start, end, 'week'), shard_params,
+                                     progress=report_progress, deadline=deadline):
+        for order in shard_rows:
+            writer.append(order)
+            yield order
+    writer.save()
+
+def get_atrasos(transportadora=None, data_inicial=None, data_final=None, cliente=None, status=None, deadline=JOB_DEADLINE, rows=None):
 
     global transp
     global data_in
@@ -61,22 +95,21 @@ def get_atrasos(transportadora=None, data_inicial=None, data_final=None, cliente
         data_final = hoje
 
     print(f"Getting atrasos for transportadora: {transportadora}, data_inicial: {data_inicial}, data_final: {data_final}, cliente: {cliente}, status: {status}")
-    params = process_data({
+    inputs = {
         'transportadora': transportadora,
         'data_inicial': data_inicial,
         'data_final': data_final,
         'cliente': cliente,
         'shipping_status': status
-    })
-
-    dataset = get_dataset('3477', params)
-    
-    print(f"Retrieved {len(dataset)} orders from the dataset")
+    }
 
     atrasos = []
+    total_orders = 0
 
-    #print(dataset)
-    for order in dataset:
+    # Orders are processed as the card streams in instead of after the whole range downloads;
+    # rows (e.g. from the card's on-disk snapshot) replaces the Metabase call
+    for order in (rows if rows is not None else iter_atrasos_orders(inputs, deadline=deadline)):
+        total_orders += 1
         # Initialize adjustment flags at the start
         order['ajuste1'] = False
         order['ajuste2'] = False
@@ -157,6 +190,7 @@ def get_atrasos(transportadora=None, data_inicial=None, data_final=None, cliente
                 'atraso': atraso
             })
 
+    print(f"Retrieved {total_orders} orders from the dataset")
     print(f"Processed {len(atrasos)} atrasos")
 
     return atrasos
@@ -234,13 +268,15 @@ uf_order_counts = count_atrasos_by_uf_and_transportadora(atrasos)
 transportadora_stats = count_atrasos_by_transportadora_with_percentage(atrasos) """
 
 # Modify the end of the file to save data to Redis
-def update_transportadora_data(transportadora=None, data_inicial=None, data_final=None, cliente=None, status=None):
+def update_transportadora_data(transportadora=None, data_inicial=None, data_final=None, cliente=None, status=None, deadline=JOB_DEADLINE, rows=None):
     atrasos = get_atrasos(
         transportadora=transportadora,
         data_inicial=data_inicial,
         data_final=data_final,
         cliente=cliente,
-        status=status
+        status=status,
+        deadline=deadline,
+        rows=rows
     )
     
     order_counts = count_atrasos_by_date_and_transportadora(atrasos)
@@ -0,0 +1,86 @@
+"""
+Time parseDT.parse_date and parse_date_array against the previous
+dateutil-first parse_date on the timestamp columns of synthetic order rows.
+
+Every parsed value must equal the previous parser's, whatever the spelling
+of the UTC offset; any difference is printed and the script exits with status 1.
+
+    python benchmarks/bench_parse_date.py
+    python benchmarks/bench_parse_date.py --sizes 10000 100000 1000000
+"""
+import os
+import sys
+import time
+import argparse
+from datetime import datetime
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+os.chdir(BASE_DIR)
+
+import numpy as np
+from dateutil import parser as dateutil_parser
+from synthetic import generate_orders
+
+FIELDS = ('pending_at', 'shipping_date', 'picking_complete')
+# UTC offset spellings cycled over the values, so parse_date_array is checked against parse_date on all of them
+OFFSET_SUFFIXES = ('-03:00', '-0300', '-03', '+05:30', 'Z')
+
+def with_offsets(values):
+    """The synthetic values end in -03:00; swap it for each spelling in turn."""
+    return [value[:-6] + OFFSET_SUFFIXES[i % len(OFFSET_SUFFIXES)] if value else value
+            for i, value in enumerate(values)]
+
+def previous_parse_date(date_str, date_format="%Y-%m-%dT%H:%M:%S", date_format2="%Y-%m-%dT%H:%M:%S.%f"):
+    """parseDT.parse_date before the fast paths: dateutil first, then the two strptime formats."""
+    if date_str is None or date_str == "":
+        return None
+    try:
+        return dateutil_parser.parse(date_str).replace(tzinfo=None)
+    except (ValueError, TypeError):
+        try:
+            return datetime.strptime(date_str, date_format)
+        except ValueError:
+            try:
+                return datetime.strptime(date_str, date_format2)
+            except ValueError:
+                return None
+
+def timed(function, *args):
+    started = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - started
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the fast-path timestamp parser")
+    parser.add_argument('--sizes', nargs='+', type=int, default=[10000, 100000])
+    args = parser.parse_args()
+
+    import parseDT
+
+    mismatches = 0
+    print(f"{'values':>9} {'dateutil s':>11} {'cold s':>8} {'warm s':>8} {'array s':>8} {'speedup':>8}  match")
+    for size in args.sizes:
+        rows = generate_orders(size, seed=size)
+        values = with_offsets([row[field] for row in rows for field in FIELDS])
+
+        previous, previous_time = timed(lambda: [previous_parse_date(value) for value in values])
+        parseDT._parse_string.cache_clear()
+        cold, cold_time = timed(lambda: [parseDT.parse_date(value) for value in values])
+        warm, warm_time = timed(lambda: [parseDT.parse_date(value) for value in values])
+        array, array_time = timed(parseDT.parse_date_array, values)
+
+        expected = np.array([value if value is not None else 'NaT' for value in previous], dtype='datetime64[us]')
+        match = previous == cold == warm and np.array_equal(array, expected, equal_nan=True)
+        print(f"{len(values):>9} {previous_time:>11.2f} {cold_time:>8.2f} {warm_time:>8.2f} {array_time:>8.2f} "
+              f"{previous_time / cold_time:>7.1f}x  {'yes' if match else 'NO'}")
+        if not match:
+            mismatches += 1
+            for value, old, new in zip(values, previous, cold):
+                if old != new:
+                    print(f"    {value!r}: dateutil {old}, parse_date {new}")
+                    break
+    sys.exit(1 if mismatches else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Compare sla_engine with the row-by-row SLA functions of incentivosEmbu,
+incentivosExtrema and incentivosPOA on synthetic card rows, and time both.
+
+The engine's outputs must equal the legacy ones exactly; any difference is
+printed and the script exits with status 1. Legacy runs are skipped above
+--legacy-max orders since they take minutes at 1M.
+
+    python benchmarks/bench_sla_engine.py
+    python benchmarks/bench_sla_engine.py --sizes 10000 100000 1000000 --warehouses embu poa
+    python benchmarks/bench_sla_engine.py --start 2024-10-20   # covers the 2024 holidays
+"""
+import os
+import sys
+import time
+import argparse
+import importlib
+from datetime import datetime
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+os.chdir(BASE_DIR)
+
+from synthetic import generate_orders, generate_recibos
+
+WAREHOUSES = {
+    'embu': ('incentivosEmbu', 'EMBU'),
+    'extrema': ('incentivosExtrema', 'EXTREMA'),
+    'poa': ('incentivosPOA', 'POA'),
+}
+
+def run_legacy(module, orders, recibos, excluded_orders, excluded_recibos):
+    # The legacy functions overwrite fields of the rows they read
+    module.fetch_orders = lambda: [dict(row) for row in orders]
+    module.fetch_recibos = lambda: [dict(row) for row in recibos]
+    module.load_excluded_orders = lambda: excluded_orders
+    module.load_excluded_recibos = lambda: excluded_recibos
+    todos_pedidos = module.ajuste_pendentes()
+    return (module.incentivos_pedidos(todos_pedidos),
+            module.incentivos_recibo(),
+            module.incentivos_picking(todos_pedidos))
+
+def run_engine(module, rules, orders, recibos, excluded_orders, excluded_recibos):
+    from sla_engine import incentivos_sla
+    return incentivos_sla(orders, recibos, rules, module.CONFIG['BR']['holidays'], excluded_orders, excluded_recibos)
+
+def timed(function, *args):
+    started = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - started
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the vectorized SLA engine against the legacy functions")
+    parser.add_argument('--sizes', nargs='+', type=int, default=[10000, 100000, 1000000])
+    parser.add_argument('--warehouses', nargs='+', choices=list(WAREHOUSES), default=list(WAREHOUSES))
+    parser.add_argument('--legacy-max', type=int, default=1000000, help="largest size the legacy functions are run at")
+    parser.add_argument('--start', help="first pending_at/arrived_at date, YYYY-MM-DD (default: a few days before this month)")
+    args = parser.parse_args()
+
+    start = datetime.strptime(args.start, '%Y-%m-%d') if args.start else None
+    import sla_engine
+
+    mismatches = 0
+    print(f"{'wh':<8} {'orders':>9} {'legacy s':>9} {'engine s':>9} {'speedup':>8}  match")
+    for size in args.sizes:
+        orders = generate_orders(size, start=start, seed=size)
+        recibos = generate_recibos(max(size // 100, 10), start=start, seed=size)
+        excluded_orders = frozenset(row['order_number'] for row in orders[::97])
+        excluded_recibos = frozenset(str(row['id']) for row in recibos[::13])
+        for warehouse in args.warehouses:
+            module_name, rules_name = WAREHOUSES[warehouse]
+            module = importlib.import_module(module_name)
+            rules = getattr(sla_engine, rules_name)
+
+            engine, engine_time = timed(run_engine, module, rules, orders, recibos, excluded_orders, excluded_recibos)
+            if size > args.legacy_max:
+                print(f"{warehouse:<8} {size:>9} {'-':>9} {engine_time:>9.2f} {'-':>8}  -")
+                continue
+            legacy, legacy_time = timed(run_legacy, module, orders, recibos, excluded_orders, excluded_recibos)
+            match = tuple(map(tuple, legacy)) == tuple(map(tuple, engine))
+            print(f"{warehouse:<8} {size:>9} {legacy_time:>9.2f} {engine_time:>9.2f} {legacy_time / engine_time:>7.1f}x  {'yes' if match else 'NO'}")
+            if not match:
+                mismatches += 1
+                for name, old, new in zip(('pedidos', 'recibos', 'picking'), legacy, engine):
+                    if tuple(old) != tuple(new):
+                        print(f"    {name}: legacy {old}")
+                        print(f"    {name}: engine {new}")
+    sys.exit(1 if mismatches else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+"""
+Local stand-in for the Metabase API, serving recorded or synthetic card rows.
+
+Implements POST /api/session and POST /api/card/<id>/query/{json,csv}.
+Rows come from benchmarks/fixtures/card_<id>.json (see record_fixtures.py);
+cards with no fixture but a generator in synthetic.py get generated rows.
+Card parameters are ignored: every query of a card returns the same rows.
+Card bodies are gzipped for clients that accept it, like Metabase behind its proxy.
+
+    python benchmarks/metabase_standin.py --port 3001 --scale 10 --latency 0.2
+    METABASE_ENDPOINT=http://127.0.0.1:3001 python incentivosEmbu.py
+"""
+import io
+import os
+import re
+import csv
+import gzip
+import json
+import time
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from synthetic import fixture_path, load_fixture, scale_rows, GENERATORS
+
+SESSION_TOKEN = "standin-session"
+CARD_PATH = re.compile(r'^/api/card/(\d+)/query/(json|csv)$')
+
+class StandinData:
+    """Card rows encoded once per format and kept in memory."""
+
+    def __init__(self, scale=1, synthetic_rows=5000):
+        self.scale = scale
+        self.synthetic_rows = synthetic_rows
+        self._bodies = {}
+        self._lock = threading.Lock()
+
+    def _load_rows(self, card):
+        if os.path.exists(fixture_path(card, self.scale)):
+            return load_fixture(card, self.scale)  # pre-scaled by synthetic.py
+        if os.path.exists(fixture_path(card)):
+            rows = load_fixture(card)
+        elif card in GENERATORS:
+            rows = GENERATORS[card](self.synthetic_rows)
+        else:
+            return None
+        return scale_rows(rows, self.scale)
+
+    def body(self, card, export_format):
+        with self._lock:
+            if (card, export_format) not in self._bodies:
+                rows = self._load_rows(card)
+                if rows is None:
+                    return None
+                self._bodies[(card, 'json')] = json.dumps(rows, ensure_ascii=False).encode('utf-8')
+                self._bodies[(card, 'csv')] = rows_to_csv(rows).encode('utf-8')
+                print(f"Card {card}: {len(rows)} rows loaded")
+            return self._bodies[(card, export_format)]
+
+    def gzipped_body(self, card, export_format):
+        body = self.body(card, export_format)
+        if body is None:
+            return None
+        with self._lock:
+            if (card, export_format, 'gzip') not in self._bodies:
+                self._bodies[(card, export_format, 'gzip')] = gzip.compress(body, 6)
+            return self._bodies[(card, export_format, 'gzip')]
+
+def rows_to_csv(rows):
+    columns = list(dict.fromkeys(column for row in rows for column in row))
+    out = io.StringIO()
+    writer = csv.DictWriter(out, fieldnames=columns)
+    writer.writeheader()
+    for row in rows:
+        writer.writerow({column: '' if value is None else value for column, value in row.items()})
+    return out.getvalue()
+
+def make_handler(data, latency, compress=True):
+
+    class StandinHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'  # keep-alive, like the real server
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send(self, status, body, content_type='application/json', content_encoding=None):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            if content_encoding:
+                self.send_header('Content-Encoding', content_encoding)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+            if self.path == '/api/session':
+                self._send(200, json.dumps({'id': SESSION_TOKEN}).encode('utf-8'))
+                return
+
+            match = CARD_PATH.match(self.path)
+            if not match:
+                self._send(404, b'"Not found."')
+                return
+            if self.headers.get('X-Metabase-Session') != SESSION_TOKEN:
+                self._send(401, b'"Unauthenticated"')
+                return
+
+            if latency:
+                time.sleep(latency)
+            card, export_format = match.groups()
+            gzipped = compress and 'gzip' in self.headers.get('Accept-Encoding', '')
+            body = data.gzipped_body(card, export_format) if gzipped else data.body(card, export_format)
+            content_type = 'text/csv; charset=utf-8' if export_format == 'csv' else 'application/json'
+            if body is None:
+                self._send(404, f'"No fixture for card {card}"'.encode('utf-8'))
+            else:
+                self._send(200, body, content_type, 'gzip' if gzipped else None)
+
+    return StandinHandler
+
+def start_standin(port=0, scale=1, latency=0, synthetic_rows=5000, compress=True):
+    """Start the stand-in on a background thread; returns the server (port 0 picks a free one)."""
+    server = ThreadingHTTPServer(('127.0.0.1', port), make_handler(StandinData(scale, synthetic_rows), latency, compress))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve recorded Metabase card fixtures locally")
+    parser.add_argument('--port', type=int, default=3001)
+    parser.add_argument('--scale', type=int, default=1, help="serve every card at this multiple of its fixture")
+    parser.add_argument('--latency', type=float, default=0, help="seconds added before each card response")
+    parser.add_argument('--synthetic-rows', type=int, default=5000, help="rows generated for cards with no fixture")
+    parser.add_argument('--no-gzip', action='store_true', help="always send bodies uncompressed")
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(('127.0.0.1', args.port),
+                                 make_handler(StandinData(args.scale, args.synthetic_rows), args.latency, not args.no_gzip))
+    print(f"Metabase stand-in on http://127.0.0.1:{args.port} (scale {args.scale}x, latency {args.latency}s)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
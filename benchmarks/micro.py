@@ -0,0 +1,207 @@
+"""
+Micro-benchmarks of the per-row helpers, offline and reproducible.
+
+Inputs are generated from a fixed seed at every --sizes; each case runs
+--repeat times and the best time is kept. Results go to a JSON file named
+after the current commit, so two commits can be compared:
+
+    python benchmarks/micro.py
+    python benchmarks/micro.py --sizes 1000 100000 --only parse_date parse_UF
+    python benchmarks/micro.py --compare benchmarks/results/micro_<old commit>.json
+
+Nothing is contacted: Redis clients are created lazily, so placeholder
+REDIS_* values are enough to import the modules. report_ops and
+SLAporDiaPOA read Google credentials from Redis at import, so their
+adjust_shipping_date is compiled from the source file instead.
+"""
+import os
+import sys
+import ast
+import gc
+import json
+import time
+import random
+import argparse
+import platform
+import subprocess
+from datetime import datetime, timedelta
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+os.chdir(BASE_DIR)
+
+for name, value in {'REDIS_END': '127.0.0.1', 'REDIS_PORT': '6379', 'REDIS_PASSWORD': '',
+                    'DATE_FORMAT': '%Y-%m-%dT%H:%M:%S', 'DATE_FORMAT2': '%Y-%m-%dT%H:%M:%S.%f'}.items():
+    os.environ.setdefault(name, value)
+
+from synthetic import CARRIERS, STORES, _timestamp
+
+RESULTS_DIR = os.path.join(BASE_DIR, 'benchmarks', 'results')
+BASE_DATE = datetime(2024, 10, 20)
+SHIPPING_MODULES = ['incentivosEmbu', 'incentivosExtrema', 'incentivosPOA', 'SLAporDia', 'report_ops', 'SLAporDiaPOA']
+# Imported from their source, see the module docstring
+SOURCE_ONLY_MODULES = {'report_ops', 'SLAporDiaPOA'}
+
+def _moment(rng):
+    return BASE_DATE + timedelta(seconds=rng.uniform(0, 60 * 86400), microseconds=rng.randrange(10**6))
+
+# Inputs: each returns the list of argument tuples of size calls
+
+def timestamp_inputs(size, rng):
+    shapes = [
+        lambda moment: _timestamp(moment),
+        lambda moment: moment.strftime('%Y-%m-%dT%H:%M:%S'),
+        lambda moment: moment.strftime('%Y-%m-%dT%H:%M:%S.%f') + 'Z',
+        lambda moment: moment.strftime('%Y-%m-%d'),
+    ]
+    return [(rng.choices(shapes, [70, 15, 10, 5])[0](_moment(rng)),) for _ in range(size)]
+
+def zip_code_inputs(size, rng):
+    return [(f"{rng.randint(1000000, 99999999):08d}" if rng.random() < 0.8
+             else f"{rng.randint(1000, 99999):05d}-{rng.randint(0, 999):03d}",) for _ in range(size)]
+
+def shipping_inputs(size, rng):
+    return [(_moment(rng), rng.choice(CARRIERS + ['JT Express', 'TREGGO', 'UELLO'])) for _ in range(size)]
+
+def process_data_inputs(size, rng):
+    return [({'pending_at_start_date': _moment(rng), 'wh': rng.choice([4, 166, 232]),
+              'cliente': rng.choice(STORES), 'shipping_status': None},) for _ in range(size)]
+
+def _movement(rng, index):
+    previous = rng.randint(0, 50)
+    return {'executed_at': _moment(rng).replace(microsecond=0), 'produto': f"SKU{index:07d}",
+            'loja': rng.choice(STORES), 'previous_stock_quantity': previous,
+            'new_stock_quantity': previous + rng.choice([-2, -1, 1, 2])}
+
+def lf_inputs(size, rng):
+    """One compare_data call over size movements: 90% already seen (stored as strings), 10% new."""
+    new_data = [_movement(rng, index) for index in range(size)]
+    old_data = [dict(item, executed_at=item['executed_at'].strftime('%Y-%m-%dT%H:%M:%S'))
+                for item in new_data if rng.random() < 0.9]
+    return [(old_data, new_data)]
+
+def store_status_inputs(size, rng):
+    """One compare_data call over size stores, 5% changed and 1% new."""
+    statuses = ['CUSTOMER_ACCOUNT', 'PROSPECT_ACCOUNT', 'TEST_ACCOUNT']
+    old_data = [{'loja': f"Loja {index}", 'status': rng.choice(statuses)} for index in range(size)]
+    new_data = [dict(item, status=rng.choice(statuses)) if rng.random() < 0.05 else item for item in old_data]
+    new_data += [{'loja': f"Nova {index}", 'status': 'PROSPECT_ACCOUNT'} for index in range(size // 100)]
+    return [(old_data, new_data)]
+
+def tote_inputs(size, rng):
+    return [(f"TOTE{rng.randint(0, 10**6):06d}", f"TOTE{rng.randint(0, 10**6):06d}") for _ in range(size)]
+
+# Functions
+
+def _source_function(module_name, function_name, namespace):
+    """Compile one top-level function of a module's source into namespace, without importing the module."""
+    with open(os.path.join(BASE_DIR, f"{module_name}.py"), 'r', encoding='utf-8') as f:
+        tree = ast.parse(f.read())
+    node = next(node for node in tree.body if isinstance(node, ast.FunctionDef) and node.name == function_name)
+    exec(compile(ast.Module(body=[node], type_ignores=[]), f"{module_name}.py", 'exec'), namespace)
+    return namespace[function_name]
+
+def shipping_function(module_name):
+    if module_name in SOURCE_ONLY_MODULES:
+        import business_calendar
+        return _source_function(module_name, 'adjust_shipping_date', vars(business_calendar).copy())
+    return getattr(__import__(module_name), 'adjust_shipping_date')
+
+def _parse_date_cold():
+    import parseDT
+    parseDT._parse_string.cache_clear()
+
+def cases():
+    """name -> (function loader, input generator, setup run before every repeat)."""
+    result = {
+        'parse_date': (lambda: __import__('parseDT').parse_date, timestamp_inputs, _parse_date_cold),
+        'parse_UF': (lambda: __import__('parseUF').parse_UF, zip_code_inputs, None),
+        'process_data': (lambda: __import__('metabase').process_data, process_data_inputs, None),
+        'LFbot.compare_data': (lambda: __import__('LFbot').compare_data, lf_inputs, None),
+        'loja_abre_fecha.compare_data': (lambda: __import__('loja_abre_fecha').compare_data, store_status_inputs, None),
+        'generate_tote_pair_zpl': (lambda: __import__('toteLivre').generate_tote_pair_zpl, tote_inputs, None),
+    }
+    for module_name in SHIPPING_MODULES:
+        result[f"{module_name}.adjust_shipping_date"] = (
+            lambda module_name=module_name: shipping_function(module_name), shipping_inputs, None)
+        if module_name not in SOURCE_ONLY_MODULES:
+            result[f"{module_name}.adjust_receiving_date"] = (
+                lambda module_name=module_name: getattr(__import__(module_name), 'adjust_receiving_date'),
+                timestamp_inputs, _parse_date_cold)
+    return result
+
+def run_case(function, inputs, setup, repeat):
+    best = None
+    for _ in range(repeat):
+        if setup:
+            setup()
+        gc.collect()
+        started = time.perf_counter()
+        for args in inputs:
+            function(*args)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def current_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BASE_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def compare(results, baseline_path):
+    with open(baseline_path, 'r') as f:
+        baseline = json.load(f)
+    previous = {(row['case'], row['size']): row['seconds'] for row in baseline['results']}
+    print(f"\nvs {baseline['commit']} ({baseline_path}):")
+    for row in results:
+        old = previous.get((row['case'], row['size']))
+        if old:
+            print(f"  {row['case']:<40} {row['size']:>8} {old / row['seconds']:>7.2f}x")
+
+def main():
+    all_cases = cases()
+    parser = argparse.ArgumentParser(description="Micro-benchmarks of the per-row helper functions")
+    parser.add_argument('--sizes', nargs='+', type=int, default=[1000, 10000, 100000])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--only', nargs='+', metavar='CASE', help=f"substring of the cases to run: {', '.join(all_cases)}")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="JSON file (default: benchmarks/results/micro_<commit>.json)")
+    parser.add_argument('--compare', metavar='JSON', help="results of another commit to print speedups against")
+    args = parser.parse_args()
+
+    commit = current_commit()
+    selected = {name: case for name, case in all_cases.items()
+                if not args.only or any(part in name for part in args.only)}
+
+    results = []
+    print(f"{'case':<40} {'size':>8} {'best s':>9} {'per item us':>12}")
+    for name, (load, generate, setup) in selected.items():
+        function = load()
+        for size in args.sizes:
+            inputs = generate(size, random.Random(f"{args.seed}:{name}:{size}"))
+            seconds = run_case(function, inputs, setup, args.repeat)
+            results.append({'case': name, 'size': size, 'calls': len(inputs), 'seconds': seconds,
+                            'per_item_us': seconds / size * 1e6})
+            print(f"{name:<40} {size:>8} {seconds:>9.4f} {seconds / size * 1e6:>12.3f}")
+
+    output = args.output or os.path.join(RESULTS_DIR, f"micro_{commit}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump({
+            'commit': commit,
+            'created_at': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'seed': args.seed,
+            'repeat': args.repeat,
+            'results': results,
+        }, f, indent=2)
+    print(f"Results saved to {output}")
+
+    if args.compare:
+        compare(results, args.compare)
+
+if __name__ == "__main__":
+    main()
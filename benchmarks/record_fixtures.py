@@ -0,0 +1,64 @@
+"""
+Record live Metabase card responses into benchmarks/fixtures/ for the stand-in.
+
+Each card is queried with the same kind of parameters the app sends, so the
+fixtures have realistic volume. Needs the usual METABASE_* and REDIS_* settings.
+Fixtures hold real order data: keep them out of git.
+
+    python benchmarks/record_fixtures.py
+    python benchmarks/record_fixtures.py --cards 1496 1485 --bin A-01-01-01
+"""
+import os
+import sys
+import argparse
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from metabase import get_dataset, process_data
+from synthetic import fixture_path, save_fixture
+
+RECORDED_CARDS = ['1496', '1485', '3477', '3379', '3509', '3920', '2954', '6512', '8201', '9845', '11808', '11926']
+
+def card_params(card, bin=None):
+    """Parameters like the ones the app sends for this card, or None to skip it."""
+    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    month_start = today.replace(day=1)
+    last_day_previous_month = month_start - timedelta(days=1)
+
+    if card == '1496':
+        return process_data({'pending_at_start_date': last_day_previous_month, 'wh': 4})
+    if card == '1485':
+        return process_data({'arrived_at': last_day_previous_month, 'wh': 4})
+    if card == '3379':
+        return process_data({'pending_at_start_date': last_day_previous_month, 'wh': 4})
+    if card == '3477':
+        return process_data({'data_inicial': (today - timedelta(days=30)).strftime('%Y-%m-%d'),
+                             'data_final': today.strftime('%Y-%m-%d')})
+    if card == '6512':
+        return process_data({'pending_at_start_date': today, 'pending_at_end_date': today + timedelta(days=1), 'wh': 4})
+    if card == '8201':
+        return process_data({'pending_at_start_date': today, 'pending_at_end_date': today + timedelta(days=1), 'wh': 232})
+    if card == '9845':
+        return process_data({'bin': bin}) if bin else None
+    if card == '11808':
+        return process_data({'data': (today - timedelta(days=7)).strftime('%Y-%m-%d')})
+    return {}
+
+def main():
+    parser = argparse.ArgumentParser(description="Record Metabase card fixtures")
+    parser.add_argument('--cards', nargs='+', default=RECORDED_CARDS)
+    parser.add_argument('--bin', help="bin location used for card 9845")
+    args = parser.parse_args()
+
+    for card in args.cards:
+        params = card_params(card, args.bin)
+        if params is None:
+            print(f"Skipping card {card}: pass --bin to record it")
+            continue
+        rows = get_dataset(card, params, refresh=True)
+        save_fixture(fixture_path(card), rows)
+        print(f"Recorded {len(rows)} rows for card {card}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""
+Time incentivosEmbu.main, bonus.compute_phd and atrasos.update_transportadora_data
+end to end against the local Metabase stand-in.
+
+Starts the stand-in in-process and points METABASE_ENDPOINT at it before the
+app modules are imported. The jobs still read and write Redis, so REDIS_* must
+point at a local or dev instance; the Metabase card cache there is cleared
+before every run so each one really downloads the cards.
+
+    python benchmarks/run_jobs.py --scale 10 --repeat 3
+    python benchmarks/run_jobs.py --jobs bonus --scale 100 --latency 0.5
+"""
+import os
+import sys
+import time
+import argparse
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+from metabase_standin import start_standin
+
+def clear_card_cache():
+    from redis_connection import get_redis_binary_connection
+    from metabase_cache import CACHE_KEY_PREFIX
+    r = get_redis_binary_connection()
+    for key in r.scan_iter(f"{CACHE_KEY_PREFIX}:*", count=1000):
+        r.delete(key)
+
+def run_embu():
+    from incentivosEmbu import main
+    main()
+
+def run_bonus():
+    from bonus import compute_phd
+    compute_phd()
+
+def run_atrasos():
+    from atrasos import update_transportadora_data
+    update_transportadora_data()
+
+JOBS = {
+    'embu': run_embu,
+    'bonus': run_bonus,
+    'atrasos': run_atrasos,
+}
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark jobs against the Metabase stand-in")
+    parser.add_argument('--jobs', nargs='+', choices=list(JOBS), default=list(JOBS))
+    parser.add_argument('--scale', type=int, default=1)
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--synthetic-rows', type=int, default=5000)
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--no-gzip', action='store_true', help="stand-in sends bodies uncompressed")
+    args = parser.parse_args()
+
+    server = start_standin(scale=args.scale, latency=args.latency, synthetic_rows=args.synthetic_rows,
+                           compress=not args.no_gzip)
+    os.environ['METABASE_ENDPOINT'] = f"http://127.0.0.1:{server.server_address[1]}"
+    # The jobs read json/config.json and friends relative to the repo root
+    os.chdir(BASE_DIR)
+
+    results = {}
+    for name in args.jobs:
+        timings = []
+        for _ in range(args.repeat):
+            clear_card_cache()
+            start = time.perf_counter()
+            JOBS[name]()
+            timings.append(time.perf_counter() - start)
+        results[name] = timings
+
+    print()
+    print(f"Scale {args.scale}x, latency {args.latency}s")
+    for name, timings in results.items():
+        print(f"{name:10s} best {min(timings):8.3f}s  mean {sum(timings) / len(timings):8.3f}s  ({len(timings)} runs)")
+
+    server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+"""
+Synthetic Metabase card rows for offline benchmarks.
+
+scale_rows multiplies a recorded fixture to 10x-100x its volume; the
+generate_* functions build rows from scratch, in the shape of the real cards,
+for when nothing has been recorded yet.
+
+    python benchmarks/synthetic.py --card 1496 --scale 10
+    python benchmarks/synthetic.py --card 3477 --rows 200000
+"""
+import os
+import sys
+import json
+import random
+import argparse
+from datetime import datetime, timedelta
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+# Columns that identify a row; copies get a suffix so they stay unique
+ID_COLUMNS = ('order_number', 'id', 'unique_code', 'Totes__unique_code', 'rastreio')
+
+CARRIERS = ['CORREIOS', 'Mercado Envíos', 'LOGGI', 'IMILE', 'CUBBO', 'Armazém', 'Externo', 'JADLOG']
+STORES = ['FOSFORO', 'Dois Pontos', 'Boitempo', 'Qura Editora', 'TAG Livros', 'ABOVE AVERAGE',
+          'Natura', 'Loja Azul', 'Casa Verde', 'Mundo Pet', 'Bella Moda', 'Tech Store']
+
+def fixture_path(card, scale=1):
+    name = f"card_{card}.json" if scale == 1 else f"card_{card}_x{scale}.json"
+    return os.path.join(FIXTURES_DIR, name)
+
+def load_fixture(card, scale=1):
+    with open(fixture_path(card, scale), 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def save_fixture(path, rows):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(rows, f, ensure_ascii=False)
+
+def scale_rows(rows, factor):
+    """Repeat rows factor times, suffixing the id columns of every copy after the first."""
+    scaled = list(rows)
+    for copy_index in range(1, factor):
+        for row in rows:
+            row = dict(row)
+            for column in ID_COLUMNS:
+                if row.get(column) not in (None, ''):
+                    row[column] = f"{row[column]}-{copy_index}"
+            scaled.append(row)
+    return scaled
+
+def _timestamp(value):
+    # Same shape as Metabase's JSON export (local time with offset)
+    return value.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + '-03:00'
+
+def _month_start():
+    return datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0) - timedelta(days=3)
+
+def generate_orders(n, start=None, seed=0):
+    """Order rows as returned by cards 1496, 3379, 6512 and 8201."""
+    rng = random.Random(seed)
+    start = start or _month_start()
+    span = max((datetime.now() - start).total_seconds(), 3600)
+    rows = []
+    for i in range(n):
+        pending_at = start + timedelta(seconds=rng.uniform(0, span))
+        shipped = rng.random() < 0.9
+        shipping_date = pending_at + timedelta(hours=rng.expovariate(1 / 20)) if shipped else None
+        picking_complete = pending_at + timedelta(hours=rng.uniform(0.5, 8)) if shipped else None
+        rows.append({
+            'order_number': f"SYN{i:08d}",
+            'status': rng.choices(['shipped', 'pending', 'canceled', 'holded'], [90, 7, 2, 1])[0],
+            'pending_at': _timestamp(pending_at),
+            'shipping_date': _timestamp(shipping_date) if shipping_date else None,
+            'picking_complete': _timestamp(picking_complete) if picking_complete else None,
+            'carrier_name': rng.choice(CARRIERS),
+            'Stores__name': rng.choice(STORES),
+            'Totes__unique_code': f"tote{rng.randint(1, 99999):05d}",
+            'account_type': rng.choices(['CUSTOMER_ACCOUNT', 'TEST_ACCOUNT'], [95, 5])[0],
+        })
+    return rows
+
+def generate_recibos(n, start=None, seed=0):
+    """Receipt rows as returned by card 1485."""
+    rng = random.Random(seed)
+    start = start or _month_start()
+    span = max((datetime.now() - start).total_seconds(), 3600)
+    rows = []
+    for i in range(n):
+        arrived_at = start + timedelta(seconds=rng.uniform(0, span))
+        completed = rng.random() < 0.85
+        completed_at = arrived_at + timedelta(hours=rng.uniform(2, 60)) if completed else None
+        rows.append({
+            'id': 500000 + i,
+            'status': 'completed' if completed else 'arrived',
+            'Stores__name': rng.choice(STORES),
+            'arrived_at': _timestamp(arrived_at),
+            'completed_at': _timestamp(completed_at) if completed_at else None,
+            'dock_to_stock_in_days': round((completed_at - arrived_at).total_seconds() / 86400, 2) if completed_at else None,
+        })
+    return rows
+
+def generate_atrasos(n, start=None, seed=0):
+    """Delivery rows as returned by card 3477."""
+    rng = random.Random(seed)
+    start = start or datetime.now() - timedelta(days=30)
+    span = max((datetime.now() - start).total_seconds(), 3600)
+    rows = []
+    for i in range(n):
+        processado = start + timedelta(seconds=rng.uniform(0, span))
+        eta = processado + timedelta(days=rng.randint(2, 10))
+        delivered = rng.random() < 0.8
+        delivered_at = eta + timedelta(days=rng.randint(-3, 4)) if delivered else None
+        first_attempt = delivered_at - timedelta(days=rng.choice([0, 0, 0, 1])) if delivered else None
+        rows.append({
+            'order_number': f"SYN{i:08d}",
+            'store_name': rng.choice(STORES),
+            'rastreio': f"BR{rng.randint(0, 10**9):09d}",
+            'carrier_name': rng.choice(CARRIERS),
+            'shipping_zip_code': f"{rng.randint(1000000, 99999999):08d}",
+            'shipping_status': 'delivered' if delivered else 'in_transit',
+            'processado': _timestamp(processado),
+            'estimated_time_arrival': _timestamp(eta) if rng.random() < 0.97 else None,
+            'delivered_at': _timestamp(delivered_at) if delivered_at else None,
+            'first_delivery_attempt_at': _timestamp(first_attempt) if first_attempt else None,
+        })
+    return rows
+
+GENERATORS = {
+    '1496': generate_orders,
+    '3379': generate_orders,
+    '6512': generate_orders,
+    '8201': generate_orders,
+    '1485': generate_recibos,
+    '3477': generate_atrasos,
+}
+
+def main():
+    parser = argparse.ArgumentParser(description="Write scaled or generated fixtures for benchmarks/metabase_standin.py")
+    parser.add_argument('--card', required=True)
+    parser.add_argument('--scale', type=int, default=10, help="multiply the recorded fixture by this factor")
+    parser.add_argument('--rows', type=int, help="generate this many rows from scratch instead of scaling")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.rows:
+        if args.card not in GENERATORS:
+            sys.exit(f"No generator for card {args.card}; record it with benchmarks/record_fixtures.py")
+        rows = GENERATORS[args.card](args.rows, seed=args.seed)
+        path = fixture_path(args.card)
+    else:
+        rows = scale_rows(load_fixture(args.card), args.scale)
+        path = fixture_path(args.card, args.scale)
+
+    save_fixture(path, rows)
+    print(f"Wrote {len(rows)} rows to {path}")
+
+if __name__ == "__main__":
+    main()
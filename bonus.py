@@ -7,7 +7,7 @@ from dotenv import dotenv_values
 import os
 import calendar
 from redis_connection import get_redis_connection
-from metabase import get_dataset, process_data
+from metabase import iter_dataset, process_data
 from parseDT import parse_date
 
 env_config = dotenv_values(".env")
@@ -50,9 +50,7 @@ def dt_processado():
         }
     )
 
-    orders_list = get_dataset('3379', incentivo_inputs)
-
-    for order in orders_list:
+    for order in iter_dataset('3379', incentivo_inputs, columns=['order_number', 'shipping_date', 'account_type']):
         if order['shipping_date'] is not None and order['shipping_date'] != "":
             order['shipping_date'] = parse_date(order['shipping_date'])
 
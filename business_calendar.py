@@ -0,0 +1,213 @@
+import os
+import json
+from datetime import date, timedelta
+from functools import lru_cache
+import numpy as np
+
+# Business days (Monday to Friday, minus the json/config.json holidays) for the
+# SLA, bonus and report modules. Every day of a multi-year window is classified
+# once: next business day, business day on or before, business-day index. Scalar
+# queries are a list lookup by ordinal, array queries one fancy-index; dates
+# outside the window fall back to np.busday_* so the answers stay correct.
+# Dates and datetimes are both accepted; datetimes keep their time of day when moved.
+
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "json/config.json")
+
+# Years classified around the holidays and the current year
+YEARS_BEFORE = 2
+YEARS_AFTER = 5
+
+# date.toordinal() of 1970-01-01, where datetime64[D] counts from
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+def load_holidays(path=CONFIG_PATH):
+    with open(path, "r") as f:
+        return json.load(f)['BR']['holidays']
+
+def _to_day(value):
+    return np.datetime64(value.toordinal() - EPOCH_ORDINAL, 'D')
+
+def _shift(value, ordinal):
+    """value moved to the day with the given ordinal, keeping its type and time of day."""
+    return value + timedelta(days=ordinal - value.toordinal())
+
+def _days(values):
+    return np.asarray(values).astype('datetime64[D]')
+
+class BusinessCalendar:
+    def __init__(self, holidays, first_year=None, last_year=None):
+        self.holidays = tuple(sorted(set(holidays)))
+        self._holiday_days = np.array(self.holidays, dtype='datetime64[D]')
+        self._holiday_set = frozenset(date.fromisoformat(day) for day in self.holidays)
+        years = [int(day[:4]) for day in self.holidays] + [date.today().year]
+        first_year = first_year or min(years) - YEARS_BEFORE
+        last_year = last_year or max(years) + YEARS_AFTER
+
+        self.first_day = np.datetime64(f"{first_year}-01-01", 'D')
+        days = np.arange(self.first_day, np.datetime64(f"{last_year + 1}-01-01", 'D'))
+        self._first_ordinal = date(first_year, 1, 1).toordinal()
+
+        self._busday = np.is_busday(days, holidays=self._holiday_days)
+        self._next = self._offset(days + np.timedelta64(1, 'D'), 'forward')
+        self._forward = self._offset(days, 'forward')
+        self._backward = self._offset(days, 'backward')
+        self._index = np.cumsum(self._busday) - 1
+        # Plain lists of ordinals for the scalar lookups, indexing them is cheaper than indexing arrays
+        self._busday_list = self._busday.tolist()
+        self._next_list = self._ordinals(self._next)
+        self._forward_list = self._ordinals(self._forward)
+        self._backward_list = self._ordinals(self._backward)
+        self._index_list = self._index.tolist()
+
+    def _offset(self, days, roll):
+        return np.busday_offset(days, 0, roll=roll, holidays=self._holiday_days)
+
+    @staticmethod
+    def _ordinals(days):
+        return (days.astype(np.int64) + EPOCH_ORDINAL).tolist()
+
+    def _position(self, value):
+        """Row of value in the tables, or None outside the window."""
+        position = value.toordinal() - self._first_ordinal
+        return position if 0 <= position < len(self._busday_list) else None
+
+    def _positions(self, days):
+        """Rows of the days in the tables and the mask of the ones inside the window."""
+        positions = (days - self.first_day).astype(np.int64)
+        inside = ~np.isnat(days) & (positions >= 0) & (positions < len(self._busday))
+        return positions, inside
+
+    def _fallback(self, value, days_ahead, roll):
+        day = self._offset(_to_day(value) + np.timedelta64(days_ahead, 'D'), roll)
+        return int(day.astype(np.int64)) + EPOCH_ORDINAL
+
+    # Scalars
+
+    def is_holiday(self, value):
+        return (value.date() if hasattr(value, 'hour') else value) in self._holiday_set
+
+    def is_business_day(self, value):
+        position = self._position(value)
+        if position is None:
+            return bool(np.is_busday(_to_day(value), holidays=self._holiday_days))
+        return self._busday_list[position]
+
+    def next_business_day(self, value):
+        """First business day after value."""
+        position = self._position(value)
+        return _shift(value, self._next_list[position] if position is not None else self._fallback(value, 1, 'forward'))
+
+    def roll_forward(self, value):
+        """value if it is a business day, else the next one."""
+        position = self._position(value)
+        return _shift(value, self._forward_list[position] if position is not None else self._fallback(value, 0, 'forward'))
+
+    def roll_backward(self, value):
+        """value if it is a business day, else the previous one."""
+        position = self._position(value)
+        return _shift(value, self._backward_list[position] if position is not None else self._fallback(value, 0, 'backward'))
+
+    def business_day_index(self, value):
+        """Business days from the start of the window up to value, minus one; differences give business-day spans."""
+        position = self._position(value)
+        if position is None:
+            end = _to_day(value) + np.timedelta64(1, 'D')
+            return int(np.busday_count(self.first_day, end, holidays=self._holiday_days)) - 1
+        return self._index_list[position]
+
+    def business_days_between(self, start, end):
+        """Business days after start up to and including end."""
+        return self.business_day_index(end) - self.business_day_index(start)
+
+    def roll_past_cutoff(self, timestamp, cutoff):
+        """
+        adjust_shipping_date: at or after the (hour, minute) cutoff, on a weekend
+        or on a holiday, the timestamp moves to the next business day, same time.
+        """
+        if (timestamp.hour, timestamp.minute) >= cutoff or not self.is_business_day(timestamp):
+            return self.next_business_day(timestamp)
+        return timestamp
+
+    # Arrays (datetime64 of any unit; NaT stays NaT)
+
+    def _table_days(self, table, values, days_ahead, roll):
+        days = _days(values)
+        positions, inside = self._positions(days)
+        result = np.full(days.shape, 'NaT', dtype='datetime64[D]')
+        result[inside] = table[positions[inside]]
+        outside = ~inside & ~np.isnat(days)
+        if outside.any():
+            result[outside] = self._offset(days[outside] + np.timedelta64(days_ahead, 'D'), roll)
+        return result
+
+    @staticmethod
+    def _moved(values, new_days):
+        values = np.asarray(values)
+        return values + (new_days - _days(values))
+
+    def is_business_day_array(self, values):
+        days = _days(values)
+        positions, inside = self._positions(days)
+        result = np.zeros(days.shape, dtype=bool)
+        result[inside] = self._busday[positions[inside]]
+        outside = ~inside & ~np.isnat(days)
+        if outside.any():
+            result[outside] = np.is_busday(days[outside], holidays=self._holiday_days)
+        return result
+
+    def next_business_day_array(self, values):
+        return self._moved(values, self._table_days(self._next, values, 1, 'forward'))
+
+    def roll_forward_array(self, values):
+        return self._moved(values, self._table_days(self._forward, values, 0, 'forward'))
+
+    def roll_backward_array(self, values):
+        return self._moved(values, self._table_days(self._backward, values, 0, 'backward'))
+
+    def business_day_index_array(self, values):
+        """business_day_index per value, -1 for NaT."""
+        days = _days(values)
+        positions, inside = self._positions(days)
+        result = np.full(days.shape, -1, dtype=np.int64)
+        result[inside] = self._index[positions[inside]]
+        outside = ~inside & ~np.isnat(days)
+        if outside.any():
+            result[outside] = np.busday_count(self.first_day, days[outside] + np.timedelta64(1, 'D'),
+                                              holidays=self._holiday_days) - 1
+        return result
+
+    def roll_past_cutoff_array(self, timestamps, cutoff_minutes):
+        """Vectorized roll_past_cutoff; cutoff_minutes is the cutoff as minutes of the day, per row or one for all."""
+        timestamps = np.asarray(timestamps)
+        days = _days(timestamps)
+        minute_of_day = (timestamps - days).astype('timedelta64[m]').astype(np.int64)
+        roll = ~np.isnat(timestamps) & ((minute_of_day >= cutoff_minutes) | ~self.is_business_day_array(days))
+        result = timestamps.copy()
+        result[roll] = self.next_business_day_array(timestamps[roll])
+        return result
+
+@lru_cache(maxsize=8)
+def _calendar(holidays):
+    return BusinessCalendar(holidays)
+
+def calendar_for(holidays):
+    """Calendar of a holiday list, built once per distinct list."""
+    return _calendar(tuple(sorted(set(str(day) for day in holidays))))
+
+CALENDAR = calendar_for(load_holidays())
+HOLIDAYS = list(CALENDAR.holidays)
+
+is_holiday = CALENDAR.is_holiday
+is_business_day = CALENDAR.is_business_day
+next_business_day = CALENDAR.next_business_day
+roll_forward = CALENDAR.roll_forward
+roll_backward = CALENDAR.roll_backward
+business_day_index = CALENDAR.business_day_index
+business_days_between = CALENDAR.business_days_between
+roll_past_cutoff = CALENDAR.roll_past_cutoff
+is_business_day_array = CALENDAR.is_business_day_array
+next_business_day_array = CALENDAR.next_business_day_array
+roll_forward_array = CALENDAR.roll_forward_array
+roll_backward_array = CALENDAR.roll_backward_array
+business_day_index_array = CALENDAR.business_day_index_array
+roll_past_cutoff_array = CALENDAR.roll_past_cutoff_array
@@ -0,0 +1,95 @@
+import json
+import threading
+from redis_connection import get_redis_connection
+
+# Orders and receipts left out of the SLAs, kept as Redis sets. Every process
+# holds a frozenset copy and reloads it only when the version counter moves,
+# so a membership check is a set lookup and a job pays one GET per load.
+EXCLUSION_KINDS = {
+    'orders': "json/excluded_orders.json",
+    'recibos': "json/excluded_recibos.json",
+}
+EXCLUSIONS_KEY_PREFIX = "exclusions"
+VERSION_KEY = f"{EXCLUSIONS_KEY_PREFIX}:version"
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+def _set_key(kind):
+    if kind not in EXCLUSION_KINDS:
+        raise ValueError(f"Unknown exclusion kind: {kind}")
+    return f"{EXCLUSIONS_KEY_PREFIX}:{kind}"
+
+def _legacy_items(kind):
+    """Items of the JSON file the exclusions used to live in (a list, or {'excluded_<kind>': [...]})."""
+    try:
+        with open(EXCLUSION_KINDS[kind], "r") as file:
+            data = json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return []
+    if isinstance(data, dict):
+        data = data.get(f"excluded_{kind}", [])
+    return data if isinstance(data, list) else []
+
+def _seed_from_files(r):
+    """First use: copy what is in the old JSON files, once."""
+    if not r.set(VERSION_KEY, 0, nx=True):
+        return
+    for kind in EXCLUSION_KINDS:
+        items = [str(item) for item in _legacy_items(kind)]
+        if items:
+            r.sadd(_set_key(kind), *items)
+            print(f"Seeded {len(items)} excluded {kind} from {EXCLUSION_KINDS[kind]}")
+
+def load_exclusions(kind):
+    """frozenset of the excluded order numbers or receipt ids (as strings)."""
+    try:
+        r = get_redis_connection()
+        version = r.get(VERSION_KEY)
+        if version is None:
+            _seed_from_files(r)
+            version = r.get(VERSION_KEY)
+        with _cache_lock:
+            cached = _cache.get(kind)
+            if cached is not None and cached[0] == version:
+                return cached[1]
+        items = frozenset(r.smembers(_set_key(kind)))
+        with _cache_lock:
+            _cache[kind] = (version, items)
+        return items
+    except Exception as e:
+        print(f"Error loading excluded {kind} from Redis: {e}")
+        cached = _cache.get(kind)
+        return cached[1] if cached is not None else frozenset()
+
+def _change(kind, items, command):
+    items = [str(item).strip() for item in items if str(item).strip()]
+    if not items:
+        return 0
+    r = get_redis_connection()
+    pipe = r.pipeline()
+    getattr(pipe, command)(_set_key(kind), *items)
+    pipe.incr(VERSION_KEY)
+    return pipe.execute()[0]
+
+def add_exclusions(kind, items):
+    """Exclude the items; returns how many were not excluded yet."""
+    return _change(kind, items, 'sadd')
+
+def remove_exclusions(kind, items):
+    """Stop excluding the items; returns how many were excluded."""
+    return _change(kind, items, 'srem')
+
+def clear_exclusions():
+    """Drop every exclusion (month rollover)."""
+    r = get_redis_connection()
+    pipe = r.pipeline()
+    pipe.delete(*(_set_key(kind) for kind in EXCLUSION_KINDS))
+    pipe.incr(VERSION_KEY)
+    pipe.execute()
+
+def excluded_orders():
+    return load_exclusions('orders')
+
+def excluded_recibos():
+    return load_exclusions('recibos')
@@ -1,13 +1,22 @@
 import requests
 import json
 from datetime import datetime, timedelta, timezone
-import numpy as np
 import os
 from dotenv import dotenv_values
 from redis_connection import get_redis_connection
 from dateutil import parser
 from parseDT import parse_date
-from metabase import get_dataset, process_data
+from business_calendar import roll_past_cutoff, next_business_day, roll_backward
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from metabase import get_dataset, iter_dataset, process_data
+from job_timings import StageTimer
+from sla_history import record_run
+from sla_counters import month_rolled_over
+import exclusions
+from incremental_fetch import fetch_incremental, INCREMENTAL_FETCH
+from sla_pushdown import incentivos_pushdown, SLA_PUSHDOWN
+from sla_engine import incentivos_sla, EMBU, SLA_ENGINE
 
 env_config = dotenv_values(".env")
 
@@ -16,21 +25,6 @@ nova_hora = (hora_agora - timedelta(hours=3)).strftime("%H:%M")
 
 redis_client = get_redis_connection()
 
-class CONFIG:
-
-    FERIADOS_ACCOUNTS = []
-
-    def __init__(self):
-            self.JSON_CONFIG = self.get_configurations()
-            self.FERIADOS_ACCOUNTS = self.JSON_CONFIG["BR"]["holidays"]
-
-    def get_configurations(self):
-            with open("json/config.json", "r", ) as f:
-                config = json.load(f)
-            return config
-        
-config = CONFIG()
-
 def erase_json_files():
     # List of all JSON files to erase
     json_files = ["json/excluded_orders.json", "json/excluded_recibos.json", "json/sla_embu.json"]
@@ -39,47 +33,13 @@ def erase_json_files():
         with open(file_path, "w") as file:
             json.dump([], file)
     save_to_redis("sla_embu", "[]")
-    save_to_redis("excluded_orders", "[]")
-    save_to_redis("excluded_recibos", "[]")
+    exclusions.clear_exclusions()
     print("jsons apagados")
 
 def check_and_erase_json_files():
-    # Path to the file storing the last cleanup date
-    last_cleanup_file = "last_cleanup.txt"
-
-    # Get the current date
-    now = datetime.now()
-    current_month = now.month
-    current_year = now.year
-
-    # Check if the last_cleanup_file exists and is not empty
-    if os.path.exists(last_cleanup_file):
-        with open(last_cleanup_file, "r") as f:
-            last_cleanup_date = f.read().strip()
-        
-        try:
-            # Extract the last cleanup month and year
-            last_cleanup_month, last_cleanup_year = map(int, last_cleanup_date.split("-"))
-        except (ValueError, IndexError):
-            # If the file is empty or has invalid format, perform cleanup and write the current date
-            erase_json_files()
-            with open(last_cleanup_file, "w") as f:
-                f.write(f"{current_month}-{current_year}")
-            return
-
-        # Check if it is a new month
-        if (current_month != last_cleanup_month or current_year != last_cleanup_year):
-            erase_json_files()
-            # Update the last cleanup date
-            with open(last_cleanup_file, "w") as f:
-                f.write(f"{current_month}-{current_year}")
-
-    else:
-        # If file does not exist, perform cleanup and create the file
+    # The month is kept in Redis and shared with sla_pipeline, which clears every warehouse at once
+    if month_rolled_over():
         erase_json_files()
-        with open(last_cleanup_file, "w") as f:
-            f.write(f"{current_month}-{current_year}")
-
 
 def save_to_redis(key, data):
     try:
@@ -93,22 +53,15 @@ def save_to_redis(key, data):
 
 
 def load_excluded_orders():
-    try:
-        with open("json/excluded_orders.json", "r") as file:
-            return json.load(file)
-    except FileNotFoundError:
-        return []
+    # frozenset cached by the exclusions module, refreshed when the Redis set changes
+    return exclusions.excluded_orders()
 
 def save_excluded_orders(excluded_orders):
     with open("json/excluded_orders.json", "w") as file:
         json.dump(excluded_orders, file)
 
 def load_excluded_recibos():
-    try:
-        with open("json/excluded_recibos.json", "r") as file:
-            return json.load(file)
-    except FileNotFoundError:
-        return []
+    return exclusions.excluded_recibos()
 
 def save_excluded_recibos(excluded_recibos):
     with open("json/excluded_recibos.json", "w") as file:
@@ -137,33 +90,15 @@ def adjust_shipping_date(shipping_date, carrier):
         'JT Express': (17, 0)
     }
 
-    hour, minute = cut_off_hours.get(carrier, cut_off_hours['LOGGI'])
-
-    # Check if shipping date is after cut off time or is a holiday
-    if (shipping_date.hour > hour or 
-        (shipping_date.hour == hour and shipping_date.minute >= minute) or 
-        shipping_date.weekday() >= 5 or  # Check if it's Saturday or Sunday
-        shipping_date.strftime('%Y-%m-%d') in CONFIG['BR']['holidays']):
-        
-        # Increment the shipping date by one day until it's not a holiday or weekend
-        while True:
-            shipping_date += timedelta(days=1)
-            if (shipping_date.weekday() < 5 and 
-                shipping_date.strftime('%Y-%m-%d') not in CONFIG['BR']['holidays']):
-                break
-
-    return shipping_date
+    # Past the cutoff, on a weekend or on a holiday: next business day, same time
+    return roll_past_cutoff(shipping_date, cut_off_hours.get(carrier, cut_off_hours['LOGGI']))
 
 def adjust_receiving_date(recibo):
 
-    # Convert recibo to numpy datetime64[D] format
-    recibo_np = np.datetime64(parse_date(recibo).strftime('%Y-%m-%d'))
+    # One business day after the receiving day (or after the business day before it)
+    adjusted_date = next_business_day(roll_backward(parse_date(recibo).date()))
 
-    adjusted_date_np = np.busday_offset(recibo_np, 1, roll='backward', holidays=config.JSON_CONFIG['BR']['holidays'])
-# Replace deprecated usage
-    adjusted_datetime = datetime.fromtimestamp(adjusted_date_np.astype('datetime64[s]').astype(int), tz=timezone.utc)
-
-    return adjusted_datetime
+    return datetime(adjusted_date.year, adjusted_date.month, adjusted_date.day, tzinfo=timezone.utc)
 
 dir_path = os.path.dirname(os.path.abspath(__file__))
 with open(os.path.join(dir_path, "json/config.json"), "r") as f:
@@ -175,36 +110,45 @@ def last_workday_of_previous_month():
     first_day_of_this_month = today.replace(day=1)
     last_day_of_previous_month = first_day_of_this_month - timedelta(days=1)
 
-    # Loop backwards from the last day of the month until we find a workday
-    while last_day_of_previous_month.weekday() >= 5:  # Saturday or Sunday
-        last_day_of_previous_month -= timedelta(days=1)
+    # Back to the last workday; from a weekend the window starts at 05:00
+    if last_day_of_previous_month.weekday() >= 5:  # Saturday or Sunday
         last_day_of_previous_month = last_day_of_previous_month.replace(hour=5)
-    
-    # If the last day of the previous month is a holiday, go one day backward
-    while last_day_of_previous_month.strftime("%Y-%m-%d") in CONFIG['BR']['holidays']:
-        last_day_of_previous_month -= timedelta(days=1)
+    last_day_of_previous_month = roll_backward(last_day_of_previous_month)
 
     print(last_day_of_previous_month)
     return last_day_of_previous_month
 
-def ajuste_pendentes():
+def fetch_orders():
+    pending_at_start_date = last_workday_of_previous_month()
+
+    order_inputs = {
+        'pending_at_start_date': pending_at_start_date,
+        'wh': 4
+    }
+
+    if INCREMENTAL_FETCH:
+        # Only rows changed since the last run are downloaded and merged into the stored month
+        return fetch_incremental('1496', order_inputs)
+    # A generator: ajuste_pendentes() on its own classifies the rows as they download;
+    # fetch_sla_rows() lists them so both cards can download at the same time
+    return iter_dataset('1496', process_data(order_inputs))
+
+def fetch_sla_rows():
+    """Cards 1496 and 1485 downloaded at the same time; neither depends on the other."""
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        # copy_context keeps the Metabase caller of the job on the worker threads
+        orders = executor.submit(contextvars.copy_context().run, lambda: list(fetch_orders()))
+        recibos = executor.submit(contextvars.copy_context().run, fetch_recibos)
+        return orders.result(), recibos.result()
+
+def ajuste_pendentes(orders_list=None):
     
     excluded_orders = load_excluded_orders()
 
     sorted_data = []
 
-    pending_at_start_date = last_workday_of_previous_month()
-
-    incentivo_inputs = process_data(
-        {
-            'pending_at_start_date': pending_at_start_date,
-            'wh': 4
-        }
-    )
-
-    orders_list = get_dataset('1496', incentivo_inputs)
-
-    #print(orders_list)
+    if orders_list is None:
+        orders_list = fetch_orders()
 
     marcas = ["FOSFORO", "Dois Pontos", "Boitempo", "Qura Editora", "TAG Livros"]
 
@@ -212,7 +156,7 @@ def ajuste_pendentes():
     for order in orders_list:
         #print(order)
         order_number = order['order_number']
-        if order_number in excluded_orders:
+        if str(order_number) in excluded_orders:
             continue
 
         if order['status'] == "canceled" or order['status'] == "holded":
@@ -306,9 +250,8 @@ def incentivos_pedidos(todos_pedidos):
                 })
         
 
-    for excluded_order in excluded_orders:
-        # Remove the excluded orders from the atraso list
-        atraso = [entry for entry in atraso if entry['order_number'] != excluded_order]
+    # Remove the excluded orders from the atraso list
+    atraso = [entry for entry in atraso if str(entry['order_number']) not in excluded_orders]
 
     sla_porcent = (hit_count / len(todos_pedidos)) * 100
 
@@ -381,16 +324,20 @@ def incentivos_pedidos(todos_pedidos):
 
     return sla_semana_1, sla_semana_2, sla_semana_3, sla_semana_4, sla_porcent
 
-def incentivos_recibo():
-    excluded_recibos = load_excluded_recibos()
-    recibos_data = []
-    
+def fetch_recibos():
     recibo_inputs = process_data({
         'arrived_at': (datetime.now().replace(day=1) - timedelta(days=1)),
         'wh': 4
     })
 
-    recibos_list = get_dataset('1485', recibo_inputs)
+    return get_dataset('1485', recibo_inputs)
+
+def incentivos_recibo(recibos_list=None):
+    excluded_recibos = load_excluded_recibos()
+    recibos_data = []
+    
+    if recibos_list is None:
+        recibos_list = fetch_recibos()
 
     for recibo in recibos_list:
         recibo_number = str(recibo['id'])
@@ -447,9 +394,8 @@ def incentivos_recibo():
             continue
 
 
-    for excluded_recibo in excluded_recibos:
-        # Remove the excluded orders from the atraso list
-        atraso_recibo = [r for r in atraso_recibo if r['id'] != excluded_recibo]
+    # Remove the excluded receipts from the atraso list (ids are stored as strings)
+    atraso_recibo = [r for r in atraso_recibo if str(r['id']) not in excluded_recibos]
 
     todos_recibos=len(recibos_data)
     if todos_recibos == 0:
@@ -620,13 +566,35 @@ def calculate_complementary(value):
  
 def main():
 
+    timer = StageTimer('incentivos_embu')
     check_and_erase_json_files()
 
-    todos_pedidos = ajuste_pendentes()
+    if SLA_PUSHDOWN:
+        # Counts come grouped from Metabase (exclusions go with the query); the ajuste_* below still apply
+        pedidos, recibos, picking = incentivos_pushdown(
+            4, last_workday_of_previous_month(), datetime.now().replace(day=1) - timedelta(days=1),
+            load_excluded_orders(), load_excluded_recibos(), EMBU, datetime.now())
+        timer.lap('pushdown')
+    else:
+        # Fetch stage: both cards at once; compute stage: once both are in
+        order_rows, recibo_rows = fetch_sla_rows()
+        timer.lap('fetch')
+        if SLA_ENGINE:
+            # Same rules as the row-by-row functions below, over NumPy arrays
+            pedidos, recibos, picking = incentivos_sla(
+                order_rows, recibo_rows, EMBU, CONFIG['BR']['holidays'],
+                load_excluded_orders(), load_excluded_recibos())
+        else:
+            todos_pedidos = ajuste_pendentes(order_rows)
+
+            pedidos = incentivos_pedidos(todos_pedidos)
+            recibos = incentivos_recibo(recibo_rows)
+            picking = incentivos_picking(todos_pedidos)
+        timer.lap('compute')
 
-    sla_semana_1, sla_semana_2, sla_semana_3, sla_semana_4, sla_porcent = incentivos_pedidos(todos_pedidos)
-    sla_recibo_1, sla_recibo_2, sla_recibo_3, sla_recibo_4, SLA_recibos_total = incentivos_recibo()
-    sla_picking_semana_1, sla_picking_semana_2, sla_picking_semana_3, sla_picking_semana_4, sla_picking_total = incentivos_picking(todos_pedidos)
+    sla_semana_1, sla_semana_2, sla_semana_3, sla_semana_4, sla_porcent = pedidos
+    sla_recibo_1, sla_recibo_2, sla_recibo_3, sla_recibo_4, SLA_recibos_total = recibos
+    sla_picking_semana_1, sla_picking_semana_2, sla_picking_semana_3, sla_picking_semana_4, sla_picking_total = picking
 
     s1_total, s2_total, s3_total, s4_total = calculate_averages(sla_semana_1, sla_semana_2, sla_semana_3, sla_semana_4, sla_recibo_1, sla_recibo_2, sla_recibo_3, sla_recibo_4, sla_picking_semana_1, sla_picking_semana_2, sla_picking_semana_3, sla_picking_semana_4)
 
@@ -734,6 +702,9 @@ def main():
     # Save to JSON
     save_to_json(data)
     save_to_redis("sla_embu", data)
+    record_run("embu", data)
+    timer.lap('save')
+    timer.save()
     print("Done")
     print(datetime.now())
 
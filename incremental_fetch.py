@@ -0,0 +1,167 @@
+import os
+import json
+import zlib
+import hashlib
+from datetime import datetime, timedelta
+import pytz
+from dotenv import dotenv_values
+from parseDT import parse_date
+from redis_connection import get_redis_connection, get_redis_binary_connection
+from metabase import get_dataset, process_data
+from metabase_cache import canonical_params
+
+env_config = dotenv_values(".env")
+
+# Opt-in: the card must filter on the UPDATED_SINCE_TAG template tag
+# (e.g. "updated_at >= {{updated_since}}::timestamp") for delta queries to work
+INCREMENTAL_FETCH = (env_config.get('INCREMENTAL_FETCH') or os.environ.get('INCREMENTAL_FETCH', '')) == '1'
+UPDATED_SINCE_TAG = env_config.get('UPDATED_SINCE_TAG') or os.environ.get('UPDATED_SINCE_TAG', 'updated_since')
+
+# Column of the cards with the database's last update time of each row, for the watermarks
+UPDATED_AT_COLUMN = env_config.get('UPDATED_AT_COLUMN') or os.environ.get('UPDATED_AT_COLUMN', 'updated_at')
+# Timezone of the cards' timestamps (and of the scheduler), for watermarks taken from the clock
+WATERMARK_TIMEZONE = pytz.timezone(env_config.get('WATERMARK_TIMEZONE')
+                                   or os.environ.get('WATERMARK_TIMEZONE', 'America/Sao_Paulo'))
+
+STORE_KEY_PREFIX = "metabase:rows"
+# The next delta starts this long before the newest change seen, so rows
+# committed while a run was in flight are not missed
+WATERMARK_OVERLAP = timedelta(minutes=10)
+# A store that has not been fully refetched for this long is rebuilt even if the nightly reconcile did not run
+FULL_RECONCILE_MAX_AGE = timedelta(hours=26)
+STORE_TTL = 40 * 24 * 3600
+WRITE_BATCH = 1000
+
+def store_key(question, inputs):
+    """One store per card, warehouse and base parameters (the month start changes the key)."""
+    digest = hashlib.sha1(canonical_params(process_data(inputs)).encode('utf-8')).hexdigest()[:16]
+    return f"{STORE_KEY_PREFIX}:{question}:{inputs.get('wh', 'all')}:{digest}"
+
+# Rows are zlib-compressed one by one with a preset dictionary made from a
+# sample row of the card, so the column names repeated in every row are almost free
+def _dictionary(rows):
+    return _serialize(rows[0])[-32768:] if rows else b'{}'
+
+def _serialize(row):
+    return json.dumps(row, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+def _compress_row(row, zdict):
+    compressor = zlib.compressobj(6, zdict=zdict)
+    return compressor.compress(_serialize(row)) + compressor.flush()
+
+def _decompress_row(payload, zdict):
+    decompressor = zlib.decompressobj(zdict=zdict)
+    return json.loads(decompressor.decompress(payload) + decompressor.flush())
+
+def _write_rows(pipe, key, rows, key_column, zdict):
+    """Queue the rows on pipe; returns (JSON bytes, stored bytes) to report the compression ratio."""
+    raw_bytes = stored_bytes = 0
+    for start in range(0, len(rows), WRITE_BATCH):
+        mapping = {}
+        for row in rows[start:start + WRITE_BATCH]:
+            payload = _compress_row(row, zdict)
+            raw_bytes += len(_serialize(row))
+            stored_bytes += len(payload)
+            mapping[str(row[key_column])] = payload
+        pipe.hset(key, mapping=mapping)
+    return raw_bytes, stored_bytes
+
+def watermark_clock():
+    """Current wall-clock time in WATERMARK_TIMEZONE (naive), whatever the host's timezone."""
+    return datetime.now(WATERMARK_TIMEZONE).replace(tzinfo=None)
+
+def _newest_update(rows):
+    return max(filter(None, (parse_date(row.get(UPDATED_AT_COLUMN)) for row in rows)), default=None)
+
+def next_watermark(row_sets, started, previous=None):
+    """
+    Where the next delta starts, WATERMARK_OVERLAP before the newest
+    UPDATED_AT_COLUMN of the fetched rows (the database's own clock; the
+    oldest of those over several cards). Never before previous; when nothing
+    changed it stays at previous. When the cards have no such column, the
+    watermark_clock() taken before the fetch (started) is used instead.
+    """
+    newest = [stamp for stamp in map(_newest_update, row_sets) if stamp is not None]
+    if newest:
+        watermark = min(newest) - WATERMARK_OVERLAP
+    elif previous and not any(row_sets):
+        return previous
+    else:
+        watermark = started - WATERMARK_OVERLAP
+    if previous:
+        watermark = max(watermark, parse_date(previous))
+    return watermark.isoformat(timespec='seconds')
+
+def _ratio(sizes):
+    raw_bytes, stored_bytes = sizes
+    return f"{raw_bytes / stored_bytes:.1f}x" if stored_bytes else "n/a"
+
+def fetch_incremental(question, inputs, key_column='order_number', full=False):
+    """
+    Return all rows of a card for the given process_data inputs, asking
+    Metabase only for rows updated since the last watermark and merging them
+    into the rows kept in Redis. Falls back to a full fetch when there is no
+    store yet, when it is due for a reconcile, or when full=True.
+    """
+    run_started = watermark_clock()
+    key = store_key(question, inputs)
+    meta_key = f"{key}:meta"
+
+    try:
+        r = get_redis_binary_connection()
+        meta = r.hgetall(meta_key)
+    except Exception as e:
+        print(f"Error reading incremental store for card {question}: {e}")
+        return get_dataset(question, process_data(inputs))
+
+    # Stores written before rows were compressed have no dictionary: rebuild them
+    zdict = meta.get(b'zdict')
+    watermark = meta[b'watermark'].decode() if meta.get(b'watermark') else None
+    last_full = datetime.fromisoformat(meta[b'last_full'].decode()) if meta.get(b'last_full') else None
+    if (full or not watermark or not zdict or last_full is None
+            or run_started - last_full > FULL_RECONCILE_MAX_AGE):
+        rows = get_dataset(question, process_data(inputs))
+        zdict = _dictionary(rows)
+        try:
+            pipe = r.pipeline()
+            pipe.delete(key)
+            sizes = _write_rows(pipe, key, rows, key_column, zdict)
+            pipe.hset(meta_key, mapping={
+                'watermark': next_watermark([rows], run_started),
+                'last_full': run_started.isoformat(),
+                'zdict': zdict
+            })
+            pipe.expire(key, STORE_TTL)
+            pipe.expire(meta_key, STORE_TTL)
+            pipe.execute()
+            print(f"Full fetch of card {question}: {len(rows)} rows stored, compressed {_ratio(sizes)}")
+        except Exception as e:
+            print(f"Error writing incremental store for card {question}: {e}")
+        return rows
+
+    # The watermark goes as text so the card can compare it with a timestamp
+    delta = get_dataset(question, process_data({**inputs, UPDATED_SINCE_TAG: watermark}), refresh=True,
+                        snapshot=False)
+
+    try:
+        # One MULTI/EXEC: the merged rows and the new watermark are stored together or not at all
+        pipe = r.pipeline()
+        _write_rows(pipe, key, delta, key_column, zdict)
+        pipe.hset(meta_key, 'watermark', next_watermark([delta], run_started, watermark))
+        pipe.hvals(key)
+        rows = [_decompress_row(value, zdict) for value in pipe.execute()[-1]]
+    except Exception as e:
+        print(f"Error merging into incremental store for card {question}: {e}; fetching it in full")
+        return get_dataset(question, process_data(inputs))
+
+    print(f"Incremental fetch of card {question}: {len(delta)} rows changed since {watermark}, {len(rows)} rows in total")
+    return rows
+
+def reset_watermarks():
+    """Make the next run of every incremental store a full fetch (nightly reconcile)."""
+    r = get_redis_connection()
+    count = 0
+    for meta_key in r.scan_iter(f"{STORE_KEY_PREFIX}:*:meta", count=1000):
+        r.hdel(meta_key, 'watermark')
+        count += 1
+    print(f"Reset {count} incremental store watermarks")
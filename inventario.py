@@ -4,7 +4,7 @@ from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from redis_connection import get_redis_connection
 from google.auth.exceptions import RefreshError
-from metabase import get_dataset, process_data
+from metabase import get_dataset, process_data, JOB_DEADLINE
 from google_auth import authenticate_google
 from dotenv import dotenv_values
 
@@ -15,12 +15,12 @@ redis_client = get_redis_connection()
 drive_service = authenticate_google('drive')
 
 
-def get_estoque(bin):
+def get_estoque(bin, refresh=False, deadline=JOB_DEADLINE):
     try:
         # Use process_data to format parameters correctly for Metabase
         params = process_data({'bin': bin})
 
-        estoque = get_dataset('9845', params)
+        estoque = get_dataset('9845', params, refresh=refresh, deadline=deadline)
         
         # Ensure we return a list
         if estoque is None:
@@ -0,0 +1,53 @@
+import json
+import time
+from datetime import datetime
+from redis_connection import get_redis_connection
+
+# Per-stage durations of the last runs of a job (fetch, compute, save...), for /jobs/status.
+# One Redis list per job, newest run first.
+TIMINGS_KEY_PREFIX = "jobs:timings"
+TIMINGS_HISTORY = 20
+
+class StageTimer:
+    """
+    Call lap(stage) at the end of every stage; it records the time since the
+    previous lap (or since the timer was created). save() stores the run.
+    """
+
+    def __init__(self, job):
+        self.job = job
+        self.started_at = datetime.now()
+        self._started = time.perf_counter()
+        self._last = self._started
+        self.stages = {}
+
+    def lap(self, stage):
+        now = time.perf_counter()
+        self.stages[stage] = round(self.stages.get(stage, 0) + now - self._last, 3)
+        self._last = now
+
+    def save(self):
+        run = {
+            'started_at': self.started_at.isoformat(timespec='seconds'),
+            'total_s': round(time.perf_counter() - self._started, 3),
+            'stages': self.stages,
+        }
+        print(f"{self.job}: " + ", ".join(f"{stage} {seconds:.2f}s" for stage, seconds in self.stages.items())
+              + f" (total {run['total_s']:.2f}s)")
+        try:
+            key = f"{TIMINGS_KEY_PREFIX}:{self.job}"
+            pipe = get_redis_connection().pipeline()
+            pipe.lpush(key, json.dumps(run))
+            pipe.ltrim(key, 0, TIMINGS_HISTORY - 1)
+            pipe.execute()
+        except Exception as e:
+            print(f"Error saving timings of {self.job}: {e}")
+        return run
+
+def load_timings(runs=1):
+    """{job: [runs, newest first]} of every job that recorded timings."""
+    r = get_redis_connection()
+    timings = {}
+    for key in sorted(r.scan_iter(f"{TIMINGS_KEY_PREFIX}:*", count=1000)):
+        timings[key[len(TIMINGS_KEY_PREFIX) + 1:]] = [json.loads(run) for run in r.lrange(key, 0, runs - 1)]
+    return timings
@@ -51,7 +51,7 @@ def compare_data(old_data, new_data):
     return changes
 
 def status_loja():
-    stores_list = get_dataset('2954')
+    stores_list = get_dataset('2954', columns=['marca', 'account_type'])
     new_data = [{'loja': loja['marca'], 'status': loja['account_type']} for loja in stores_list]
     old_data = load_previous_data_redis()
     changes = compare_data(old_data, new_data)
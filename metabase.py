@@ -1,86 +1,798 @@
 import os
 import json
+import csv
+import codecs
+import zlib
+import copy
+import threading
+import contextvars
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from collections import namedtuple
+import numpy as np
 from dotenv import dotenv_values
 import requests
-from datetime import datetime
-from requests.adapters import HTTPAdapter
+from datetime import datetime, timedelta
 from urllib3.util.retry import Retry
 import time
+from metabase_cache import get_cached, set_cached, get_stale, is_cacheable, cache_key, fetch_shared
+from metabase_metrics import CardCallMetrics, TimedHTTPAdapter, take_connect_time
+from parseDT import parse_date_array
 
-def create_metabase_token():
+env_config = dotenv_values(".env")
+
+# METABASE_ENDPOINT can point the client at a local stand-in (benchmarks/metabase_standin.py)
+METABASE_ENDPOINT = (env_config.get('METABASE_ENDPOINT') or os.environ.get('METABASE_ENDPOINT')
+                     or "https://cubbo.metabaseapp.com").rstrip('/')
+
+# Metabase expires sessions after 14 days (MAX_SESSION_AGE); renew a bit before that
+SESSION_MAX_AGE = timedelta(days=13)
+
+# Card results are large, repetitive JSON: ask for them compressed and
+# decompress while the body streams in (see iter_decoded)
+ACCEPT_ENCODING = 'gzip, deflate'
+
+# Seconds a caller is willing to wait for a card, retries included.
+# Web routes must answer well inside gunicorn's 30 s timeout.
+WEB_DEADLINE = 10
+JOB_DEADLINE = 300
+
+class MetabaseUnavailable(Exception):
+    """Metabase did not answer within the caller's deadline, or the circuit breaker is open."""
+
+def get_metabase_credentials():
 
     env_config = dotenv_values(".env")
     metabase_user = env_config.get('METABASE_USER')
-    
+
     if metabase_user is not None:
         metabase_password = env_config.get('METABASE_PASSWORD')
     else:
         metabase_user = os.environ["METABASE_USER"]
         metabase_password = os.environ["METABASE_PASSWORD"]
 
-    url = 'https://cubbo.metabaseapp.com/api/session'
+    return metabase_user, metabase_password
+
+def create_metabase_token(session=None, endpoint=METABASE_ENDPOINT):
+
+    metabase_user, metabase_password = get_metabase_credentials()
+
+    url = f'{endpoint}/api/session'
     data = {
         'username': metabase_user,
         'password': metabase_password
     }
 
     headers = {'Content-Type': 'application/json'}
-    response = requests.post(url, headers=headers, data=json.dumps(data))
+    response = (session or requests).post(url, headers=headers, data=json.dumps(data), timeout=(30, 60))
     if response.status_code == 200:
         return response.json().get('id')
     else:
         raise Exception(f'Failed to create token: {response.content}')
-    
-def create_session_with_retries():
+
+def create_session_with_retries(pool_maxsize=10):
     session = requests.Session()
     retries = Retry(
         total=3,  # number of retries
         backoff_factor=1,  # wait 1, 2, 4 seconds between retries
         status_forcelist=[500, 502, 503, 504]
     )
-    session.mount('https://', HTTPAdapter(max_retries=retries))
+    # One pool per host, kept alive between calls
+    adapter = TimedHTTPAdapter(max_retries=retries, pool_connections=1, pool_maxsize=pool_maxsize)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers['Accept-Encoding'] = ACCEPT_ENCODING
     return session
 
-def get_dataset(question, params={}):
-    METABASE_ENDPOINT = "https://cubbo.metabaseapp.com"
+class MetabaseClient:
+    """
+    Process-wide Metabase client.
+    Keeps one pooled keep-alive session and reuses the session token until it
+    expires or Metabase answers 401.
+    """
+
+    def __init__(self, endpoint=METABASE_ENDPOINT, session_max_age=SESSION_MAX_AGE):
+        self.endpoint = endpoint
+        self.session_max_age = session_max_age
+        self.session = create_session_with_retries()
+        self.pid = os.getpid()
+        self._token = None
+        self._token_expires_at = None
+        self._token_lock = threading.Lock()
+
+    def get_token(self, rejected_token=None):
+        """
+        Return the cached session token, creating a new one when there is none,
+        it is past its max age, or it is the token Metabase just rejected.
+        """
+        with self._token_lock:
+            if (self._token is None
+                    or datetime.now() >= self._token_expires_at
+                    or (rejected_token is not None and rejected_token == self._token)):
+                self._token = create_metabase_token(self.session, self.endpoint)
+                self._token_expires_at = datetime.now() + self.session_max_age
+                print("New Metabase session token created")
+            return self._token
+
+    def post(self, path, **kwargs):
+        """POST to the Metabase API, refreshing the token once on 401."""
+        url = f"{self.endpoint}{path}"
+        headers = {"Content-Type": "application/json", **kwargs.pop('headers', {})}
+
+        token = self.get_token()
+        res = self.session.post(url, headers={**headers, 'X-Metabase-Session': token}, **kwargs)
+
+        if res.status_code == 401:
+            res.close()
+            token = self.get_token(rejected_token=token)
+            res = self.session.post(url, headers={**headers, 'X-Metabase-Session': token}, **kwargs)
+
+        return res
+
+_client = None
+_client_lock = threading.Lock()
+
+def get_client():
+    """
+    Return the shared MetabaseClient. A new one is created after a fork
+    (gunicorn preload) so workers never share sockets with the master.
+    """
+    global _client
+    if _client is None or _client.pid != os.getpid():
+        with _client_lock:
+            if _client is None or _client.pid != os.getpid():
+                _client = MetabaseClient()
+    return _client
+
+class CircuitBreaker:
+    """
+    Shared by every Metabase call in the process. After failure_threshold
+    consecutive failed attempts the circuit opens and calls fail fast; after
+    reset_timeout seconds one trial call is let through (half open), and its
+    outcome closes the circuit again or reopens it.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=60):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == 'open' and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = 'half_open'
+                self._trial_running = False
+            if self.state == 'closed':
+                return True
+            if self.state == 'half_open' and not self._trial_running:
+                self._trial_running = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self.state != 'closed':
+                print("Metabase circuit breaker closed")
+            self.state = 'closed'
+            self.failures = 0
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_running = False
+            if self.state == 'half_open' or (self.state == 'closed' and self.failures >= self.failure_threshold):
+                print(f"Metabase circuit breaker opened after {self.failures} consecutive failures")
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+
+    def status(self):
+        with self._lock:
+            status = {'state': self.state, 'consecutive_failures': self.failures}
+            if self.state == 'open':
+                status['retry_in_seconds'] = max(0, round(self.reset_timeout - (time.monotonic() - self.opened_at)))
+            return status
+
+breaker = CircuitBreaker()
+
+def _post_card(question, params, stream=False, export_format='json', deadline=JOB_DEADLINE, metrics=None):
+    """
+    POST a card query, retrying until Metabase answers 200 or the deadline
+    (seconds) runs out, in which case MetabaseUnavailable is raised.
+    Returns the open response; with stream=True the body is not read yet.
+    metrics (a CardCallMetrics) gets the attempt count and connect/server/download times.
+    """
+    client = get_client()
+    expires_at = time.monotonic() + deadline
     attempt = 0
-    
-    while True:  # Keep trying indefinitely
+
+    while True:
+        remaining = expires_at - time.monotonic()
+        if remaining <= 0:
+            raise MetabaseUnavailable(f"No time left to query card {question} ({attempt} attempts)")
+
+        if not breaker.allow():
+            raise MetabaseUnavailable(f"Metabase circuit breaker is open, card {question} not queried")
+
         try:
             attempt += 1
-            METABASE_TOKEN = create_metabase_token()
-            session = create_session_with_retries()
-            
+
             print(f"Attempt {attempt} to fetch data from Metabase...")
-            
-            res = session.post(
-                f"{METABASE_ENDPOINT}/api/card/{question}/query/json",
-                headers={
-                    "Content-Type": "application/json",
-                    'X-Metabase-Session': METABASE_TOKEN
-                },
+
+            take_connect_time()
+            sent_at = time.perf_counter()
+            res = client.post(
+                f"/api/card/{question}/query/{export_format}",
                 json=params,
-                timeout=(30, 90)  # (connect timeout, read timeout)
+                timeout=(min(30, remaining), min(90, remaining)),  # (connect timeout, read timeout)
+                stream=stream
             )
-            
+
             if res.status_code == 200:
-                dataset = res.json()
-                print("Successfully fetched data from Metabase")
-                return dataset
+                breaker.record_success()
+                if metrics is not None:
+                    metrics.attempts = attempt
+                    metrics.response_received(take_connect_time(), res.elapsed.total_seconds())
+                    if not stream:
+                        # requests has already read the body: the rest of the time was the download
+                        metrics.download = max(time.perf_counter() - sent_at - res.elapsed.total_seconds(), 0.0)
+                        metrics.bytes = len(res.content)
+                return res
             else:
                 print(f"Error response from Metabase: {res.text}")
-                print(f"Retrying in {min(attempt * 2, 30)} seconds...")  # Cap wait time at 30 seconds
-                time.sleep(min(attempt * 2, 30))
+                res.close()
+                # A 4xx still means Metabase is up; only server errors count against it
+                if res.status_code >= 500:
+                    breaker.record_failure()
+                else:
+                    breaker.record_success()
 
         except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
             print(f"Network error on attempt {attempt}: {str(e)}")
-            print(f"Retrying in {min(attempt * 2, 30)} seconds...")  # Cap wait time at 30 seconds
-            time.sleep(min(attempt * 2, 30))
-            
+            breaker.record_failure()
+
         except Exception as e:
             print(f"Unexpected error on attempt {attempt}: {str(e)}")
-            print(f"Retrying in {min(attempt * 2, 30)} seconds...")  # Cap wait time at 30 seconds
-            time.sleep(min(attempt * 2, 30))
+            breaker.record_failure()
+
+        if breaker.state == 'open':
+            raise MetabaseUnavailable(f"Metabase circuit breaker opened while querying card {question}")
+        wait = min(attempt * 2, 30)  # Cap wait time at 30 seconds
+        if time.monotonic() + wait >= expires_at:
+            raise MetabaseUnavailable(f"Metabase did not answer card {question} within {deadline:.0f} seconds ({attempt} attempts)")
+        print(f"Retrying in {wait} seconds...")
+        time.sleep(wait)
+
+class _InFlightCall:
+    def __init__(self):
+        self.done = threading.Event()
+        self.waiters = 0
+        self.result = None
+        self.error = None
+
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+
+def _single_flight(key, fetch, timeout=None):
+    """
+    Run fetch() once for concurrent callers with the same key in this process.
+    The first caller fetches; the others block (up to timeout seconds) and get
+    a copy of its result (or its exception). Copies are needed because callers
+    edit the rows in place.
+    """
+    with _in_flight_lock:
+        call = _in_flight.get(key)
+        if call is None:
+            call = _in_flight[key] = _InFlightCall()
+            leader = True
+        else:
+            call.waiters += 1
+            leader = False
+
+    if not leader:
+        if not call.done.wait(timeout):
+            raise MetabaseUnavailable("Timed out waiting for an identical Metabase request in flight")
+        if call.error is not None:
+            raise call.error
+        return copy.deepcopy(call.result)
+
+    try:
+        result = fetch()
+        with _in_flight_lock:
+            del _in_flight[key]
+            # Keep an untouched snapshot for the waiters before the caller edits the rows
+            call.result = copy.deepcopy(result) if call.waiters else None
+        return result
+    except BaseException as e:
+        with _in_flight_lock:
+            _in_flight.pop(key, None)
+        call.error = e
+        raise
+    finally:
+        call.done.set()
+
+def _cache_params(params, columns):
+    """Params a result is cached under: a projected result is keyed by its column allow-list too."""
+    return params if columns is None else {**params, 'columns': sorted(columns)}
+
+def _project(rows, columns, metrics):
+    """
+    Keep only the allowed columns of each row. Once the rows run out, the
+    metrics get the response bytes the dropped columns took up.
+    """
+    columns = list(columns)
+    kept_bytes = 0
+    for row in rows:
+        projected = {column: row[column] for column in columns if column in row}
+        if metrics is not None:
+            kept_bytes += len(json.dumps(projected, ensure_ascii=False, separators=(',', ':')).encode('utf-8')) + 1
+        yield projected
+    if metrics is not None:
+        metrics.saved_bytes = max(metrics.bytes - kept_bytes, 0)
+
+def _fetch_dataset(question, params, deadline=JOB_DEADLINE, metrics=None, columns=None, snapshot=True):
+    expires_at = time.monotonic() + deadline
+    if metrics is not None:
+        metrics.outcome = 'miss'
+    while True:
+        res = _post_card(question, params, stream=True, deadline=expires_at - time.monotonic(), metrics=metrics)
+        download_started = time.perf_counter()
+        try:
+            with res:
+                dataset = json.loads(b''.join(_iter_body(res, metrics)))
+        except (ValueError, zlib.error) as e:
+            print(f"Invalid JSON from Metabase for card {question}: {e}")
+            time.sleep(2)
+            continue
+        if metrics is not None:
+            metrics.download = time.perf_counter() - download_started
+        if columns is not None:
+            dataset = list(_project(dataset, columns, metrics))
+        print("Successfully fetched data from Metabase")
+        cache_params = _cache_params(params, columns)
+        _record_cache_sizes(metrics, set_cached(question, cache_params, dataset))
+        writer = _snapshot_writer(question, cache_params, snapshot)
+        if writer is not None:
+            for row in dataset:
+                writer.append(row)
+            _save_snapshot_in_background(writer)
+        return dataset
+
+def _snapshot_writer(question, params, snapshot=True):
+    """A SnapshotWriter when this card keeps an on-disk snapshot (snapshot_store.SNAPSHOT_CARDS)."""
+    from snapshot_store import SnapshotWriter, SNAPSHOT_CARDS
+    return SnapshotWriter(question, params) if snapshot and str(question) in SNAPSHOT_CARDS else None
+
+def _save_snapshot_in_background(writer):
+    # The values are already captured, so callers can go on editing the rows
+    threading.Thread(target=writer.save, daemon=True).start()
+
+def _serve_stale(question, params, error):
+    """The Redis stale copy, else the on-disk snapshot for these params, else re-raise error."""
+    stale = get_stale(question, params)
+    if stale is None:
+        from snapshot_store import load_card_snapshot, iter_snapshot_rows
+        snapshot = load_card_snapshot(question, params)
+        if snapshot is None:
+            raise error
+        print(f"{error}; serving snapshot of card {question} from {snapshot.meta['created_at']}")
+        return list(iter_snapshot_rows(snapshot))
+    print(f"{error}; serving stale cached result for card {question}")
+    return stale
+
+def get_dataset(question, params={}, refresh=False, deadline=JOB_DEADLINE, columns=None, snapshot=True):
+    """
+    Fetch a card's rows. Cards listed in metabase_cache.CARD_CACHE_TTL are served
+    from Redis while fresh; refresh=True skips the cache read (user-triggered
+    refreshes) but still stores the new result.
+    Identical requests already in flight, in this process or another worker,
+    are joined instead of sent to Metabase again.
+    deadline is how many seconds the caller can wait (WEB_DEADLINE for routes).
+    When it runs out, or the circuit breaker is open, the last cached result
+    is returned if there is one; otherwise MetabaseUnavailable is raised.
+    columns is an optional allow-list: rows keep only those keys, and are
+    cached apart from the full result.
+    snapshot=False skips the on-disk snapshot of SNAPSHOT_CARDS: pass it for
+    partial results (date shards, deltas) that must not become the card's latest.
+    """
+    metrics = CardCallMetrics(question)
+    cache_params = _cache_params(params, columns)
+    if not refresh:
+        cached = get_cached(question, cache_params)
+        if cached is not None:
+            print(f"Card {question} served from cache")
+            metrics.record('hit', rows=len(cached))
+            return cached
+
+    expires_at = time.monotonic() + deadline
+    try:
+        dataset = _single_flight(
+            cache_key(question, cache_params),
+            lambda: fetch_shared(
+                question, cache_params,
+                lambda: _fetch_dataset(question, params, expires_at - time.monotonic(), metrics, columns, snapshot),
+                max_wait=deadline
+            ),
+            timeout=deadline
+        )
+    except MetabaseUnavailable as e:
+        try:
+            dataset = _serve_stale(question, cache_params, e)
+        except MetabaseUnavailable:
+            metrics.record('error')
+            raise
+        metrics.record('stale', rows=len(dataset))
+        return dataset
+    except Exception:
+        metrics.record('error')
+        raise
+
+    metrics.record(rows=len(dataset))
+    return dataset
+
+def _iter_json_array(chunks):
+    """
+    Yield the elements of a JSON array as soon as each one is complete,
+    reading the body from an iterable of byte chunks.
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+    pos = 0
+    started = False
+
+    for chunk in chunks:
+        buffer = buffer[pos:] + text_decoder.decode(chunk)
+        pos = 0
+
+        while True:
+            # Skip whitespace and the commas between elements
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+                pos += 1
+            if pos >= len(buffer):
+                break
+
+            if not started:
+                if buffer[pos] != '[':
+                    raise ValueError(f"Expected a JSON array, got: {buffer[pos:pos + 200]}")
+                started = True
+                pos += 1
+                continue
+
+            if buffer[pos] == ']':
+                return
+
+            try:
+                item, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                break  # element not complete yet, wait for the next chunk
+
+            yield item
+            pos = end
+
+    raise ValueError("Metabase response ended before the JSON array was closed")
+
+def _decompressor(content_encoding):
+    """zlib decompressobj for a Content-Encoding, or None when the body is not compressed."""
+    if content_encoding == 'gzip':
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if content_encoding == 'deflate':
+        return zlib.decompressobj(zlib.MAX_WBITS)
+    return None
+
+def iter_decoded(chunks, content_encoding, metrics=None):
+    """
+    Decompress a response body chunk by chunk as it arrives. chunks are the
+    bytes as sent on the wire; metrics gets both the wire and decoded sizes.
+    """
+    content_encoding = (content_encoding or '').strip().lower()
+    decoder = _decompressor(content_encoding)
+    first = True
+    for chunk in chunks:
+        if metrics is not None:
+            metrics.wire_bytes += len(chunk)
+        if decoder is not None:
+            try:
+                chunk = decoder.decompress(chunk)
+            except zlib.error:
+                # Some servers send "deflate" without the zlib header
+                if not (first and content_encoding == 'deflate'):
+                    raise
+                decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+                chunk = decoder.decompress(chunk)
+        first = False
+        if chunk:
+            if metrics is not None:
+                metrics.bytes += len(chunk)
+            yield chunk
+    if decoder is not None:
+        tail = decoder.flush()
+        if tail:
+            if metrics is not None:
+                metrics.bytes += len(tail)
+            yield tail
+
+def _iter_body(res, metrics):
+    """Body of a streamed requests response, decompressed here rather than by urllib3 so wire bytes can be counted."""
+    return iter_decoded(res.raw.stream(64 * 1024, decode_content=False), res.headers.get('Content-Encoding'), metrics)
+
+def _record_cache_sizes(metrics, sizes):
+    if metrics is not None and sizes is not None:
+        metrics.cache_raw_bytes, metrics.cache_bytes = sizes
+
+def iter_dataset(question, params={}, refresh=False, deadline=JOB_DEADLINE, columns=None, snapshot=True):
+    """
+    Generator version of get_dataset: parses the response while it downloads
+    and yields rows one at a time, so memory does not grow with the result.
+    Only the request itself is retried; an error in the middle of the body is raised.
+    Cached cards are served from Redis, and on a miss their rows are kept to refill the cache.
+    columns and snapshot work as in get_dataset.
+    """
+    metrics = CardCallMetrics(question)
+    cache_params = _cache_params(params, columns)
+    if not refresh:
+        cached = get_cached(question, cache_params)
+        if cached is not None:
+            print(f"Card {question} served from cache")
+            metrics.record('hit', rows=len(cached))
+            yield from cached
+            return
+
+    rows = [] if is_cacheable(question) else None
+    writer = _snapshot_writer(question, cache_params, snapshot)
+
+    try:
+        res = _post_card(question, params, stream=True, deadline=deadline, metrics=metrics)
+    except MetabaseUnavailable as e:
+        try:
+            stale = _serve_stale(question, cache_params, e)
+        except MetabaseUnavailable:
+            metrics.record('error')
+            raise
+        metrics.record('stale', rows=len(stale))
+        yield from stale
+        return
+
+    # The download time includes the caller's own work on each row, since both interleave
+    download_started = time.perf_counter()
+    count = 0
+    try:
+        with res:
+            parsed = _iter_json_array(_iter_body(res, metrics))
+            for row in (parsed if columns is None else _project(parsed, columns, metrics)):
+                count += 1
+                if rows is not None:
+                    rows.append(row)
+                if writer is not None:
+                    writer.append(row)
+                yield row
+    except Exception:
+        metrics.record('error', rows=count)
+        raise
+    metrics.download = time.perf_counter() - download_started
+    metrics.record('miss', rows=count)
+
+    print(f"Successfully streamed {count} rows from Metabase")
+    if rows is not None:
+        _record_cache_sizes(metrics, set_cached(question, cache_params, rows))
+    if writer is not None:
+        _save_snapshot_in_background(writer)
+
+# Columns decoded by get_dataset_columns when no schema is given
+TIMESTAMP_COLUMNS = ['pending_at', 'shipping_date', 'picking_complete', 'arrived_at',
+                     'completed_at', 'delivered_at', 'estimated_time_arrival']
+CATEGORY_COLUMNS = ['carrier_name', 'Stores__name', 'status']
+DEFAULT_COLUMN_SCHEMA = {
+    **{column: 'datetime' for column in TIMESTAMP_COLUMNS},
+    **{column: 'category' for column in CATEGORY_COLUMNS},
+}
+
+# Dictionary-encoded column: codes index into categories, -1 marks an empty value
+CategoricalColumn = namedtuple('CategoricalColumn', ['codes', 'categories'])
+
+def _to_datetime64(values):
+    """
+    Convert timestamp strings to datetime64[us]. Like parse_date, the UTC offset
+    is dropped and the wall-clock time is kept; empty values become NaT.
+    """
+    return parse_date_array(values)
+
+def _to_categorical(values):
+    index = {}
+    codes = np.fromiter(
+        (index.setdefault(value, len(index)) if value else -1 for value in values),
+        dtype=np.int32,
+        count=len(values)
+    )
+    return CategoricalColumn(codes, np.array(list(index), dtype=object))
+
+def _to_float(values):
+    return np.array([float(value) if value else np.nan for value in values], dtype=np.float64)
+
+COLUMN_DECODERS = {
+    'datetime': _to_datetime64,
+    'category': _to_categorical,
+    'int': lambda values: np.array(values, dtype=np.int64),
+    'float': _to_float,
+    'str': lambda values: np.array(values, dtype=object),
+}
+
+def _iter_text_lines(chunks):
+    """Decode byte chunks into text lines, keeping line endings for the csv module."""
+    text_decoder = codecs.getincrementaldecoder('utf-8-sig')()
+    pending = ''
+    for chunk in chunks:
+        lines = (pending + text_decoder.decode(chunk)).splitlines(keepends=True)
+        # Hold back an unterminated last line (or a CR that may be half of a CRLF)
+        pending = lines.pop() if lines and not lines[-1].endswith('\n') else ''
+        yield from lines
+    pending += text_decoder.decode(b'', final=True)
+    if pending:
+        yield pending
+
+def get_dataset_columns(question, params={}, schema=None, deadline=JOB_DEADLINE, columns=None, snapshot=True):
+    """
+    Fetch a card through the CSV export and return one NumPy array per column.
+    schema maps column name -> 'datetime' | 'category' | 'int' | 'float' | 'str';
+    columns missing from it are kept as object arrays of strings.
+    Categorical columns come back as CategoricalColumn(codes, categories).
+    columns is an optional allow-list; other columns are skipped while parsing.
+    snapshot works as in get_dataset.
+    """
+    schema = DEFAULT_COLUMN_SCHEMA if schema is None else schema
+    # format_rows=false keeps ISO timestamps and raw numbers in the export
+    csv_params = {**params, 'format_rows': False}
+
+    metrics = CardCallMetrics(question)
+    started_stamp = time.time_ns()
+    try:
+        with _post_card(question, csv_params, stream=True, export_format='csv', deadline=deadline, metrics=metrics) as res:
+            download_started = time.perf_counter()
+            reader = csv.reader(_iter_text_lines(_iter_body(res, metrics)))
+            header = next(reader, [])
+            kept = [i for i, name in enumerate(header) if columns is None or name in columns]
+            header = [header[i] for i in kept]
+            values = [[] for _ in header]
+            count = 0
+            for row in reader:
+                count += 1
+                for column_values, i in zip(values, kept):
+                    column_values.append(row[i] if i < len(row) else '')
+            metrics.download = time.perf_counter() - download_started
+    except Exception:
+        metrics.record('error')
+        raise
+
+    if columns is not None:
+        # Decoded CSV bytes minus what the kept columns account for (values plus a separator each)
+        metrics.saved_bytes = max(metrics.bytes - sum(len(value.encode('utf-8')) + 1
+                                                      for column_values in values for value in column_values), 0)
+
+    result = {}
+    for name, column_values in zip(header, values):
+        result[name] = COLUMN_DECODERS[schema.get(name, 'str')](column_values)
+
+    metrics.record('miss', rows=count)
+    print(f"Fetched {count} rows in columnar mode from card {question}")
+    from snapshot_store import save_columns_snapshot, SNAPSHOT_CARDS
+    if snapshot and str(question) in SNAPSHOT_CARDS:
+        try:
+            save_columns_snapshot(question, _cache_params(params, columns), result, started_stamp)
+        except Exception as e:
+            print(f"Error saving snapshot of card {question}: {e}")
+    return result
+
+# Shards fetched at once by iter_shards, and how far ahead of the consumer they may run
+SHARD_WORKERS = 4
+SHARD_READ_AHEAD = 2
+
+def date_shards(start, end, unit='day'):
+    """
+    Split the inclusive window start..end (dates or datetimes) into consecutive
+    (first, last) windows of one day or one week, also inclusive.
+    """
+    step = timedelta(days=7 if unit == 'week' else 1)
+    shards = []
+    first = start
+    while first <= end:
+        last = min(first + step - timedelta(days=1), end)
+        shards.append((first, last))
+        first = last + timedelta(days=1)
+    return shards
+
+def _fetch_shard(question, params, max_attempts, expires_at):
+    """
+    One shard, retried while attempts and the time left before expires_at
+    (time.monotonic()) allow. expires_at=None: each attempt gets JOB_DEADLINE.
+    """
+    attempt = 0
+    while True:
+        attempt += 1
+        remaining = JOB_DEADLINE if expires_at is None else expires_at - time.monotonic()
+        if remaining <= 0:
+            raise MetabaseUnavailable(f"Deadline ran out before a shard of card {question} could be fetched")
+        try:
+            return get_dataset(question, params, deadline=remaining, snapshot=False)
+        except Exception as e:
+            if attempt >= max_attempts:
+                raise
+            wait = min(attempt * 2, 30)
+            # Not worth sleeping if the next attempt would have no time left
+            if expires_at is not None and expires_at - time.monotonic() <= wait:
+                raise MetabaseUnavailable(f"Deadline ran out retrying a shard of card {question}: {e}") from e
+            print(f"Shard of card {question} failed (attempt {attempt}/{max_attempts}): {e}; retrying in {wait} seconds")
+            time.sleep(wait)
+
+def iter_shards(question, shards, make_params, max_workers=SHARD_WORKERS, max_attempts=3,
+                progress=None, partial=False, deadline=JOB_DEADLINE):
+    """
+    Fetch one card for many (first, last) windows on a bounded thread pool and
+    yield ((first, last), rows) in the order of shards. make_params(first, last)
+    builds each shard's params. A failing shard is retried on its own up to
+    max_attempts times; if it still fails the error is raised, or its rows are
+    None with partial=True. deadline covers the whole call, not each shard:
+    every shard (and retry) only gets the time left, and MetabaseUnavailable
+    is raised for the shards that run out of it. Long backfills pass
+    deadline=None, which leaves the call unbounded and gives every attempt
+    JOB_DEADLINE.
+    Shards are not snapshotted on disk; callers snapshot the merged window.
+    Only a few shards run ahead of the consumer, so memory stays bounded.
+    progress(done, total, first, last) is called as each shard is yielded.
+    """
+    shards = list(shards)
+    expires_at = None if deadline is None else time.monotonic() + deadline
+    window = max_workers * SHARD_READ_AHEAD
+    pending = deque()
+    done = 0
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        def submit(shard):
+            params = make_params(*shard)
+            # Copy the context so the metrics still name the job or route that asked
+            future = executor.submit(contextvars.copy_context().run, _fetch_shard, question, params, max_attempts, expires_at)
+            pending.append((shard, future))
+
+        upcoming = iter(shards)
+        for shard in upcoming:
+            submit(shard)
+            if len(pending) >= window:
+                break
+
+        try:
+            while pending:
+                shard, future = pending.popleft()
+                try:
+                    rows = future.result()
+                except Exception as e:
+                    if not partial:
+                        raise
+                    print(f"Giving up on card {question} for {shard[0]:%Y-%m-%d}..{shard[1]:%Y-%m-%d}: {e}")
+                    rows = None
+                next_shard = next(upcoming, None)
+                if next_shard is not None:
+                    submit(next_shard)
+
+                done += 1
+                if progress is not None:
+                    progress(done, len(shards), *shard)
+                yield shard, rows
+        finally:
+            for _, future in pending:
+                future.cancel()
+
+def fetch_date_range(question, start, end, make_params, unit='day', **kwargs):
+    """
+    Fetch a card over a long date window as parallel day or week shards (see
+    iter_shards) and return all rows merged in date order.
+    """
+    rows = []
+    for _, shard_rows in iter_shards(question, date_shards(start, end, unit), make_params, **kwargs):
+        rows.extend(shard_rows or [])
+    return rows
 
 def process_data(inputs):
 
@@ -106,5 +818,3 @@ def process_data(inputs):
             params.append(param)
 
     return {'parameters': json.dumps(params)}
-
-print(create_metabase_token())
\ No newline at end of file
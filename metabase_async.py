@@ -0,0 +1,168 @@
+import asyncio
+import json
+import time
+import aiohttp
+from metabase import get_client, breaker, iter_decoded, MetabaseUnavailable, JOB_DEADLINE, ACCEPT_ENCODING
+from metabase_cache import get_cached, set_cached, get_stale
+from metabase_metrics import CardCallMetrics
+
+# Card queries allowed in flight at once against Metabase
+DEFAULT_CONCURRENCY = 4
+
+def _timing_trace_config():
+    """Fill the request's trace_request_ctx dict with connect time and time to headers."""
+    async def on_request_start(session, ctx, params):
+        ctx.trace_request_ctx['sent_at'] = time.perf_counter()
+        ctx.trace_request_ctx['connect'] = 0.0
+
+    async def on_connection_create_start(session, ctx, params):
+        ctx.trace_request_ctx['connect_started'] = time.perf_counter()
+
+    async def on_connection_create_end(session, ctx, params):
+        ctx.trace_request_ctx['connect'] += time.perf_counter() - ctx.trace_request_ctx['connect_started']
+
+    async def on_request_end(session, ctx, params):
+        ctx.trace_request_ctx['headers_at'] = time.perf_counter()
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_connection_create_start.append(on_connection_create_start)
+    trace_config.on_connection_create_end.append(on_connection_create_end)
+    trace_config.on_request_end.append(on_request_end)
+    return trace_config
+
+class AsyncMetabaseClient:
+    """
+    asyncio counterpart of get_dataset. Shares the session token of the
+    process-wide MetabaseClient and the Redis card cache, and caps the number
+    of concurrent card queries with a semaphore.
+    """
+
+    def __init__(self, max_concurrency=DEFAULT_CONCURRENCY):
+        self.sync_client = get_client()
+        self.endpoint = self.sync_client.endpoint
+        self.max_concurrency = max_concurrency
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.session = None
+
+    async def __aenter__(self):
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.max_concurrency),
+            timeout=aiohttp.ClientTimeout(sock_connect=30, sock_read=90),
+            trace_configs=[_timing_trace_config()],
+            headers={'Accept-Encoding': ACCEPT_ENCODING},
+            # Bodies are decompressed by iter_decoded so the transferred size can be measured
+            auto_decompress=False
+        )
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.session.close()
+
+    async def _get_token(self, rejected_token=None):
+        return await asyncio.to_thread(self.sync_client.get_token, rejected_token)
+
+    async def _request(self, url, params, token, timeout, metrics):
+        timing = {}
+        async with self.session.post(url, json=params, headers={'X-Metabase-Session': token},
+                                     timeout=timeout, trace_request_ctx=timing) as res:
+            if res.status != 200:
+                return res.status, await res.text()
+            wire_chunks = [chunk async for chunk in res.content.iter_chunked(64 * 1024)]
+            body = b''.join(iter_decoded(wire_chunks, res.headers.get('Content-Encoding'), metrics))
+            headers_at = timing.get('headers_at', time.perf_counter())
+            metrics.response_received(timing.get('connect', 0.0), headers_at - timing.get('sent_at', headers_at))
+            metrics.download = time.perf_counter() - headers_at
+            return res.status, json.loads(body)
+
+    async def _post_card(self, question, params, timeout, metrics):
+        url = f"{self.endpoint}/api/card/{question}/query/json"
+        token = await self._get_token()
+        status, body = await self._request(url, params, token, timeout, metrics)
+        if status == 401:
+            token = await self._get_token(rejected_token=token)
+            status, body = await self._request(url, params, token, timeout, metrics)
+        return status, body
+
+    async def get_dataset(self, question, params={}, refresh=False, deadline=JOB_DEADLINE):
+        """Same semantics as metabase.get_dataset, without blocking the event loop."""
+        metrics = CardCallMetrics(question)
+        if not refresh:
+            cached = await asyncio.to_thread(get_cached, question, params)
+            if cached is not None:
+                print(f"Card {question} served from cache")
+                await asyncio.to_thread(metrics.record, 'hit', len(cached))
+                return cached
+
+        expires_at = time.monotonic() + deadline
+        try:
+            async with self.semaphore:
+                dataset = await self._fetch(question, params, expires_at, metrics)
+        except MetabaseUnavailable as e:
+            stale = await asyncio.to_thread(get_stale, question, params)
+            if stale is None:
+                await asyncio.to_thread(metrics.record, 'error')
+                raise
+            print(f"{e}; serving stale cached result for card {question}")
+            await asyncio.to_thread(metrics.record, 'stale', len(stale))
+            return stale
+
+        await asyncio.to_thread(metrics.record, 'miss', len(dataset))
+        return dataset
+
+    async def _fetch(self, question, params, expires_at, metrics):
+        attempt = 0
+        while True:
+            remaining = expires_at - time.monotonic()
+            if remaining <= 0:
+                raise MetabaseUnavailable(f"No time left to query card {question} ({attempt} attempts)")
+            if not breaker.allow():
+                raise MetabaseUnavailable(f"Metabase circuit breaker is open, card {question} not queried")
+
+            attempt += 1
+            try:
+                print(f"Attempt {attempt} to fetch card {question} from Metabase (async)...")
+                timeout = aiohttp.ClientTimeout(total=remaining, sock_connect=min(30, remaining), sock_read=min(90, remaining))
+                status, body = await self._post_card(question, params, timeout, metrics)
+                if status == 200:
+                    metrics.attempts = attempt
+                    breaker.record_success()
+                    sizes = await asyncio.to_thread(set_cached, question, params, body)
+                    if sizes is not None:
+                        metrics.cache_raw_bytes, metrics.cache_bytes = sizes
+                    return body
+                print(f"Error response from Metabase for card {question}: {body}")
+                # A 4xx still means Metabase is up; only server errors count against it
+                if status >= 500:
+                    breaker.record_failure()
+                else:
+                    breaker.record_success()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                print(f"Network error on attempt {attempt} for card {question}: {str(e)}")
+                breaker.record_failure()
+            except Exception as e:
+                print(f"Unexpected error on attempt {attempt} for card {question}: {str(e)}")
+                breaker.record_failure()
+
+            if breaker.state == 'open':
+                raise MetabaseUnavailable(f"Metabase circuit breaker opened while querying card {question}")
+            wait = min(attempt * 2, 30)  # Cap wait time at 30 seconds
+            if time.monotonic() + wait >= expires_at:
+                raise MetabaseUnavailable(f"Metabase did not answer card {question} in time ({attempt} attempts)")
+            print(f"Retrying in {wait} seconds...")
+            await asyncio.sleep(wait)
+
+async def gather_datasets(queries, max_concurrency=DEFAULT_CONCURRENCY, refresh=False, deadline=JOB_DEADLINE):
+    async with AsyncMetabaseClient(max_concurrency) as client:
+        return await asyncio.gather(
+            *(client.get_dataset(question, params, refresh=refresh, deadline=deadline) for question, params in queries)
+        )
+
+def fetch_many(queries, max_concurrency=DEFAULT_CONCURRENCY, refresh=False, deadline=JOB_DEADLINE):
+    """
+    Fetch a list of (card, params) concurrently and return the datasets in the
+    same order. Blocking wrapper for the scheduler jobs and Flask routes.
+    deadline applies to each query, counted from the start of the batch;
+    MetabaseUnavailable is raised if any of them has no result by then.
+    """
+    return asyncio.run(gather_datasets(queries, max_concurrency=max_concurrency, refresh=refresh, deadline=deadline))
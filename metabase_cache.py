@@ -0,0 +1,201 @@
+import json
+import zlib
+import time
+import threading
+import uuid
+import hashlib
+from redis_connection import get_redis_binary_connection
+
+# Seconds a card result stays fresh in Redis. Cards not listed here are never cached.
+CARD_CACHE_TTL = {
+    '2954': 60,     # store status (job_store_status, every minute)
+    '3920': 60,     # LF stock movements (job_lfbot, every minute)
+    '9845': 30,     # inventory search by bin
+    '11808': 60,    # tote livre (three routes share it)
+    '1496': 300,    # month-to-date orders (incentivos / SLAporDia)
+    '1485': 300,    # month-to-date receipts
+    '3509': 3600,   # remocoes
+}
+
+CACHE_KEY_PREFIX = "metabase:card"
+
+# A second copy of each cached result outlives its TTL, to be served while Metabase is down
+STALE_TTL = 24 * 3600
+
+def canonical_params(params):
+    """
+    Serialize get_dataset params so that equal queries give equal strings,
+    whatever the order process_data received its inputs in.
+    """
+    params = dict(params or {})
+    parameters = params.pop('parameters', [])
+    if isinstance(parameters, str):
+        parameters = json.loads(parameters)
+    parameters = sorted(parameters, key=lambda p: json.dumps(p.get('target'), sort_keys=True))
+    return json.dumps({'parameters': parameters, **params}, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+
+def cache_key(question, params):
+    digest = hashlib.sha1(canonical_params(params).encode('utf-8')).hexdigest()
+    return f"{CACHE_KEY_PREFIX}:{question}:{digest}"
+
+def is_cacheable(question):
+    return str(question) in CARD_CACHE_TTL
+
+def serialize_payload(dataset):
+    return json.dumps(dataset, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+def compress_payload(dataset):
+    return zlib.compress(serialize_payload(dataset), 6)
+
+def decompress_payload(payload):
+    return json.loads(zlib.decompress(payload).decode('utf-8'))
+
+def get_cached(question, params):
+    """Return the cached rows for this card and params, or None on a miss."""
+    if not is_cacheable(question):
+        return None
+    try:
+        payload = get_redis_binary_connection().get(cache_key(question, params))
+        if payload is None:
+            return None
+        return decompress_payload(payload)
+    except Exception as e:
+        print(f"Error reading Metabase cache for card {question}: {e}")
+        return None
+
+def set_cached(question, params, dataset):
+    """Store the rows compressed; returns (JSON bytes, stored bytes), or None when nothing was stored."""
+    if not is_cacheable(question):
+        return None
+    try:
+        key = cache_key(question, params)
+        raw = serialize_payload(dataset)
+        payload = zlib.compress(raw, 6)
+        pipe = get_redis_binary_connection().pipeline(transaction=False)
+        pipe.setex(key, CARD_CACHE_TTL[str(question)], payload)
+        pipe.setex(f"{key}:stale", STALE_TTL, payload)
+        pipe.execute()
+        return len(raw), len(payload)
+    except Exception as e:
+        print(f"Error writing Metabase cache for card {question}: {e}")
+        return None
+
+def get_stale(question, params):
+    """Return the last result stored for this card and params, however old, or None."""
+    if not is_cacheable(question):
+        return None
+    try:
+        payload = get_redis_binary_connection().get(f"{cache_key(question, params)}:stale")
+        return decompress_payload(payload) if payload is not None else None
+    except Exception as e:
+        print(f"Error reading stale Metabase cache for card {question}: {e}")
+        return None
+
+# Cross-worker single flight: the worker holding a card's fetch lock queries
+# Metabase, and workers that asked for the same card meanwhile wait for its
+# result on a short-lived handoff key instead of sending their own request
+# The holder renews its lock (and the waiters count) every third of the TTL while
+# it fetches, so a fetch longer than the TTL (JOB_DEADLINE is 300s) keeps it;
+# the TTL only frees the lock of a worker that died
+FETCH_LOCK_TTL_MS = 180000
+LOCK_RENEW_INTERVAL = FETCH_LOCK_TTL_MS / 3000
+HANDOFF_TTL = 30
+LOCK_POLL_INTERVAL = 0.25
+
+# Delete the lock only if we still hold it (it may have expired and been retaken)
+_RELEASE_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+# Extend the lock and the waiters key only while we still hold the lock
+_EXTEND_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    redis.call('pexpire', KEYS[1], ARGV[2])
+    redis.call('pexpire', KEYS[2], ARGV[2])
+    return 1
+end
+return 0
+"""
+
+def _keep_lock(r, lock_key, waiters_key, token, stop):
+    """Renew the fetch lock until stop is set or the lock is lost."""
+    while not stop.wait(LOCK_RENEW_INTERVAL):
+        try:
+            if not r.eval(_EXTEND_LOCK_SCRIPT, 2, lock_key, waiters_key, token, FETCH_LOCK_TTL_MS):
+                return
+        except Exception as e:
+            print(f"Error renewing Metabase fetch lock {lock_key}: {e}")
+            return
+
+def _wait_for_handoff(r, key, holder, deadline):
+    """Wait for the lock holder's result; None when it released the lock without one."""
+    handoff_key = f"{key}:result:{holder.decode()}"
+    waiters_key = f"{key}:waiters:{holder.decode()}"
+    r.incr(waiters_key)
+    r.pexpire(waiters_key, FETCH_LOCK_TTL_MS)
+
+    while time.monotonic() < deadline:
+        payload, current_holder = r.mget(handoff_key, f"{key}:lock")
+        if payload is not None:
+            return decompress_payload(payload)
+        if current_holder != holder:
+            payload = r.get(handoff_key)
+            return decompress_payload(payload) if payload is not None else None
+        time.sleep(LOCK_POLL_INTERVAL)
+    return None
+
+def fetch_shared(question, params, fetch, max_wait=None):
+    """
+    Run fetch() for this card and params in one gunicorn worker at a time.
+    Workers that find the fetch lock taken wait for the holder's result (at
+    most max_wait seconds); if the holder fails they take the lock and fetch
+    themselves. Falls back to a plain fetch() when Redis is unavailable.
+    """
+    key = cache_key(question, params)
+    lock_key = f"{key}:lock"
+    token = uuid.uuid4().hex
+    # The lock is renewed while its holder fetches, so waiters can wait their whole deadline
+    wait = FETCH_LOCK_TTL_MS / 1000 if max_wait is None else max_wait
+    deadline = time.monotonic() + wait
+
+    try:
+        r = get_redis_binary_connection()
+        while not r.set(lock_key, token, nx=True, px=FETCH_LOCK_TTL_MS):
+            if time.monotonic() >= deadline:
+                print(f"Gave up waiting for another worker's fetch of card {question}")
+                r = None
+                break
+            holder = r.get(lock_key)
+            if holder is None:
+                continue
+            print(f"Card {question} is being fetched by another worker, waiting for its result")
+            dataset = _wait_for_handoff(r, key, holder, deadline)
+            if dataset is not None:
+                return dataset
+    except Exception as e:
+        print(f"Error coordinating Metabase fetch for card {question}: {e}")
+        r = None
+
+    if r is None:
+        return fetch()
+
+    stop_renewing = threading.Event()
+    threading.Thread(target=_keep_lock, args=(r, lock_key, f"{key}:waiters:{token}", token, stop_renewing),
+                     daemon=True).start()
+    try:
+        dataset = fetch()
+        try:
+            if r.get(f"{key}:waiters:{token}"):
+                r.setex(f"{key}:result:{token}", HANDOFF_TTL, compress_payload(dataset))
+        except Exception as e:
+            print(f"Error handing off Metabase result for card {question}: {e}")
+        return dataset
+    finally:
+        stop_renewing.set()
+        try:
+            r.eval(_RELEASE_LOCK_SCRIPT, 1, lock_key, token)
+        except Exception as e:
+            print(f"Error releasing Metabase fetch lock for card {question}: {e}")
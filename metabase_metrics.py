@@ -0,0 +1,201 @@
+import time
+import threading
+import contextvars
+from functools import wraps
+from datetime import datetime, timedelta
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from redis_connection import get_redis_connection
+
+# Rolling metrics: one Redis hash per hour, kept for METRICS_RETENTION_HOURS
+METRICS_KEY_PREFIX = "metabase:metrics"
+METRICS_RETENTION_HOURS = 48
+
+# Upper bounds (ms) of the wall-time histogram buckets; the last one catches everything
+LATENCY_BUCKETS_MS = [50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000, float('inf')]
+
+COUNTERS = ['calls', 'hit', 'miss', 'stale', 'coalesced', 'error', 'retries', 'rows', 'bytes', 'wire_bytes',
+            'saved_bytes', 'cache_raw_bytes', 'cache_bytes', 'wall_ms', 'connect_ms', 'server_ms', 'download_ms']
+
+# Who is asking for the card: "job:<function>" or "route:<endpoint>"
+current_caller = contextvars.ContextVar('metabase_caller', default='unknown')
+
+def set_caller(name):
+    current_caller.set(name)
+
+def track_caller(func):
+    """Decorator for scheduler jobs: Metabase calls made inside are attributed to job:<name>."""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        token = current_caller.set(f"job:{func.__name__}")
+        try:
+            return func(*args, **kwargs)
+        finally:
+            current_caller.reset(token)
+    return wrapper
+
+# Seconds spent opening TCP/TLS connections on this thread; read around each request
+_connect_time = threading.local()
+
+def take_connect_time():
+    elapsed = getattr(_connect_time, 'seconds', 0.0)
+    _connect_time.seconds = 0.0
+    return elapsed
+
+class _TimedConnectMixin:
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            super().connect()
+        finally:
+            _connect_time.seconds = getattr(_connect_time, 'seconds', 0.0) + time.perf_counter() - start
+
+class TimedHTTPConnection(_TimedConnectMixin, HTTPConnection):
+    pass
+
+class TimedHTTPSConnection(_TimedConnectMixin, HTTPSConnection):
+    pass
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+class TimedHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter whose connections record how long connecting took (see take_connect_time)."""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': TimedHTTPConnectionPool,
+            'https': TimedHTTPSConnectionPool,
+        }
+
+class CardCallMetrics:
+    """
+    Measurements for one get_dataset-style call. The fetch code fills in the
+    phases; record() writes them to the hourly Redis histogram.
+    outcome is hit / miss / stale / coalesced (joined another in-flight call) / error.
+    """
+
+    def __init__(self, question):
+        self.question = str(question)
+        self.caller = current_caller.get()
+        self.started = time.perf_counter()
+        self.outcome = 'coalesced'
+        self.attempts = 0
+        self.connect = 0.0
+        self.server = 0.0
+        self.download = 0.0
+        self.bytes = 0          # decompressed response body
+        self.wire_bytes = 0     # body as transferred (compressed when Metabase gzips it)
+        self.saved_bytes = 0    # dropped by a column allow-list
+        self.cache_raw_bytes = 0  # JSON written to the card cache, before and after zlib
+        self.cache_bytes = 0
+        self.rows = 0
+
+    def response_received(self, connect, elapsed):
+        """Headers of the successful response arrived; elapsed counts from sending the request."""
+        self.connect = connect
+        self.server = max(elapsed - connect, 0.0)
+
+    def record(self, outcome=None, rows=None):
+        if outcome is not None:
+            self.outcome = outcome
+        if rows is not None:
+            self.rows = rows
+        wall_ms = (time.perf_counter() - self.started) * 1000
+        prefix = f"{self.question}|{self.caller}|"
+        bucket = next(bound for bound in LATENCY_BUCKETS_MS if wall_ms <= bound)
+
+        try:
+            key = f"{METRICS_KEY_PREFIX}:{datetime.now():%Y%m%d%H}"
+            pipe = get_redis_connection().pipeline(transaction=False)
+            pipe.hincrby(key, prefix + 'calls', 1)
+            pipe.hincrby(key, prefix + self.outcome, 1)
+            pipe.hincrby(key, prefix + 'retries', max(self.attempts - 1, 0))
+            pipe.hincrby(key, prefix + 'rows', self.rows)
+            pipe.hincrby(key, prefix + 'bytes', self.bytes)
+            pipe.hincrby(key, prefix + 'wire_bytes', self.wire_bytes)
+            pipe.hincrby(key, prefix + 'saved_bytes', self.saved_bytes)
+            pipe.hincrby(key, prefix + 'cache_raw_bytes', self.cache_raw_bytes)
+            pipe.hincrby(key, prefix + 'cache_bytes', self.cache_bytes)
+            pipe.hincrbyfloat(key, prefix + 'wall_ms', round(wall_ms, 1))
+            pipe.hincrbyfloat(key, prefix + 'connect_ms', round(self.connect * 1000, 1))
+            pipe.hincrbyfloat(key, prefix + 'server_ms', round(self.server * 1000, 1))
+            pipe.hincrbyfloat(key, prefix + 'download_ms', round(self.download * 1000, 1))
+            pipe.hincrby(key, prefix + f"le_{bucket}", 1)
+            pipe.expire(key, METRICS_RETENTION_HOURS * 3600)
+            pipe.execute()
+        except Exception as e:
+            print(f"Error recording Metabase metrics for card {self.question}: {e}")
+
+def _percentile(buckets, total, fraction):
+    """Upper bound of the histogram bucket holding the given fraction of calls."""
+    seen = 0
+    for bound in LATENCY_BUCKETS_MS:
+        seen += buckets.get(bound, 0)
+        if total and seen >= fraction * total:
+            return None if bound == float('inf') else bound
+    return None
+
+def load_metrics(hours=24):
+    """
+    Aggregate the last `hours` hourly buckets per card and caller, sorted by
+    the total wall time they cost (the cards that dominate come first).
+    """
+    r = get_redis_connection()
+    now = datetime.now()
+    keys = [f"{METRICS_KEY_PREFIX}:{now - timedelta(hours=h):%Y%m%d%H}" for h in range(hours)]
+    pipe = r.pipeline(transaction=False)
+    for key in keys:
+        pipe.hgetall(key)
+
+    totals = {}
+    for bucket in pipe.execute():
+        for field, value in bucket.items():
+            question, caller, name = field.split('|', 2)
+            entry = totals.setdefault((question, caller), {'counters': dict.fromkeys(COUNTERS, 0), 'buckets': {}})
+            if name.startswith('le_'):
+                bound = float(name[3:])
+                entry['buckets'][bound] = entry['buckets'].get(bound, 0) + int(value)
+            else:
+                entry['counters'][name] = entry['counters'].get(name, 0) + float(value)
+
+    cards = []
+    for (question, caller), entry in totals.items():
+        c = entry['counters']
+        calls = int(c['calls']) or 1
+        fetched = int(c['miss']) or 1
+        cards.append({
+            'card': question,
+            'caller': caller,
+            'calls': int(c['calls']),
+            'cache_hits': int(c['hit']),
+            'cache_misses': int(c['miss']),
+            'stale': int(c['stale']),
+            'coalesced': int(c['coalesced']),
+            'errors': int(c['error']),
+            'hit_rate': round(c['hit'] / calls, 3),
+            'retries': int(c['retries']),
+            'total_wall_s': round(c['wall_ms'] / 1000, 1),
+            'avg_wall_ms': round(c['wall_ms'] / calls, 1),
+            'p50_wall_ms': _percentile(entry['buckets'], c['calls'], 0.5),
+            'p95_wall_ms': _percentile(entry['buckets'], c['calls'], 0.95),
+            # Phase averages are over calls that actually went to Metabase
+            'avg_connect_ms': round(c['connect_ms'] / fetched, 1),
+            'avg_server_ms': round(c['server_ms'] / fetched, 1),
+            'avg_download_ms': round(c['download_ms'] / fetched, 1),
+            'avg_bytes': int(c['bytes'] / fetched),
+            'avg_wire_bytes': int(c['wire_bytes'] / fetched),
+            'avg_saved_bytes': int(c['saved_bytes'] / fetched),
+            # Decompressed / transferred, and JSON / stored in the card cache
+            'transfer_ratio': round(c['bytes'] / c['wire_bytes'], 2) if c['wire_bytes'] else None,
+            'cache_ratio': round(c['cache_raw_bytes'] / c['cache_bytes'], 2) if c['cache_bytes'] else None,
+            'avg_rows': int(c['rows'] / calls),
+        })
+
+    cards.sort(key=lambda card: card['total_wall_s'], reverse=True)
+    return cards
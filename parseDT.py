@@ -1,28 +1,82 @@
+import re
 from datetime import datetime
+from functools import lru_cache
 from dateutil import parser
+import numpy as np
 import os
 from dotenv import dotenv_values
 
 env_config = dotenv_values(".env")
 
-date_format = os.environ["DATE_FORMAT"] or env_config.get('DATE_FORMAT')
+date_format = env_config.get('DATE_FORMAT') or os.environ.get('DATE_FORMAT')
 
-date_format2 = os.environ["DATE_FORMAT2"] or env_config.get('DATE_FORMAT2')
+date_format2 = env_config.get('DATE_FORMAT2') or os.environ.get('DATE_FORMAT2')
+
+# The shapes Metabase returns: 2024-05-01, 2024-05-01T10:00, 2024-05-01T10:00:00,
+# with "T" or a space, up to 6 fraction digits and an optional Z or UTC offset.
+# The offset is dropped and the wall-clock time kept, like parser.parse(...).replace(tzinfo=None).
+_ISO_TIMESTAMP = re.compile(
+    r'(\d{4})-(\d{2})-(\d{2})'
+    r'(?:[T ](\d{2}):(\d{2})(?::(\d{2})(?:\.(\d{1,6}))?)?)?'
+    r'(?:Z|[+-]\d{2}(?::?\d{2})?)?$'
+)
+_TZ_SUFFIX = re.compile(r'(Z|[+-]\d{2}(?::?\d{2})?)$')
+
+# Distinct strings remembered; the same dates repeat a lot within a card (and across the fields of a row)
+PARSE_CACHE_SIZE = 65536
+
+def _parse_iso(date_str):
+    match = _ISO_TIMESTAMP.match(date_str)
+    if match is None:
+        return None
+    year, month, day, hour, minute, second, fraction = match.groups()
+    try:
+        return datetime(int(year), int(month), int(day), int(hour or 0), int(minute or 0), int(second or 0),
+                        int(fraction.ljust(6, '0')) if fraction else 0)
+    except ValueError:
+        return None
+
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def _parse_string(date_str):
+    parsed = _parse_iso(date_str)
+    if parsed is not None:
+        return parsed
+    for date_fmt in (date_format, date_format2):
+        if date_fmt:
+            try:
+                return datetime.strptime(date_str, date_fmt)
+            except ValueError:
+                pass
+    try:
+        # Anything else, the slow way
+        return parser.parse(date_str).replace(tzinfo=None)
+    except (ValueError, OverflowError) as e:
+        print(f"Warning: Unable to parse date: {date_str}, Error: {e}")
+        return None
 
 def parse_date(date_str):
     if date_str is None or date_str == "":
         return None
+    if isinstance(date_str, datetime):
+        return date_str.replace(tzinfo=None)
+    return _parse_string(date_str)
+
+def parse_date_array(values):
+    """
+    datetime64[us] array of a whole column of timestamp strings (None or ""
+    give NaT). The ISO shapes are converted by NumPy in one call; only when
+    some value is not ISO does the column go through parse_date.
+    """
+    normalized = []
+    for value in values:
+        if not value:
+            normalized.append('NaT')
+            continue
+        if isinstance(value, str) and len(value) > 10:
+            value = _TZ_SUFFIX.sub('', value).replace(' ', 'T', 1)
+        normalized.append(value)
     try:
-        # First try parsing as ISO format with timezone
-        return parser.parse(date_str).replace(tzinfo=None)
+        return np.array(normalized, dtype='datetime64[us]')
     except (ValueError, TypeError):
-        try:
-            # Then try the standard date format
-            return datetime.strptime(date_str, date_format)
-        except ValueError:
-            try:
-                # Finally try the alternate date format
-                return datetime.strptime(date_str, date_format2)
-            except ValueError as e:
-                print(f"Warning: Unable to parse date: {date_str}, Error: {e}")
-                return None 
\ No newline at end of file
+        parsed = (parse_date(value) for value in values)
+        return np.array([value if value is not None else 'NaT' for value in parsed], dtype='datetime64[us]')
@@ -1,85 +1,72 @@
 import re
+import numpy as np
 
-def parse_UF(zipcode: str) -> str:
-    zipcode = str(zipcode)
-    zipcode = re.sub("[^0-9]", "", zipcode)
-
-    if len(zipcode) < 3:
-        return None
-
-    if zipcode[0] == "1" or zipcode[0] == "0":
-        return "SP"
-
-
-    if zipcode[0] == "2":
-      if int(zipcode[0:2]) <= 28:
-          return "RJ"
-      else:
-        return "ES"
+# UF of every 3-digit CEP prefix, built once from the ranges below
+# (last prefix of the range, UF), in order.
+CEP_RANGES = [
+    (199, "SP"),
+    (289, "RJ"),
+    (299, "ES"),
+    (399, "MG"),
+    (489, "BA"),
+    (499, "SE"),
+    (569, "PE"),
+    (579, "AL"),
+    (589, "PB"),
+    (599, "RN"),
+    (639, "CE"),
+    (649, "PI"),
+    (659, "MA"),
+    (688, "PA"),
+    (689, "AP"),
+    (692, "AM"),
+    (693, "RR"),
+    (698, "AM"),
+    (699, "AC"),
+    (736, "DF"),
+    (767, "GO"),
+    (769, "RO"),
+    (779, "TO"),
+    (788, "MT"),
+    (799, "MS"),
+    (879, "PR"),
+    (899, "SC"),
+    (999, "RS"),
+]
 
-    if zipcode[0] == "3":
-        return "MG"
+def _build_table():
+    table = []
+    for last_prefix, uf in CEP_RANGES:
+        table.extend([uf] * (last_prefix + 1 - len(table)))
+    return table
 
-    if zipcode[0] == "4":
-      if int(zipcode[0:2]) <= 48:
-        return "BA"
-      else:
-        return "SE"
+UF_BY_PREFIX = _build_table()
+# Index -1 (fewer than 3 digits) maps to None
+_UF_TABLE = np.array(UF_BY_PREFIX + [None], dtype=object)
+_NON_DIGITS = re.compile("[^0-9]")
+_PLACE_VALUES = np.array([100, 10, 1])
 
-    if zipcode[0] == "5":
-      if int(zipcode[0:2]) <= 56:
-          return "PE"
-      elif int(zipcode[0:2]) == 57:
-          return "AL"
-      elif int(zipcode[0:2]) == 58:
-          return "PB"
-      elif int(zipcode[0:2]) == 59:
-          return "RN"
-
-    if zipcode[0] == "6":
-      if int(zipcode[0:2]) <= 63:
-          return "CE"
-      elif int(zipcode[0:2]) == 64:
-          return "PI"
-      elif int(zipcode[0:2]) == 65:
-          return "MA"
-      elif int(zipcode[0:3]) <= 688:
-          return "PA"
-      elif int(zipcode[0:3]) == 689:
-          return "AP"
-      elif int(zipcode[0:3]) <= 692:
-          return "AM"
-      elif int(zipcode[0:3]) == 693:
-          return "RR"
-      elif int(zipcode[0:3]) <= 698:
-          return "AM"
-      elif int(zipcode[0:3]) == 699:
-          return "AC"
-
-    if zipcode[0] == "7":
-      if int(zipcode[0:3]) <= 736:
-          return "DF"
-      elif int(zipcode[0:3]) <= 767:
-          return "GO"
-      elif int(zipcode[0:3]) <= 769:
-          return "RO"
-      elif int(zipcode[0:3]) <= 779:
-          return "TO"
-      elif int(zipcode[0:3]) <= 788:
-          return "MT"
-      elif int(zipcode[0:3]) <= 799:
-          return "MS"
-
-    if zipcode[0] == "8":
-      if int(zipcode[0:2]) <= 87:
-          return "PR"
-      else:
-          return "SC"
+def _prefix(zipcode):
+    """First 3 digits of the zip code as an int, -1 when it has fewer."""
+    zipcode = str(zipcode)
+    head = zipcode[:3]
+    if len(head) == 3 and head.isascii() and head.isdigit():
+        return int(head)
+    digits = _NON_DIGITS.sub("", zipcode)
+    return int(digits[:3]) if len(digits) >= 3 else -1
 
-    if zipcode[0] == "9":
-      return "RS"
-    
-    else:
-        return "ZZ"
+def parse_UF(zipcode: str) -> str:
+    prefix = _prefix(zipcode)
+    return UF_BY_PREFIX[prefix] if prefix >= 0 else None
 
-    return None
+def parse_UF_array(zipcodes):
+    """parse_UF of a whole array of zip codes: object array of UF codes (None for fewer than 3 digits)."""
+    heads = np.asarray(zipcodes).astype(str).astype('U3')
+    # Code points of the first 3 characters, 0 past the end of shorter strings
+    codes = heads.view(np.uint32).reshape(len(heads), 3).astype(np.int64) - ord('0')
+    clean = ((codes >= 0) & (codes <= 9)).all(axis=1)
+    prefixes = np.where(clean, codes @ _PLACE_VALUES, -1)
+    for row in np.flatnonzero(~clean):
+        # Separators or spaces in the first 3 characters
+        prefixes[row] = _prefix(zipcodes[row])
+    return _UF_TABLE[prefixes]
@@ -20,3 +20,15 @@ redis_pool = redis.ConnectionPool(
 
 def get_redis_connection():
     return redis.Redis(connection_pool=redis_pool)
+
+# Raw-bytes pool for binary payloads (compressed caches); the pool above decodes to str
+redis_binary_pool = redis.ConnectionPool(
+    host=redis_end,
+    port=redis_port,
+    password=redis_password,
+    db=0,
+    decode_responses=False
+)
+
+def get_redis_binary_connection():
+    return redis.Redis(connection_pool=redis_binary_pool)
@@ -7,7 +7,7 @@ from google_auth_oauthlib.flow import InstalledAppFlow
 from redis_connection import get_redis_connection
 from google.auth.exceptions import RefreshError
 import time
-from metabase import get_dataset
+from metabase import get_dataset, JOB_DEADLINE
 from parseDT import parse_date
 from google_auth import authenticate_google
 from dotenv import dotenv_values
@@ -19,9 +19,9 @@ redis_client = get_redis_connection()
 drive_service = authenticate_google('drive')
 
 
-def get_remocoes():
+def get_remocoes(refresh=False, deadline=JOB_DEADLINE):
     """Get and process removal orders from the dataset"""
-    remocoes = get_dataset('3509')
+    remocoes = get_dataset('3509', refresh=refresh, deadline=deadline)
     processed_remocoes = []
     
     # Get the set of removed order IDs from Redis
@@ -8,7 +8,8 @@ from google.oauth2.credentials import Credentials
 from google_auth import authenticate_google
 from redis_connection import get_redis_connection
 # Import the metabase functions
-from metabase import get_dataset, process_data
+from business_calendar import is_holiday, is_business_day, roll_past_cutoff
+from metabase import get_dataset, process_data, iter_shards
 
 # Get the Redis client from the shared connection
 redis_client = get_redis_connection()
@@ -42,10 +43,6 @@ def get_google_sheet(sheet_url, sheet_name):
 # def get_dataset(question, params={}): ...
 # def process_data(inputs): ...
 
-holidays = ["2024-01-01","2024-01-25","2024-02-12","2024-03-29","2024-04-21","2024-05-01",
-        "2024-05-30","2024-07-09","2024-09-07","2024-10-12","2024-11-02","2024-11-15",
-        "2024-11-20","2024-12-25","2024-12-31"]
-
 def adjust_shipping_date(shipping_date, carrier):
     cut_off_hours = {
         'CUBBO': (16, 30),
@@ -56,23 +53,14 @@ def adjust_shipping_date(shipping_date, carrier):
         'JT Express': (16, 0)
     }
 
-    hour, minute = cut_off_hours.get(carrier, cut_off_hours['LOGGI'])
-
-    if (shipping_date.hour > hour or
-        (shipping_date.hour == hour and shipping_date.minute >= minute) or
-        shipping_date.weekday() >= 5 or
-        shipping_date.strftime('%Y-%m-%d') in holidays):
-
-        while True:
-            shipping_date += timedelta(days=1)
-            if (shipping_date.weekday() < 5 and
-                shipping_date.strftime('%Y-%m-%d') not in holidays):
-                break
-
-    return shipping_date
+    # Past the cutoff, on a weekend or on a holiday: next business day, same time
+    return roll_past_cutoff(shipping_date, cut_off_hours.get(carrier, cut_off_hours['LOGGI']))
 
 print("1 feito")
 
+# Days fetched in parallel when rebuilding the history
+HISTORY_WORKERS = 4
+
 def ajuste_pendentes(only_process_today=True, max_day_retries=5):
     sorted_data = []
     
@@ -88,7 +76,7 @@ def ajuste_pendentes(only_process_today=True, max_day_retries=5):
         
         while current_date <= end_date:
             # Skip weekends and holidays for historical processing
-            if current_date.weekday() < 5 and current_date.strftime('%Y-%m-%d') not in holidays:
+            if is_business_day(current_date):
                 dates_to_process.append(current_date)
             current_date += timedelta(days=1)
         
@@ -101,23 +89,48 @@ def ajuste_pendentes(only_process_today=True, max_day_retries=5):
         # Log if it's a weekend or holiday, but still process
         if today.weekday() >= 5:
             print(f"Note: Today ({today.strftime('%d/%m/%Y')}) is a weekend, but still processing data")
-        elif today.strftime('%Y-%m-%d') in holidays:
+        elif is_holiday(today):
             print(f"Note: Today ({today.strftime('%d/%m/%Y')}) is a holiday, but still processing data")
         else:
             print("Processing today's data")
     
-    # Process each date individually
-    for day_to_process in dates_to_process:
-        day_data = process_single_day(day_to_process, max_retries=max_day_retries)
+    # Fetch the days in parallel (in order, a few ahead of processing), then
+    # process each date individually. A day whose fetch failed comes back as
+    # None and process_single_day fetches it again with its own retries.
+    # The backfill can outlast any one deadline, so only each day's fetch is
+    # bounded (deadline=None).
+    def report_progress(done, total, day, _):
+        if done % 20 == 0 or done == total:
+            print(f"Fetched {done}/{total} days (up to {day.strftime('%d/%m/%Y')})")
+
+    if len(dates_to_process) > 1:
+        days = iter_shards('6512', [(day, day) for day in dates_to_process], lambda day, _: day_inputs(day),
+                           max_workers=HISTORY_WORKERS, partial=True, progress=report_progress,
+                           deadline=None)
+    else:
+        days = [((day, day), None) for day in dates_to_process]
+
+    for (day_to_process, _), daily_orders in days:
+        day_data = process_single_day(day_to_process, max_retries=max_day_retries, prefetched=daily_orders)
         if day_data:
             sorted_data.extend(day_data)
     
     print(f"Finished processing. Total records: {len(sorted_data)}")
     return sorted_data
 
-def process_single_day(day_to_process, max_retries=5):
+def day_inputs(day_to_process):
+    # Use the imported process_data function - metabase.py expects actual datetime objects
+    return process_data({
+        'pending_at_start_date': day_to_process,
+        'pending_at_end_date': day_to_process + timedelta(days=1),
+        'wh': 4
+    })
+
+def process_single_day(day_to_process, max_retries=5, prefetched=None):
     """
     Process a single day with multiple retries if needed.
+    prefetched is the day's dataset when ajuste_pendentes already fetched it;
+    it is used for the first attempt only.
     Returns list of processed orders for the day.
     """
     day_data = []
@@ -128,17 +141,10 @@ def process_single_day(day_to_process, max_retries=5):
     while retry_count < max_retries:
         try:
             # Get data for just this one day
-            next_day = day_to_process + timedelta(days=1)
-            
-            # Use the imported process_data function - metabase.py expects actual datetime objects
-            incentivo_inputs = process_data({
-                'pending_at_start_date': day_to_process,
-                'pending_at_end_date': next_day,
-                'wh': 4
-            })
-            
-            # Increasing timeout for difficult queries
-            daily_orders = get_dataset('6512', incentivo_inputs)
+            if prefetched is not None:
+                daily_orders, prefetched = prefetched, None
+            else:
+                daily_orders = get_dataset('6512', day_inputs(day_to_process))
             
             # Check if we got valid data back
             if not daily_orders or not isinstance(daily_orders, list):
@@ -171,7 +177,7 @@ def process_single_day(day_to_process, max_retries=5):
                         print(f"Could not parse pending_at date: {order['pending_at']}, error: {e}")
                         continue
                 
-                if order['pending_at'].strftime('%Y-%m-%d') in holidays:
+                if is_holiday(order['pending_at']):
                     order['pending_at'] += timedelta(days=1)
                 
                 order['pending_at'] = adjust_shipping_date(order['pending_at'], order['carrier_name'])
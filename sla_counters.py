@@ -0,0 +1,231 @@
+import os
+import json
+import hashlib
+from collections import namedtuple, Counter
+from datetime import datetime
+import numpy as np
+from dotenv import dotenv_values
+from redis_connection import get_redis_connection
+from incremental_fetch import UPDATED_SINCE_TAG, next_watermark, watermark_clock
+from sla_engine import (order_columns, recibo_columns, order_states, recibo_states, cells, picked_cells,
+                        CellCounts, GRID_SIZE)
+
+env_config = dotenv_values(".env")
+
+# Month-to-date SLA counters kept in Redis, so a run only classifies the
+# orders and receipts that changed since the previous one. Opt-in: like
+# INCREMENTAL_FETCH, cards 1496 and 1485 must filter on UPDATED_SINCE_TAG.
+#
+# Per warehouse and month:
+#   sla:counters:<name>:<YYYY-MM>          hash of counts per sla_engine grid cell
+#                                          (o/oh orders and HITs, p picked, r/rh receipts and HITs);
+#                                          weeks overlap, so they are summed from the cells on read
+#   sla:counters:<name>:<YYYY-MM>:orders   order_number -> the state counted for it
+#   sla:counters:<name>:<YYYY-MM>:recibos  receipt id -> the state counted for it
+#   sla:counters:<name>:<YYYY-MM>:waiting  unshipped orders not counted until their pending_at, by timestamp
+#   sla:counters:<name>:<YYYY-MM>:meta     watermark and fingerprint of the exclusions and calendar
+# A new month, a changed fingerprint or a full reconcile rebuilds them from the full card results.
+SLA_COUNTERS = (env_config.get('SLA_COUNTERS') or os.environ.get('SLA_COUNTERS', '')) == '1'
+
+COUNTERS_KEY_PREFIX = "sla:counters"
+COUNTERS_TTL = 40 * 24 * 3600
+# Month the exclusions and payloads were last cleared for
+MONTH_KEY = "sla:month"
+
+CounterKeys = namedtuple('CounterKeys', ['counters', 'orders', 'recibos', 'waiting', 'meta'])
+
+def counter_keys(name, now):
+    base = f"{COUNTERS_KEY_PREFIX}:{name}:{now:%Y-%m}"
+    return CounterKeys(base, f"{base}:orders", f"{base}:recibos", f"{base}:waiting", f"{base}:meta")
+
+def month_rolled_over(now=None):
+    """True on the first call of a new month, for clearing the monthly exclusions and payloads."""
+    now = now or datetime.now()
+    try:
+        previous = get_redis_connection().getset(MONTH_KEY, f"{now:%Y-%m}")
+        # No month recorded yet (first deploy): start tracking without clearing anything
+        return previous is not None and previous != f"{now:%Y-%m}"
+    except Exception as e:
+        print(f"Error checking month rollover: {e}")
+        return False
+
+def fingerprint(profile, holidays, excluded_orders, excluded_recibos):
+    """Everything besides the rows that decides an outcome; when it changes the counters are rebuilt."""
+    inputs = [profile.wh, profile.recibo_wh, sorted(holidays),
+              sorted(str(order) for order in excluded_orders), sorted(str(recibo) for recibo in excluded_recibos)]
+    return hashlib.sha1(json.dumps(inputs).encode('utf-8')).hexdigest()
+
+def changes_since(profile, now, current_fingerprint, full=False):
+    """
+    Watermark to fetch the profile's changed rows from, or None when the
+    counters must be rebuilt from the full card results.
+    """
+    try:
+        meta = get_redis_connection().hgetall(counter_keys(profile.name, now).meta)
+    except Exception as e:
+        print(f"Error reading SLA counters of {profile.name}: {e}")
+        return None
+    if full or meta.get('fingerprint') != current_fingerprint:
+        return None
+    return meta.get('watermark')
+
+def delta_inputs(inputs, since):
+    return inputs if since is None else {**inputs, UPDATED_SINCE_TAG: since}
+
+def _order_state_strings(states, now):
+    """'cell,hit,picked cell' per row, prefixed with w while the order is waiting; '' when not counted."""
+    counted = states.kept | states.waiting
+    pending = states.pending[counted]
+    order_cells = cells(pending, now)
+    picked = ~np.isnat(states.picking[counted])
+    picking_cells = np.full(len(pending), -1)
+    picking_cells[picked] = picked_cells(pending[picked], states.picking[counted][picked], now)
+
+    result = [''] * len(counted)
+    for row, cell, hit, picking_cell, waiting in zip(np.flatnonzero(counted), order_cells, states.hit[counted],
+                                                     picking_cells, states.waiting[counted]):
+        result[row] = f"{'w' if waiting else ''}{cell},{int(hit)},{picking_cell}"
+    return result
+
+def _order_fields(state):
+    if not state or state.startswith('w'):
+        return []
+    cell, hit, picking_cell = state.split(',')
+    fields = [f"o:{cell}"]
+    if hit == '1':
+        fields.append(f"oh:{cell}")
+    if picking_cell != '-1':
+        fields.append(f"p:{picking_cell}")
+    return fields
+
+def _recibo_state_strings(states, now):
+    recibo_cells = cells(states.arrived[states.kept], now)
+    result = [''] * len(states.kept)
+    for row, cell, hit in zip(np.flatnonzero(states.kept), recibo_cells, states.hit[states.kept]):
+        result[row] = f"{cell},{int(hit)}"
+    return result
+
+def _recibo_fields(state):
+    if not state:
+        return []
+    cell, hit = state.split(',')
+    return [f"r:{cell}", f"rh:{cell}"] if hit == '1' else [f"r:{cell}"]
+
+def _diff(ids, new_states, old_states, fields):
+    """Counter increments and changed states between what was counted and what is now."""
+    increments = Counter()
+    changed = {}
+    for row_id, new, old in zip(ids, new_states, old_states):
+        old = old or ''
+        if new == old:
+            continue
+        for field in fields(old):
+            increments[field] -= 1
+        for field in fields(new):
+            increments[field] += 1
+        changed[row_id] = new
+    return increments, changed
+
+def _waiting_due(state_strings, states):
+    """Row -> pending_at timestamp of the waiting orders."""
+    due = states.pending.astype('datetime64[s]').astype(np.int64)
+    return {row: int(due[row]) for row, state in enumerate(state_strings) if state.startswith('w')}
+
+def apply_changes(profile, order_rows, recibo_rows, since, current_fingerprint, holidays,
+                  excluded_orders, excluded_recibos, run_started, fetch_started=None):
+    """
+    Classify the fetched rows and move the counters by the difference with
+    what was counted for them before. since=None means the rows are the full
+    month: the counters are rebuilt from them. fetch_started is the
+    incremental_fetch.watermark_clock() taken before the rows were fetched.
+    Returns the CellCounts.
+    """
+    r = get_redis_connection()
+    keys = counter_keys(profile.name, run_started)
+    rebuild = since is None
+
+    orders = order_columns(order_rows)
+    states = order_states(orders, profile.rules, holidays, excluded_orders, run_started)
+    order_ids = [str(number) for number in orders['order_number']]
+    new_orders = _order_state_strings(states, run_started)
+    recibos = recibo_columns(recibo_rows)
+    recibo_ids = [str(recibo_id) for recibo_id in recibos['id']]
+    new_recibos = _recibo_state_strings(recibo_states(recibos, excluded_recibos, run_started), run_started)
+
+    if rebuild:
+        old_orders = [None] * len(order_ids)
+        old_recibos = [None] * len(recibo_ids)
+    else:
+        old_orders = r.hmget(keys.orders, order_ids) if order_ids else []
+        old_recibos = r.hmget(keys.recibos, recibo_ids) if recibo_ids else []
+
+    increments, changed_orders = _diff(order_ids, new_orders, old_orders, _order_fields)
+    recibo_increments, changed_recibos = _diff(recibo_ids, new_recibos, old_recibos, _recibo_fields)
+    increments.update(recibo_increments)
+    waiting = _waiting_due(new_orders, states)
+
+    pipe = r.pipeline()
+    if rebuild:
+        pipe.delete(*keys)
+    for field, amount in increments.items():
+        if amount:
+            pipe.hincrby(keys.counters, field, amount)
+    if changed_orders:
+        pipe.hset(keys.orders, mapping=changed_orders)
+        no_longer_waiting = [order_id for order_id, state in changed_orders.items() if not state.startswith('w')]
+        if no_longer_waiting and not rebuild:
+            pipe.zrem(keys.waiting, *no_longer_waiting)
+    if waiting:
+        pipe.zadd(keys.waiting, {order_ids[row]: due for row, due in waiting.items()})
+    if changed_recibos:
+        pipe.hset(keys.recibos, mapping=changed_recibos)
+    pipe.hset(keys.meta, mapping={
+        'watermark': next_watermark([order_rows, recibo_rows], fetch_started or watermark_clock(), since),
+        'fingerprint': current_fingerprint
+    })
+    for key in keys:
+        pipe.expire(key, COUNTERS_TTL)
+    pipe.execute()
+
+    started_waiting = _count_due_waiting(r, keys, run_started)
+    print(f"SLA counters of {profile.name}: {'rebuilt from' if rebuild else 'applied'} {len(order_ids)} orders "
+          f"({len(changed_orders)} changed, {started_waiting} done waiting) and {len(recibo_ids)} receipts "
+          f"({len(changed_recibos)} changed)")
+    return load_counts(keys)
+
+def _count_due_waiting(r, keys, now):
+    """Start counting the waiting orders whose pending_at has passed."""
+    due = r.zrangebyscore(keys.waiting, '-inf', int(np.datetime64(now, 's').astype(np.int64)))
+    if not due:
+        return 0
+    increments = Counter()
+    changed = {}
+    for order_id, state in zip(due, r.hmget(keys.orders, due)):
+        if state and state.startswith('w'):
+            changed[order_id] = state[1:]
+            for field in _order_fields(state[1:]):
+                increments[field] += 1
+    pipe = r.pipeline()
+    for field, amount in increments.items():
+        pipe.hincrby(keys.counters, field, amount)
+    if changed:
+        pipe.hset(keys.orders, mapping=changed)
+    pipe.zrem(keys.waiting, *due)
+    pipe.execute()
+    return len(changed)
+
+def load_counts(keys):
+    arrays = {kind: np.zeros(GRID_SIZE, dtype=np.int64) for kind in ('o', 'oh', 'p', 'r', 'rh')}
+    for field, value in get_redis_connection().hgetall(keys.counters).items():
+        kind, cell = field.split(':')
+        arrays[kind][int(cell)] = int(value)
+    return CellCounts(arrays['o'], arrays['oh'], arrays['p'], arrays['r'], arrays['rh'])
+
+def reset_counters():
+    """Make the next run rebuild the counters of every warehouse from the full card results."""
+    r = get_redis_connection()
+    count = 0
+    for meta_key in r.scan_iter(f"{COUNTERS_KEY_PREFIX}:*:meta", count=1000):
+        r.hdel(meta_key, 'fingerprint')
+        count += 1
+    print(f"Reset {count} SLA counter stores")
@@ -0,0 +1,356 @@
+import os
+from collections import namedtuple
+from datetime import datetime
+import numpy as np
+from dotenv import dotenv_values
+from parseDT import parse_date_array
+from business_calendar import calendar_for
+
+# Vectorized version of the per-order SLA rules in incentivosEmbu/Extrema/POA.py.
+# Rows are turned into datetime64 arrays once, carrier cutoffs and shipping limits
+# become lookup arrays indexed by carrier code, HIT/MISS is a boolean mask and the
+# week buckets come from one np.bincount over (day of month, month vs current).
+# The quirks of the row-by-row code are kept on purpose so the numbers match:
+# years are never compared, weeks may overlap and every counter starts at 1.
+# SLA_ENGINE=legacy goes back to the row-by-row functions.
+
+env_config = dotenv_values(".env")
+
+SLA_ENGINE = (env_config.get('SLA_ENGINE') or os.environ.get('SLA_ENGINE', 'numpy')) != 'legacy'
+
+SLARules = namedtuple('SLARules', [
+    'cutoffs',             # carrier -> (hour, minute); orders pending from then on roll to the next business day
+    'default_cutoff',
+    'ship_limits',         # carrier -> last hour a same-day shipment is a HIT
+    'default_ship_limit',
+    'delayed_stores',      # stores whose orders count from 09:00 three days after pending_at
+    'skipped_stores',
+    'order_weeks',         # one predicate per week for incentivos_pedidos, weeks may overlap
+    'recibo_weeks',        # same for incentivos_recibo
+    'picking_weeks',       # first predicate that matches is the order's week; none matching skips it
+    'picking_hit_weeks',   # same for the picked-in-time orders, also given early (picked by the pending day)
+    'week_ends',           # last day of each week, for the month's averages
+])
+
+def _weeks(week_ends):
+    """Week predicates over (day, rel) of incentivos_pedidos/recibo; rel < 0 is an earlier month."""
+    bounds = list(zip(week_ends, week_ends[1:]))
+    return ([lambda day, rel, early: (day <= week_ends[0]) | (rel < 0)]
+            + [lambda day, rel, early, lo=lo, hi=hi: (day > lo) & (day <= hi) for lo, hi in bounds]
+            + [lambda day, rel, early: (day > week_ends[-1]) & (rel == 0)])
+
+def _picking_weeks(week_ends):
+    bounds = list(zip(week_ends, week_ends[1:]))
+    return ([lambda day, rel, early: (day <= week_ends[0]) | (rel < 0)]
+            + [lambda day, rel, early, lo=lo, hi=hi: (day > lo) & (day <= hi) & (rel == 0) for lo, hi in bounds])
+
+def _picking_hit_weeks(week_ends):
+    bounds = list(zip(week_ends, week_ends[1:]))
+    return ([lambda day, rel, early: (early & (day <= week_ends[0])) | (rel < 0)]
+            + [lambda day, rel, early, lo=lo, hi=hi: early & (day > lo) & (day <= hi) & (rel == 0) for lo, hi in bounds])
+
+MARCAS_DELAYED = {"FOSFORO", "Dois Pontos", "Boitempo", "Qura Editora", "TAG Livros"}
+
+EMBU_WEEK_ENDS = [8, 16, 24]
+EMBU = SLARules(
+    cutoffs={
+        'CUBBO': (16, 30),
+        'UELLO': (16, 0),
+        'CORREIOS': (14, 30),
+        'IMILE': (16, 0),
+        'LOGGI': (16, 0),
+        'Mercado Envíos': (14, 0),
+        'JT Express': (17, 0)
+    },
+    default_cutoff=(16, 0),
+    ship_limits={'CORREIOS': 15, 'IMILE': 17, 'CUBBO': 17, 'Mercado Envíos': 15,
+                 'Armazém': 18, 'Externo': 18, 'LOGGI': 18},
+    default_ship_limit=18,
+    delayed_stores=MARCAS_DELAYED,
+    skipped_stores={"TAG Livros"},
+    order_weeks=_weeks(EMBU_WEEK_ENDS),
+    recibo_weeks=_weeks(EMBU_WEEK_ENDS),
+    # Anything past the third week lands in the fourth, whatever the month
+    picking_weeks=_picking_weeks(EMBU_WEEK_ENDS) + [lambda day, rel, early: np.ones_like(day, dtype=bool)],
+    picking_hit_weeks=_picking_hit_weeks(EMBU_WEEK_ENDS) + [lambda day, rel, early: early & (day > 24)],
+    week_ends=EMBU_WEEK_ENDS,
+)
+
+EXTREMA = EMBU._replace(
+    cutoffs={
+        'CUBBO': (16, 30),
+        'UELLO': (16, 0),
+        'CORREIOS': (14, 0),
+        'TREGGO': (12, 30),
+        'LOGGI': (16, 30),
+        'Mercado Envíos': (13, 0),
+        'JT Express': (16, 0)
+    },
+    default_cutoff=(16, 30),
+    ship_limits={'CORREIOS': 13, 'TREGGO': 14, 'Mercado Envíos': 15, 'LOGGI': 17,
+                 'Armazém': 18, 'Externo': 18},
+)
+
+POA_WEEK_ENDS = [7, 14, 21, 28]
+POA = SLARules(
+    cutoffs={
+        'CUBBO': (16, 0),
+        'UELLO': (16, 0),
+        'CORREIOS': (14, 30),
+        'IMILE': (16, 0),
+        'LOGGI': (16, 0),
+        'Mercado Envíos': (14, 0),
+        'JT Express': (17, 0)
+    },
+    default_cutoff=(16, 0),
+    ship_limits={'CUBBO': 23},
+    default_ship_limit=18,
+    delayed_stores=set(),
+    skipped_stores=set(),
+    # incentivos_pedidos of POA counts days 8-16 in its second week, overlapping the third
+    order_weeks=[lambda day, rel, early: (day <= 7) | (rel < 0),
+                 lambda day, rel, early: (day > 7) & (day <= 16),
+                 lambda day, rel, early: (day > 14) & (day <= 21),
+                 lambda day, rel, early: (day > 21) & (day <= 28),
+                 lambda day, rel, early: (day > 28) & (rel == 0)],
+    recibo_weeks=_weeks(POA_WEEK_ENDS),
+    picking_weeks=_picking_weeks(POA_WEEK_ENDS) + [lambda day, rel, early: (day > 28) & (rel == 0)],
+    picking_hit_weeks=_picking_hit_weeks(POA_WEEK_ENDS) + [lambda day, rel, early: early & (day > 28) & (rel == 0)],
+    week_ends=POA_WEEK_ENDS,
+)
+
+# Every (day, rel, early) combination, in bincount code order
+_GRID_DAY, _GRID_REL, _GRID_EARLY = (axis.ravel() for axis in np.meshgrid(
+    np.arange(1, 32), np.array([-1, 0, 1]), np.array([False, True]), indexing='ij'))
+GRID_SIZE = _GRID_DAY.size
+
+Orders = namedtuple('Orders', ['pending', 'hit', 'picking'])
+OrderStates = namedtuple('OrderStates', ['kept', 'waiting', 'pending', 'hit', 'picking'])
+Recibos = namedtuple('Recibos', ['arrived', 'hit'])
+ReciboStates = namedtuple('ReciboStates', ['kept', 'arrived', 'hit'])
+# Counts per grid cell; the weekly numbers are sums over the cells of each week
+CellCounts = namedtuple('CellCounts', ['orders', 'order_hits', 'picked', 'recibos', 'recibo_hits'])
+
+def _timestamps(values):
+    """datetime64[us] array of timestamp strings, parse_date per value only for non-ISO formats."""
+    return parse_date_array(values)
+
+def _parts(timestamps):
+    """Month, day of month and hour arrays of a datetime64 array."""
+    days = timestamps.astype('datetime64[D]')
+    months = timestamps.astype('datetime64[M]')
+    month = (months - timestamps.astype('datetime64[Y]')).astype(np.int64) + 1
+    day = (days - months).astype(np.int64) + 1
+    hour = (timestamps - days).astype('timedelta64[h]').astype(np.int64)
+    return month, day, hour
+
+def _lookup(values, table, default):
+    """Map each value through table with one dict lookup per distinct value."""
+    index = {}
+    codes = np.fromiter((index.setdefault(value, len(index)) for value in values), dtype=np.int64, count=len(values))
+    return np.array([table.get(value, default) for value in index] or [default])[codes]
+
+def _isin(values, choices):
+    mask = np.zeros(len(values), dtype=bool)
+    for choice in choices:
+        mask |= values == choice
+    return mask
+
+def _column(columns, name):
+    return np.asarray(columns[name], dtype=object)
+
+def order_columns(rows):
+    """Columns classify_orders needs, from the row dicts of card 1496."""
+    names = ('order_number', 'status', 'pending_at', 'Stores__name', 'carrier_name', 'shipping_date', 'picking_complete')
+    columns = {name: [] for name in names}
+    for row in rows:
+        for name in names:
+            columns[name].append(row[name])
+    return columns
+
+def recibo_columns(rows):
+    """Columns classify_recibos needs, from the row dicts of card 1485."""
+    names = ('id', 'arrived_at', 'completed_at')
+    columns = {name: [] for name in names}
+    for row in rows:
+        for name in names:
+            columns[name].append(row[name])
+    return columns
+
+def order_states(columns, rules, holidays, excluded_orders=(), now=None):
+    """
+    Outcome of ajuste_pendentes for every input row, as arrays aligned with the
+    rows. kept marks the orders it counts; waiting marks the unshipped orders
+    it leaves out only because their adjusted pending_at is still ahead of now.
+    pending is NaT for excluded, canceled, holded and skipped-store orders.
+    """
+    now = now or datetime.now()
+    # Compared as strings, as the exclusions are stored; the card may return integer order numbers
+    excluded_orders = frozenset(str(order) for order in excluded_orders)
+    numbers = _column(columns, 'order_number')
+    status = _column(columns, 'status')
+    keep = np.fromiter((str(number) not in excluded_orders for number in numbers), dtype=bool, count=len(numbers))
+    keep &= (status != "canceled") & (status != "holded")
+
+    stores = _column(columns, 'Stores__name')[keep]
+    keep_store = ~_isin(stores, rules.skipped_stores)
+    select = np.flatnonzero(keep)[keep_store]
+    stores = stores[keep_store]
+    carriers = _column(columns, 'carrier_name')[select]
+    pending = _timestamps(_column(columns, 'pending_at')[select])
+
+    delayed = _isin(stores, rules.delayed_stores)
+    if delayed.any():
+        # +3 days at 09:00:00, keeping the microseconds like datetime.replace
+        moved = pending[delayed] + np.timedelta64(3, 'D')
+        fraction = moved - moved.astype('datetime64[s]')
+        pending[delayed] = moved.astype('datetime64[D]') + np.timedelta64(9, 'h') + fraction
+
+    # Past the carrier's cutoff, on a weekend or on a holiday: next business day, same time
+    cutoff_hour, cutoff_minute = rules.default_cutoff
+    cutoff = _lookup(carriers, {carrier: hour * 60 + minute for carrier, (hour, minute) in rules.cutoffs.items()},
+                     cutoff_hour * 60 + cutoff_minute)
+    pending = calendar_for(holidays).roll_past_cutoff_array(pending, cutoff)
+
+    shipping = _timestamps(_column(columns, 'shipping_date')[select])
+    shipped = ~np.isnat(shipping)
+    pending_month, pending_day, _ = _parts(pending)
+    ship_month, ship_day, ship_hour = _parts(shipping)
+
+    limit = _lookup(carriers, rules.ship_limits, rules.default_ship_limit)
+    same_month = ship_month == pending_month
+    hit = shipped & (((ship_hour <= limit) & (pending_day == ship_day) & same_month)
+                     | ((ship_day < pending_day) & same_month)
+                     | (ship_month < pending_month))
+
+    waiting = ~shipped & (pending > np.datetime64(now, 'us'))
+    kept = ~(shipped & (ship_month == now.month - 1)) & ~waiting
+
+    n = len(numbers)
+    states = OrderStates(np.zeros(n, dtype=bool), np.zeros(n, dtype=bool), np.full(n, 'NaT', dtype='datetime64[us]'),
+                         np.zeros(n, dtype=bool), np.full(n, 'NaT', dtype='datetime64[us]'))
+    states.kept[select] = kept
+    states.waiting[select] = waiting
+    states.pending[select] = pending
+    states.hit[select] = hit
+    states.picking[select] = _timestamps(_column(columns, 'picking_complete')[select])
+    return states
+
+def classify_orders(columns, rules, holidays, excluded_orders=(), now=None):
+    """
+    Vectorized ajuste_pendentes: the orders it keeps, with their adjusted
+    pending_at, SLA HIT mask and picking_complete (NaT when not picked).
+    """
+    states = order_states(columns, rules, holidays, excluded_orders, now)
+    return Orders(states.pending[states.kept], states.hit[states.kept], states.picking[states.kept])
+
+def recibo_states(columns, excluded_recibos=(), now=None):
+    """
+    First half of incentivos_recibo for every input row: kept marks the
+    receipts it counts, arrived is arrived_at + 1 day (NaT when excluded).
+    """
+    now = now or datetime.now()
+    excluded_recibos = frozenset(str(recibo) for recibo in excluded_recibos)
+    ids = _column(columns, 'id')
+    keep = np.fromiter((str(recibo_id) not in excluded_recibos for recibo_id in ids), dtype=bool, count=len(ids))
+    arrived = np.full(len(ids), 'NaT', dtype='datetime64[us]')
+    arrived[keep] = _timestamps(_column(columns, 'arrived_at')[keep]) + np.timedelta64(1, 'D')
+    completed = _timestamps(_column(columns, 'completed_at'))
+    done = ~np.isnat(completed)
+    completed_month, _, _ = _parts(completed)
+    kept = keep & ~(done & (completed_month == now.month - 1))
+    hit = done & (arrived > completed)
+    return ReciboStates(kept, arrived, hit)
+
+def classify_recibos(columns, excluded_recibos=(), now=None):
+    """Vectorized first half of incentivos_recibo: arrival + 1 day and the HIT mask of the kept receipts."""
+    states = recibo_states(columns, excluded_recibos, now)
+    return Recibos(states.arrived[states.kept], states.hit[states.kept])
+
+def cells(timestamps, now, early=None):
+    """Grid cell of each timestamp: its day of month, its month against now's and the early flag."""
+    month, day, _ = _parts(timestamps)
+    return cell_codes(month, day, now, early)
+
+def cell_codes(month, day, now, early=None):
+    """Grid cell of each (month, day of month) pair against now's month, with the early flag."""
+    rel = np.sign(month - now.month)
+    early = np.zeros(len(day), dtype=np.int64) if early is None else early.astype(np.int64)
+    return ((day - 1) * 3 + rel + 1) * 2 + early
+
+def picked_cells(pending, picking, now):
+    """Cells of picked orders, early when picking_complete's day is not after pending_at's."""
+    _, picking_day, _ = _parts(picking)
+    _, pending_day, _ = _parts(pending)
+    return cells(pending, now, early=picking_day <= pending_day)
+
+def _bincount(codes):
+    return np.bincount(codes, minlength=GRID_SIZE)
+
+def cell_counts(orders, recibos, now=None):
+    """How many orders, HITs, picked orders, receipts and receipt HITs fall in each grid cell."""
+    now = now or datetime.now()
+    order_cells = cells(orders.pending, now)
+    picked = ~np.isnat(orders.picking)
+    recibo_cells = cells(recibos.arrived, now)
+    return CellCounts(_bincount(order_cells), _bincount(order_cells[orders.hit]),
+                      _bincount(picked_cells(orders.pending[picked], orders.picking[picked], now)),
+                      _bincount(recibo_cells), _bincount(recibo_cells[recibos.hit]))
+
+def _weekly(counts, weeks):
+    """1 + the count of each week; weeks may overlap, so each sums its own cells."""
+    return [1 + int(counts[week(_GRID_DAY, _GRID_REL, _GRID_EARLY)].sum()) for week in weeks]
+
+def _first_week(weeks):
+    """Week index of every grid cell under an if/elif chain of predicates, -1 for none."""
+    assigned = np.full(GRID_SIZE, -1)
+    for index, week in reversed(list(enumerate(weeks))):
+        assigned[week(_GRID_DAY, _GRID_REL, _GRID_EARLY)] = index
+    return assigned
+
+def _chained(counts, weeks):
+    assigned = _first_week(weeks)
+    return [1 + int(counts[assigned == index].sum()) for index in range(len(weeks))]
+
+def current_week(week_ends, day):
+    """1-based week bucket of a day of the month, for week_ends like [8, 16, 24]."""
+    return 1 + sum(day > end for end in week_ends)
+
+def _format(hits, totals):
+    return ["{:.2f}".format((hit / total) * 100) for hit, total in zip(hits, totals)]
+
+def pedidos_sla(counts, rules):
+    """Same values as incentivos_pedidos: the weekly SLAs, then the month's SLA percentage."""
+    totals = _weekly(counts.orders, rules.order_weeks)
+    hits = _weekly(counts.order_hits, rules.order_weeks)
+    return (*_format(hits, totals), (int(counts.order_hits.sum()) / int(counts.orders.sum())) * 100)
+
+def recibos_sla(counts, rules):
+    """Same values as incentivos_recibo: the weekly SLAs, then the month's SLA percentage."""
+    totals = _weekly(counts.recibos, rules.recibo_weeks)
+    hits = _weekly(counts.recibo_hits, rules.recibo_weeks)
+    return (*_format(hits, totals), (int(counts.recibo_hits.sum()) / (int(counts.recibos.sum()) or 1)) * 100)
+
+def picking_sla(counts, rules, now=None):
+    """Same values as incentivos_picking: the weekly SLAs, then the average of the weeks so far."""
+    now = now or datetime.now()
+    totals = _chained(counts.orders, rules.picking_weeks)
+    # Orders outside every week are skipped before their picking is looked at
+    in_week = _first_week(rules.picking_weeks) >= 0
+    hits = _chained(np.where(in_week, counts.picked, 0), rules.picking_hit_weeks)
+
+    weekly = _format(hits, totals)
+    so_far = weekly[:current_week(rules.week_ends, now.day)]
+    return (*weekly, sum(float(value) for value in so_far) / len(so_far))
+
+def sla_from_counts(counts, rules, now=None):
+    """The (pedidos, recibos, picking) tuples of a warehouse from its CellCounts."""
+    return pedidos_sla(counts, rules), recibos_sla(counts, rules), picking_sla(counts, rules, now)
+
+def incentivos_sla(order_rows, recibo_rows, rules, holidays, excluded_orders=(), excluded_recibos=(), now=None):
+    """Return the (pedidos, recibos, picking) tuples of a warehouse from the raw card rows."""
+    now = now or datetime.now()
+    orders = classify_orders(order_columns(order_rows), rules, holidays, excluded_orders, now)
+    recibos = classify_recibos(recibo_columns(recibo_rows), excluded_recibos, now)
+    print(f"SLA engine: {len(orders.hit)} orders, {len(recibos.hit)} receipts")
+    return sla_from_counts(cell_counts(orders, recibos, now), rules, now)
@@ -0,0 +1,104 @@
+import re
+import json
+from datetime import datetime, timedelta
+from redis_connection import get_redis_connection
+
+# Every SLA run's numbers, kept as a time series next to the payload the
+# dashboards read (which each run overwrites). Per warehouse:
+#   sla:history:<name>          Redis Stream of every run, trimmed to RAW_RETENTION
+#   sla:history:<name>:hourly   sorted set by hour (score = start of the hour), the
+#                               last run of each hour; kept for HOURLY_RETENTION
+# The values are month-to-date, so the last run of an hour (or day) is what the
+# dashboard showed at its end; that is what the coarser resolutions keep.
+HISTORY_KEY_PREFIX = "sla:history"
+RAW_RETENTION = timedelta(days=3)
+HOURLY_RETENTION = timedelta(days=400)
+
+# Stored fields: the percentages of the payload (sla_*, sN_total), not the circulos, ajuste_* or hora_agora
+HISTORY_FIELD = re.compile(r'sla_(?!total_).+|s\d+_total')
+
+RESOLUTIONS = ('raw', 'hourly', 'daily')
+
+def history_keys(name):
+    base = f"{HISTORY_KEY_PREFIX}:{name}"
+    return base, f"{base}:hourly"
+
+def _timestamp_ms(moment):
+    return int(moment.timestamp() * 1000)
+
+def _point_values(payload):
+    values = {}
+    for key, value in payload.items():
+        if not HISTORY_FIELD.fullmatch(key):
+            continue
+        try:
+            # "100." and "99.5" as written by the payload formatting
+            values[key] = round(float(value), 2)
+        except (TypeError, ValueError):
+            continue
+    return values
+
+def record_run(name, payload, now=None):
+    """Append one run's SLA numbers to the warehouse's history."""
+    now = now or datetime.now()
+    values = _point_values(payload)
+    if not values:
+        return
+    raw_key, hourly_key = history_keys(name)
+    hour = now.replace(minute=0, second=0, microsecond=0)
+    hour_score = _timestamp_ms(hour)
+    try:
+        pipe = get_redis_connection().pipeline()
+        # Stream ids are the time of the run; entries older than RAW_RETENTION are trimmed as new ones come in
+        pipe.xadd(raw_key, values, minid=_timestamp_ms(now - RAW_RETENTION), approximate=True)
+        # The hour's point is replaced by the latest run
+        pipe.zremrangebyscore(hourly_key, hour_score, hour_score)
+        pipe.zadd(hourly_key, {json.dumps({'t': hour_score, **values}, separators=(',', ':')): hour_score})
+        pipe.zremrangebyscore(hourly_key, '-inf', f"({_timestamp_ms(hour - HOURLY_RETENTION)}")
+        pipe.execute()
+    except Exception as e:
+        print(f"Error recording SLA history of {name}: {e}")
+
+def _raw_points(name, start, end):
+    raw_key, _ = history_keys(name)
+    entries = get_redis_connection().xrange(raw_key, min=_timestamp_ms(start), max=_timestamp_ms(end))
+    return [{'t': int(entry_id.split('-')[0]), **{key: float(value) for key, value in fields.items()}}
+            for entry_id, fields in entries]
+
+def _hourly_points(name, start, end):
+    _, hourly_key = history_keys(name)
+    members = get_redis_connection().zrangebyscore(hourly_key, _timestamp_ms(start), _timestamp_ms(end))
+    return [json.loads(member) for member in members]
+
+def _daily_points(points):
+    """Last point of each day."""
+    days = {}
+    for point in points:
+        days[datetime.fromtimestamp(point['t'] / 1000).date()] = point
+    return list(days.values())
+
+def pick_resolution(start, end, now=None):
+    """raw while the range fits the stream and spans at most two days, hourly up to 45 days, then daily."""
+    now = now or datetime.now()
+    if start >= now - RAW_RETENTION and end - start <= timedelta(days=2):
+        return 'raw'
+    return 'hourly' if end - start <= timedelta(days=45) else 'daily'
+
+def load_history(name, start, end, resolution=None, fields=None):
+    """
+    Points of a warehouse between start and end, oldest first, as
+    {'t': epoch ms, <field>: value}. resolution is 'raw', 'hourly' or
+    'daily' (None picks one for the span); fields limits the values returned.
+    """
+    resolution = resolution or pick_resolution(start, end)
+    if resolution not in RESOLUTIONS:
+        raise ValueError(f"Unknown resolution: {resolution}")
+    if resolution == 'raw':
+        points = _raw_points(name, start, end)
+    else:
+        points = _hourly_points(name, start, end)
+        if resolution == 'daily':
+            points = _daily_points(points)
+    if fields:
+        points = [{key: value for key, value in point.items() if key == 't' or key in fields} for point in points]
+    return resolution, points
@@ -0,0 +1,230 @@
+import json
+from collections import namedtuple
+from datetime import datetime, timedelta
+from metabase import process_data
+from metabase_async import fetch_many
+from incremental_fetch import fetch_incremental, watermark_clock, INCREMENTAL_FETCH
+from sla_pushdown import incentivos_pushdown, SLA_PUSHDOWN
+from sla_engine import incentivos_sla, sla_from_counts, current_week, EMBU, EXTREMA, POA
+from sla_counters import (apply_changes, changes_since, delta_inputs, fingerprint, month_rolled_over,
+                          SLA_COUNTERS)
+from redis_connection import get_redis_connection
+from exclusions import clear_exclusions
+from job_timings import StageTimer
+from sla_history import record_run
+from incentivosEmbu import (CONFIG, load_excluded_orders, load_excluded_recibos,
+                            last_workday_of_previous_month, calculate_complementary)
+
+# One run computes the SLA dashboards of every warehouse: cards 1496 and 1485
+# are fetched for all of them in one fetch_many batch, then each profile's
+# payload is built with sla_engine. incentivos*.py keep their main() for
+# running a single warehouse by hand.
+
+WarehouseProfile = namedtuple('WarehouseProfile', [
+    'name',
+    'wh',           # warehouse id of the orders card (1496)
+    'recibo_wh',    # warehouse id of the receipts card (1485)
+    'rules',        # sla_engine.SLARules: cutoffs, shipping limits, brand rules, weeks
+    'output_key',   # Redis key of the payload
+    'json_path',    # local copy of the payload, also where the ajuste_* are read from
+])
+
+WAREHOUSE_PROFILES = [
+    WarehouseProfile('embu', 4, 4, EMBU, 'sla_embu', 'json/sla_embu.json'),
+    # incentivosExtrema reads the receipts of wh 4, kept so the numbers do not move
+    WarehouseProfile('extrema', 166, 4, EXTREMA, 'sla_extrema', 'json/sla_extrema.json'),
+    WarehouseProfile('poa', 232, 232, POA, 'sla_POA', 'json/sla_POA.json'),
+]
+
+EXCLUDED_FILES = ["json/excluded_orders.json", "json/excluded_recibos.json"]
+
+redis_client = get_redis_connection()
+
+def save_to_redis(key, data):
+    try:
+        if data is None:
+            raise ValueError("Cannot save None data to Redis.")
+        redis_client.set(key, json.dumps(data))
+    except Exception as e:
+        print(f"Error saving data to Redis: {e}")
+
+def load_payload(profile):
+    try:
+        with open(profile.json_path, "r") as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return []
+
+def save_payload(profile, data):
+    with open(profile.json_path, "w") as file:
+        json.dump(data, file)
+    save_to_redis(profile.output_key, data)
+
+def check_month_rollover(profiles=WAREHOUSE_PROFILES):
+    """On the first run of a month, clear the exclusions and every profile's payload."""
+    if not month_rolled_over():
+        return
+
+    for file_path in EXCLUDED_FILES + [profile.json_path for profile in profiles]:
+        with open(file_path, "w") as file:
+            json.dump([], file)
+    for profile in profiles:
+        save_to_redis(profile.output_key, "[]")
+    clear_exclusions()
+    print("jsons apagados")
+
+def _order_inputs(profile, pending_at_start_date):
+    return {'pending_at_start_date': pending_at_start_date, 'wh': profile.wh}
+
+def _recibo_inputs(profile, arrived_at):
+    return {'arrived_at': arrived_at, 'wh': profile.recibo_wh}
+
+def fetch_rows(profiles, pending_at_start_date, arrived_at, since=None):
+    """
+    Order and receipt rows of every profile, {name: (orders, recibos)}. All
+    card queries go out in one fetch_many batch; profiles asking for the same
+    query share its result. since maps profile names to the watermark of the
+    SLA counters, to fetch only the rows changed after it (None: all rows).
+    """
+    incremental = INCREMENTAL_FETCH and since is None
+    since = since or {}
+    # process_data returns the parameters as one JSON string, so equal queries compare equal
+    queries = {}
+    for profile in profiles:
+        watermark = since.get(profile.name)
+        if not incremental:
+            order_inputs = delta_inputs(_order_inputs(profile, pending_at_start_date), watermark)
+            queries[profile.name, '1496'] = ('1496', process_data(order_inputs)['parameters'])
+        recibo_inputs = delta_inputs(_recibo_inputs(profile, arrived_at), watermark)
+        queries[profile.name, '1485'] = ('1485', process_data(recibo_inputs)['parameters'])
+    unique = list(dict.fromkeys(queries.values()))
+    datasets = dict(zip(unique, fetch_many([(card, {'parameters': parameters}) for card, parameters in unique],
+                                           refresh=any(since.values()))))
+
+    result = {}
+    for profile in profiles:
+        if incremental:
+            # The incremental store is kept per warehouse and only downloads what changed
+            orders = fetch_incremental('1496', _order_inputs(profile, pending_at_start_date))
+        else:
+            orders = datasets[queries[profile.name, '1496']]
+        result[profile.name] = (orders, datasets[queries[profile.name, '1485']])
+    return result
+
+def build_payload(profile, pedidos, recibos, picking, now):
+    """The sla_* dict incentivos*.main saves, from the (pedidos, recibos, picking) tuples."""
+    weeks = len(profile.rules.week_ends) + 1
+    sla_semanas, sla_porcent = pedidos[:weeks], pedidos[weeks]
+    sla_recibos, SLA_recibos_total = recibos[:weeks], recibos[weeks]
+    sla_pickings, sla_picking_total = picking[:weeks], picking[weeks]
+
+    totals = [(float(semana) + float(recibo) + float(pick)) / 3
+              for semana, recibo, pick in zip(sla_semanas, sla_recibos, sla_pickings)]
+    so_far = totals[:current_week(profile.rules.week_ends, now.day)]
+    sla_mes = sum(so_far) / len(so_far)
+
+    #calculo redução SLA 0.01%
+    ajuste_recibos = 0
+    ajuste_picking = 0
+    ajuste_pedidos = 0
+
+    data_erros = load_payload(profile)
+    if data_erros:
+        ajuste_recibos = int(data_erros.get("ajuste_recibos", 0))
+        ajuste_picking = int(data_erros.get("ajuste_picking", 0))
+        ajuste_pedidos = int(data_erros.get("ajuste_pedidos", 0))
+
+    SLA_recibos_total = SLA_recibos_total - (ajuste_recibos*0.01)
+    sla_picking_total = sla_picking_total - (ajuste_picking*0.01)
+    sla_porcent = sla_porcent - (ajuste_pedidos*0.01)
+
+    data = {}
+    data.update({f"sla_semana_{week}": value for week, value in enumerate(sla_semanas, 1)})
+    data["sla_porcent"] = sla_porcent
+    data.update({f"sla_recibo_{week}": value for week, value in enumerate(sla_recibos, 1)})
+    data["sla_recibos_total"] = SLA_recibos_total
+    data.update({f"sla_picking_semana_{week}": value for week, value in enumerate(sla_pickings, 1)})
+    data["sla_picking_total"] = sla_picking_total
+    data.update({f"s{week}_total": value for week, value in enumerate(totals, 1)})
+    data["sla_mes"] = sla_mes
+
+    for key in data:
+        float_value = float(data[key])
+        # One decimal place, anything that rounds to 100 shows as "100."
+        formatted_value = "{:.1f}".format(float_value)
+        data[key] = "100." if float_value >= 100 or formatted_value == "100.0" else formatted_value
+
+    data.update({f"total_s{week}_circulo": calculate_complementary(value) for week, value in enumerate(totals, 1)})
+    data.update({
+        "sla_total_circulo": calculate_complementary(sla_mes),
+        "sla_total_ci_circulo": calculate_complementary(SLA_recibos_total),
+        "sla_total_pi_circulo": calculate_complementary(sla_picking_total),
+        "sla_total_pa_circulo": calculate_complementary(sla_porcent),
+        "ajuste_recibos": ajuste_recibos,
+        "ajuste_picking": ajuste_picking,
+        "ajuste_pedidos": ajuste_pedidos,
+        "hora_agora": (now - timedelta(hours=3)).strftime("%H:%M")
+    })
+    return data
+
+def _pushdown_results(profiles, now, pending_at_start_date, arrived_at, excluded_orders, excluded_recibos, timer):
+    return {profile.name: incentivos_pushdown(profile.wh, pending_at_start_date, arrived_at, excluded_orders,
+                                              excluded_recibos, profile.rules, now)
+            for profile in profiles}
+
+def _engine_results(profiles, now, pending_at_start_date, arrived_at, excluded_orders, excluded_recibos, timer):
+    rows = fetch_rows(profiles, pending_at_start_date, arrived_at)
+    timer.lap('fetch')
+    return {profile.name: incentivos_sla(*rows[profile.name], profile.rules, CONFIG['BR']['holidays'],
+                                         excluded_orders, excluded_recibos, now)
+            for profile in profiles}
+
+def _counter_results(profiles, now, pending_at_start_date, arrived_at, excluded_orders, excluded_recibos, timer):
+    """Only the rows changed since the last run are fetched and applied to the Redis counters."""
+    holidays = CONFIG['BR']['holidays']
+    fingerprints = {profile.name: fingerprint(profile, holidays, excluded_orders, excluded_recibos)
+                    for profile in profiles}
+    since = {profile.name: changes_since(profile, now, fingerprints[profile.name]) for profile in profiles}
+    fetch_started = watermark_clock()
+    rows = fetch_rows(profiles, pending_at_start_date, arrived_at, since)
+    timer.lap('fetch')
+
+    results = {}
+    for profile in profiles:
+        counts = apply_changes(profile, *rows[profile.name], since[profile.name], fingerprints[profile.name],
+                               holidays, excluded_orders, excluded_recibos, now, fetch_started)
+        results[profile.name] = sla_from_counts(counts, profile.rules, now)
+    return results
+
+def run_pipeline(profiles=WAREHOUSE_PROFILES):
+    """Compute and save the SLA payload of every profile in one run."""
+    # Stored under the scheduler job id, for /jobs/status
+    timer = StageTimer('sla')
+    check_month_rollover(profiles)
+    now = datetime.now()
+    pending_at_start_date = last_workday_of_previous_month()
+    arrived_at = now.replace(day=1) - timedelta(days=1)
+    excluded_orders = load_excluded_orders()
+    excluded_recibos = load_excluded_recibos()
+
+    if SLA_PUSHDOWN:
+        compute = _pushdown_results
+    elif SLA_COUNTERS:
+        compute = _counter_results
+    else:
+        compute = _engine_results
+    timer.lap('prepare')
+    results = compute(profiles, now, pending_at_start_date, arrived_at, excluded_orders, excluded_recibos, timer)
+    timer.lap('compute')
+
+    for profile in profiles:
+        pedidos, recibos, picking = results[profile.name]
+        payload = build_payload(profile, pedidos, recibos, picking, now)
+        save_payload(profile, payload)
+        record_run(profile.name, payload, now)
+        print(f"SLA payload of {profile.name} saved to {profile.output_key}")
+    timer.lap('save')
+    timer.save()
+
+if __name__ == "__main__":
+    run_pipeline()
@@ -0,0 +1,80 @@
+import os
+import numpy as np
+from dotenv import dotenv_values
+from metabase import get_dataset, process_data
+from sla_engine import CellCounts, GRID_SIZE, cell_codes, sla_from_counts
+
+env_config = dotenv_values(".env")
+
+# Optional aggregation pushdown for the incentivos dashboards: instead of
+# downloading every order (1496) and receipt (1485) to count HITs per week,
+# two aggregated cards return the counts already grouped, and only the
+# exclusions and manual ajuste_* adjustments are applied here.
+#
+# The groups are the cells of sla_engine's grid rather than week buckets, so
+# the engine's week rules (POA's overlapping second week, Embu's catch-all
+# fourth picking week...) give the same numbers as the raw rows.
+# Orders card, template tags wh, pending_at_start_date and excluded
+# (comma-separated order numbers), one row per group:
+#     month, day, sla ('HIT' / 'MISS'), picking ('early' / 'late' / null), orders
+# month and day are those of the SLA-adjusted pending_at; picking is null when
+# the order is not picked, 'early' when picking_complete's day of month is not
+# after pending_at's. Receipts card, template tags wh, arrived_at and excluded
+# (receipt ids): month, day (of the adjusted arrival), sla, recibos.
+# The raw-row functions in incentivos*.py stay the reference for the SLA rules
+# and are still used when pushdown is off or for drill-down.
+ORDERS_AGGREGATE_CARD = env_config.get('SLA_ORDERS_AGGREGATE_CARD') or os.environ.get('SLA_ORDERS_AGGREGATE_CARD')
+RECIBOS_AGGREGATE_CARD = env_config.get('SLA_RECIBOS_AGGREGATE_CARD') or os.environ.get('SLA_RECIBOS_AGGREGATE_CARD')
+SLA_PUSHDOWN = ((env_config.get('SLA_PUSHDOWN') or os.environ.get('SLA_PUSHDOWN', '')) == '1'
+                and bool(ORDERS_AGGREGATE_CARD) and bool(RECIBOS_AGGREGATE_CARD))
+
+def _excluded_param(excluded):
+    # Sorted, so the same exclusions always make the same query (and cache key)
+    return ','.join(sorted(str(item) for item in excluded)) or None
+
+def fetch_order_groups(wh, pending_at_start_date, excluded_orders):
+    return get_dataset(ORDERS_AGGREGATE_CARD, process_data({
+        'pending_at_start_date': pending_at_start_date,
+        'wh': wh,
+        'excluded': _excluded_param(excluded_orders)
+    }))
+
+def fetch_recibo_groups(wh, arrived_at, excluded_recibos):
+    return get_dataset(RECIBOS_AGGREGATE_CARD, process_data({
+        'arrived_at': arrived_at,
+        'wh': wh,
+        'excluded': _excluded_param(excluded_recibos)
+    }))
+
+def _cell_counts(groups, count_column, now, early=None):
+    """Counts of the groups per grid cell; early is an optional flag per group."""
+    month = np.array([int(group['month']) for group in groups], dtype=np.int64)
+    day = np.array([int(group['day']) for group in groups], dtype=np.int64)
+    weights = np.array([int(group[count_column]) for group in groups], dtype=np.int64)
+    codes = cell_codes(month, day, now, early)
+    return np.bincount(codes, weights=weights, minlength=GRID_SIZE).astype(np.int64)
+
+def _subset(groups, keep):
+    return [group for group in groups if keep(group)]
+
+def pushdown_counts(order_groups, recibo_groups, now):
+    """sla_engine.CellCounts of the aggregated cards' groups."""
+    picked = _subset(order_groups, lambda group: group.get('picking') is not None)
+    early = np.array([group['picking'] == 'early' for group in picked], dtype=bool)
+    return CellCounts(
+        _cell_counts(order_groups, 'orders', now),
+        _cell_counts(_subset(order_groups, lambda group: group['sla'] == "HIT"), 'orders', now),
+        _cell_counts(picked, 'orders', now, early),
+        _cell_counts(recibo_groups, 'recibos', now),
+        _cell_counts(_subset(recibo_groups, lambda group: group['sla'] == "HIT"), 'recibos', now),
+    )
+
+def incentivos_pushdown(wh, pending_at_start_date, arrived_at, excluded_orders, excluded_recibos, rules, now):
+    """
+    Return the (pedidos, recibos, picking) tuples of a warehouse from the
+    aggregated cards, through the same sla_engine week rules as the raw rows.
+    """
+    order_groups = fetch_order_groups(wh, pending_at_start_date, excluded_orders)
+    recibo_groups = fetch_recibo_groups(wh, arrived_at, excluded_recibos)
+    print(f"SLA pushdown for wh {wh}: {len(order_groups)} order groups, {len(recibo_groups)} receipt groups")
+    return sla_from_counts(pushdown_counts(order_groups, recibo_groups, now), rules, now)
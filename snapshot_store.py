@@ -0,0 +1,324 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+from datetime import datetime
+from collections import namedtuple
+import numpy as np
+from filelock import FileLock
+from dotenv import dotenv_values
+from metabase import CategoricalColumn, _to_datetime64
+from metabase_cache import canonical_params
+
+env_config = dotenv_values(".env")
+
+# Typed, memory-mappable copies of the latest results of the big cards, kept on
+# disk so they survive worker recycling and can be read by any process without copying
+SNAPSHOT_DIR = (env_config.get('SNAPSHOT_DIR') or os.environ.get('SNAPSHOT_DIR')
+                or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'temp', 'snapshots'))
+SNAPSHOT_CARDS = {'1496', '1485', '3379', '3477'}
+
+# Versions kept per snapshot; older ones are removed after a new one is published
+KEEP_VERSIONS = 2
+# Snapshots (param sets) kept per card, newest first; the one card_<q>.latest points to is always kept
+KEEP_NAMES = 4
+
+# Timestamp columns of the snapshot cards, stored as datetime64 (wall-clock, offset dropped)
+TIMESTAMP_COLUMNS = {'pending_at', 'shipping_date', 'picking_complete', 'arrived_at', 'completed_at',
+                     'delivered_at', 'estimated_time_arrival', 'processado', 'first_delivery_attempt_at'}
+# Repetitive text columns, stored dictionary-encoded
+CATEGORY_COLUMNS = {'carrier_name', 'Stores__name', 'store_name', 'status', 'shipping_status', 'account_type'}
+
+class StringColumn:
+    """UTF-8 strings packed in one byte buffer plus offsets; both can be memory-mapped."""
+
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return bytes(self.data[self.offsets[i]:self.offsets[i + 1]]).decode('utf-8')
+
+    def tolist(self):
+        return [self[i] for i in range(len(self))]
+
+    @classmethod
+    def from_strings(cls, values):
+        encoded = [value.encode('utf-8') for value in values]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(value) for value in encoded], out=offsets[1:])
+        return cls(np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets)
+
+Snapshot = namedtuple('Snapshot', ['columns', 'nulls', 'meta'])
+
+def snapshot_name(question, params):
+    digest = hashlib.sha1(canonical_params(params).encode('utf-8')).hexdigest()[:12]
+    return f"card_{question}_{digest}"
+
+def params_inputs(params):
+    """Template-tag values sent in get_dataset params, as {tag: value}."""
+    parameters = (params or {}).get('parameters', [])
+    if isinstance(parameters, str):
+        parameters = json.loads(parameters)
+    return {p['target'][1][1]: p['value'] for p in parameters}
+
+def _column_kind(name, values):
+    if name in TIMESTAMP_COLUMNS:
+        return 'datetime'
+    if name in CATEGORY_COLUMNS:
+        return 'category'
+    present = [value for value in values if value is not None]
+    if present and all(type(value) is bool for value in present):
+        return 'bool'
+    if present and all(type(value) is int for value in present):
+        return 'int'
+    if present and all(type(value) in (int, float) for value in present):
+        return 'float'
+    if all(type(value) is str for value in present):
+        return 'str'
+    return 'json'
+
+def _encode_column(kind, values):
+    """Return (arrays to save, null mask or None, extra meta) for one column."""
+    nulls = np.fromiter((value is None for value in values), dtype=bool, count=len(values))
+    has_nulls = bool(nulls.any())
+
+    if kind == 'datetime':
+        return {'values': _to_datetime64([value or '' for value in values])}, None, {}
+    if kind == 'category':
+        index = {}
+        codes = np.fromiter((-1 if value is None else index.setdefault(value, len(index)) for value in values),
+                            dtype=np.int32, count=len(values))
+        return {'codes': codes}, None, {'categories': list(index)}
+    if kind in ('int', 'bool'):
+        dtype = np.int64 if kind == 'int' else np.uint8
+        return {'values': np.array([0 if value is None else value for value in values], dtype=dtype)}, \
+            nulls if has_nulls else None, {}
+    if kind == 'float':
+        return {'values': np.array([np.nan if value is None else value for value in values], dtype=np.float64)}, \
+            nulls if has_nulls else None, {}
+
+    if kind == 'json':
+        values = [None if value is None else json.dumps(value, ensure_ascii=False) for value in values]
+    column = StringColumn.from_strings(['' if value is None else value for value in values])
+    return {'data': column.data, 'offsets': column.offsets}, nulls if has_nulls else None, {}
+
+def _encode_typed_column(column):
+    """Encode a column already decoded by metabase.get_dataset_columns."""
+    if isinstance(column, CategoricalColumn):
+        return 'category', {'codes': np.asarray(column.codes, dtype=np.int32)}, None, {'categories': list(column.categories)}
+    column = np.asarray(column)
+    if column.dtype.kind == 'M':
+        return 'datetime', {'values': column.astype('datetime64[us]')}, None, {}
+    if column.dtype.kind in 'iuf':
+        return ('float' if column.dtype.kind == 'f' else 'int'), {'values': column}, None, {}
+    strings = StringColumn.from_strings([str(value) for value in column])
+    return 'str', {'data': strings.data, 'offsets': strings.offsets}, None, {}
+
+def _write_version(name, encoded, rows, meta):
+    snapshot_dir = os.path.join(SNAPSHOT_DIR, name)
+    version = f"{datetime.now():%Y%m%dT%H%M%S%f}-{os.getpid()}"
+    tmp_dir = os.path.join(snapshot_dir, f".tmp-{version}")
+    os.makedirs(tmp_dir)
+
+    columns_meta = []
+    for i, (column_name, kind, arrays, nulls, extra) in enumerate(encoded):
+        files = {}
+        for part, array in arrays.items():
+            files[part] = f"c{i}.{part}.npy"
+            np.save(os.path.join(tmp_dir, files[part]), array)
+        if nulls is not None:
+            files['nulls'] = f"c{i}.nulls.npy"
+            np.save(os.path.join(tmp_dir, files['nulls']), nulls)
+        columns_meta.append({'name': column_name, 'kind': kind, 'files': files, **extra})
+
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w', encoding='utf-8') as f:
+        json.dump({**meta, 'rows': rows, 'created_at': datetime.now().isoformat(), 'columns': columns_meta},
+                  f, ensure_ascii=False)
+
+    # Publish: rename the finished version into place, then swap the CURRENT pointer atomically
+    os.rename(tmp_dir, os.path.join(snapshot_dir, version))
+    pointer_tmp = os.path.join(snapshot_dir, f".CURRENT-{version}")
+    with open(pointer_tmp, 'w') as f:
+        f.write(version)
+    os.replace(pointer_tmp, os.path.join(snapshot_dir, 'CURRENT'))
+
+    # Open memory maps of removed versions stay valid until their readers close them
+    versions = sorted(entry for entry in os.listdir(snapshot_dir) if not entry.startswith('.') and entry != 'CURRENT')
+    for old in versions[:-KEEP_VERSIONS]:
+        shutil.rmtree(os.path.join(snapshot_dir, old), ignore_errors=True)
+    return version
+
+def save_rows_snapshot(question, params, column_values, rows, stamp=None):
+    """
+    Save a card result given as {column: [values...]} (the JSON rows, column by column).
+    Also marks it as the latest snapshot of the card unless a newer fetch already did
+    (stamp: time.time_ns() of when the fetch started, default now).
+    """
+    name = snapshot_name(question, params)
+    encoded = []
+    for column_name, values in column_values.items():
+        kind = _column_kind(column_name, values)
+        arrays, nulls, extra = _encode_column(kind, values)
+        encoded.append((column_name, kind, arrays, nulls, extra))
+    _publish(question, name, encoded, rows, params, stamp)
+    return name
+
+def save_columns_snapshot(question, params, columns, stamp=None):
+    """Save the output of metabase.get_dataset_columns as a snapshot."""
+    name = snapshot_name(question, params)
+    encoded = [(column_name, *_encode_typed_column(column)) for column_name, column in columns.items()]
+    first = next(iter(columns.values()), [])
+    rows = len(first.codes) if isinstance(first, CategoricalColumn) else len(first)
+    _publish(question, name, encoded, rows, params, stamp)
+    return name
+
+def _read_latest(pointer):
+    """(name, stamp) of a card_<q>.latest pointer, (None, 0) when there is none."""
+    try:
+        with open(pointer) as f:
+            parts = f.read().split()
+    except FileNotFoundError:
+        return None, 0
+    # Pointers written before the stamp was added hold only the name
+    return parts[0], int(parts[1]) if len(parts) > 1 else 0
+
+def _publish(question, name, encoded, rows, params, stamp=None):
+    """
+    Write a new version of the snapshot, point card_<q>.latest at it unless it
+    already points at a fetch started later, and remove the card's oldest
+    snapshots past KEEP_NAMES. Saves run in background threads of several
+    workers, so all of it happens under the card's file lock.
+    """
+    stamp = stamp or time.time_ns()
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    pointer = os.path.join(SNAPSHOT_DIR, f"card_{question}.latest")
+    with FileLock(f"{pointer}.lock"):
+        _write_version(name, encoded, rows, {'card': str(question), 'params': params})
+        latest, latest_stamp = _read_latest(pointer)
+        if stamp >= latest_stamp:
+            pointer_tmp = f"{pointer}.{os.getpid()}"
+            with open(pointer_tmp, 'w') as f:
+                f.write(f"{name} {stamp}")
+            os.replace(pointer_tmp, pointer)
+            latest = name
+        _prune_names(question, keep={name, latest})
+
+def _prune_names(question, keep):
+    """Remove the snapshots of a card past the KEEP_NAMES most recently published (and not in keep)."""
+    prefix = f"card_{question}_"
+    published = []
+    for entry in os.listdir(SNAPSHOT_DIR):
+        if not entry.startswith(prefix):
+            continue
+        try:
+            published.append((os.path.getmtime(os.path.join(SNAPSHOT_DIR, entry, 'CURRENT')), entry))
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+    published.sort(reverse=True)
+    for _, entry in published[KEEP_NAMES:]:
+        if entry not in keep:
+            shutil.rmtree(os.path.join(SNAPSHOT_DIR, entry), ignore_errors=True)
+
+def load_snapshot(name):
+    """
+    Open a snapshot memory-mapped (read-only, shared with other processes by the
+    page cache). Returns Snapshot(columns, nulls, meta) or None if there is none.
+    """
+    snapshot_dir = os.path.join(SNAPSHOT_DIR, name)
+    try:
+        with open(os.path.join(snapshot_dir, 'CURRENT')) as f:
+            version_dir = os.path.join(snapshot_dir, f.read().strip())
+        with open(os.path.join(version_dir, 'meta.json'), encoding='utf-8') as f:
+            meta = json.load(f)
+    except FileNotFoundError:
+        return None
+
+    def load(filename):
+        return np.load(os.path.join(version_dir, filename), mmap_mode='r')
+
+    columns, nulls = {}, {}
+    for column in meta['columns']:
+        files = column['files']
+        if column['kind'] == 'category':
+            columns[column['name']] = CategoricalColumn(load(files['codes']), column['categories'])
+        elif column['kind'] in ('str', 'json'):
+            columns[column['name']] = StringColumn(load(files['data']), load(files['offsets']))
+        else:
+            columns[column['name']] = load(files['values'])
+        if 'nulls' in files:
+            nulls[column['name']] = load(files['nulls'])
+    return Snapshot(columns, nulls, meta)
+
+def load_card_snapshot(question, params=None):
+    """Latest snapshot of a card, or of the card with these exact params when given."""
+    if params is not None:
+        return load_snapshot(snapshot_name(question, params))
+    name, _ = _read_latest(os.path.join(SNAPSHOT_DIR, f"card_{question}.latest"))
+    return load_snapshot(name) if name else None
+
+def iter_snapshot_rows(snapshot):
+    """
+    Rebuild row dicts shaped like get_dataset's. Timestamps come back as ISO
+    strings without offset, which parse_date turns into the same wall-clock time.
+    """
+    kinds = {column['name']: column['kind'] for column in snapshot.meta['columns']}
+    decoded = {}
+    for name, column in snapshot.columns.items():
+        kind = kinds[name]
+        if kind == 'datetime':
+            strings = np.datetime_as_string(column, unit='us')
+            values = [None if value == 'NaT' else value for value in strings.tolist()]
+        elif kind == 'category':
+            categories = column.categories
+            values = [None if code < 0 else categories[code] for code in column.codes.tolist()]
+        elif kind == 'json':
+            values = [json.loads(value) if value else None for value in column.tolist()]
+        elif kind == 'bool':
+            values = [bool(value) for value in column.tolist()]
+        else:
+            values = column.tolist()
+        if name in snapshot.nulls:
+            values = [None if null else value for value, null in zip(values, snapshot.nulls[name].tolist())]
+        decoded[name] = values
+
+    names = list(decoded)
+    for row_values in zip(*(decoded[name] for name in names)):
+        yield dict(zip(names, row_values))
+
+class SnapshotWriter:
+    """
+    Collects a card's rows column by column while they stream (before callers
+    edit them) and saves the snapshot when the stream completes.
+    """
+
+    def __init__(self, question, params):
+        self.question = question
+        self.params = params
+        # Orders the card's latest pointer by when the fetch started, not when its save finished
+        self.stamp = time.time_ns()
+        self.columns = {}
+        self.rows = 0
+
+    def append(self, row):
+        for name, value in row.items():
+            column = self.columns.get(name)
+            if column is None:
+                column = self.columns[name] = [None] * self.rows
+            column.append(value)
+        self.rows += 1
+        for column in self.columns.values():
+            if len(column) < self.rows:
+                column.append(None)
+
+    def save(self):
+        started = time.perf_counter()
+        try:
+            save_rows_snapshot(self.question, self.params, self.columns, self.rows, self.stamp)
+            print(f"Snapshot of card {self.question} saved ({self.rows} rows, {time.perf_counter() - started:.2f}s)")
+        except Exception as e:
+            print(f"Error saving snapshot of card {self.question}: {e}")
@@ -1,6 +1,6 @@
 from datetime import datetime, timedelta
 import json
-from metabase import get_dataset, process_data
+from metabase import get_dataset, process_data, MetabaseUnavailable, JOB_DEADLINE
 
 
 def generate_tote_pair_zpl(tote1, tote2):
@@ -20,11 +20,12 @@ def generate_tote_pair_zpl(tote1, tote2):
     return zpl_code
 
 
-def get_tote_livre(last_print_date=None):
+def get_tote_livre(last_print_date=None, refresh=False, deadline=JOB_DEADLINE):
     """
     1. Run dataset with last_print_date as parameter
     2. Get unique_code from each row (already in 'toteXXXXX' format)
     3. Generate ZPL for all available totes, 2 by 2
+    refresh=True bypasses the Metabase cache; deadline bounds the wait for Metabase.
     """
     try:
         if not last_print_date:
@@ -43,7 +44,7 @@ def get_tote_livre(last_print_date=None):
             try:
                 print(f"[DEBUG] Attempt {attempt + 1}/{max_retries} to get dataset")
                 params = process_data({'data': last_print_date})
-                response = get_dataset('11808', params)
+                response = get_dataset('11808', params, refresh=refresh, deadline=deadline)
                 print(f"[DEBUG] Raw response from get_dataset: {response}")
                 
                 # Check if we got valid data
@@ -58,6 +59,8 @@ def get_tote_livre(last_print_date=None):
                     else:
                         raise Exception("Failed to get valid data after all retries")
                         
+            except MetabaseUnavailable:
+                raise  # get_dataset already used up the deadline
             except Exception as e:
                 print(f"[DEBUG] Error on attempt {attempt + 1}: {str(e)}")
                 if attempt < max_retries - 1: